@@ -1,11 +1,14 @@
 import os
 import eventlet
 
-eventlet.monkey_patch()
+# Background jobs run in their own processes without eventlet (see scrapers/scheduler.py)
+if not os.environ.get('DISABLE_MONKEY_PATCH'):
+    eventlet.monkey_patch()
 import logging
 import os
 from typing import Tuple
 
+import click
 from dotenv import load_dotenv
 from easy_profile import EasyProfileMiddleware
 from flask import Flask, jsonify
@@ -89,7 +92,7 @@ def create_app(env: str) -> Tuple[Flask, SocketIO]:
         from .routes.paper import app as paper_routes
         from .routes.paper_list import app as paper_list_routes
         from .routes.user import app as user_routes
-        from .scrapers import arxiv, paperswithcode, twitter
+        from .scrapers import arxiv, arxiv_oai, latex_backfill, metadata_backfill, paperswithcode, scheduler, twitter
         from .websocket import setup_websocket
 
         flask_app.register_blueprint(paper_list_routes, url_prefix='/papers')
@@ -105,6 +108,13 @@ def create_app(env: str) -> Tuple[Flask, SocketIO]:
     def fetch_arxiv():
         arxiv.run()
 
+    @flask_app.cli.command("fetch-arxiv-incremental")
+    @click.option('--set', 'sets', multiple=True, help='OAI sets to harvest (default: cs, stat)')
+    @click.option('--category', 'categories', multiple=True, help='Only store papers with these categories')
+    @click.option('--from-date', default=None, help='Override the stored watermark (YYYY-MM-DD)')
+    def fetch_arxiv_incremental(sets, categories, from_date):
+        arxiv_oai.run(sets=list(sets), categories=list(categories), from_date=from_date)
+
     @flask_app.cli.command("fetch-paperswithcode")
     def fetch_papers_with_code():
         paperswithcode.run()
@@ -113,6 +123,59 @@ def create_app(env: str) -> Tuple[Flask, SocketIO]:
     def fetch_twitter():
         twitter.main_twitter_fetcher()
 
+    @flask_app.cli.command("run-background-tasks")
+    @click.option('--job', 'job_names', multiple=True, type=click.Choice([job.name for job in scheduler.JOBS]),
+                  help='Only schedule these jobs (default: all)')
+    @click.option('--run-once', is_flag=True, help='Run the jobs once and exit')
+    def run_background_tasks(job_names, run_once):
+        scheduler.run(job_names=list(job_names), run_once=run_once)
+
+    @flask_app.cli.command("run-job")
+    @click.argument('name', type=click.Choice([job.name for job in scheduler.JOBS]))
+    def run_job(name):
+        scheduler.run_job(scheduler.get_job(name))
+
+    @flask_app.cli.command("send-emails")
+    def send_emails():
+        from .routes.notifications import digest
+        num_sent = digest.send_pending_notifications()
+        logger.info(f'Sent {num_sent} pending emails')
+
+    @flask_app.cli.command("realtime-metrics")
+    def realtime_metrics():
+        from .realtime import get_metrics
+        click.echo(get_metrics())
+
+    @flask_app.cli.command("update-twitter-scores")
+    @click.option('--verify', is_flag=True, help='Compare the incremental scores to a full recomputation')
+    @click.option('--fix', is_flag=True, help='Overwrite mismatching scores with the recomputed ones')
+    def update_twitter_scores(verify, fix):
+        twitter.update_twitter_scores(verify=verify, fix=fix)
+
+    @flask_app.cli.command("reprocess-metadata")
+    @click.option('--paper-id', 'paper_ids', type=int, multiple=True, help='Only reprocess these papers')
+    @click.option('--workers', type=int, default=4, help='Number of concurrent requests to Grobid')
+    @click.option('--batch-size', type=int, default=100)
+    @click.option('--max-per-second', type=float, default=2.0, help='Max papers sent to Grobid per second')
+    @click.option('--dry-run', is_flag=True, help='Only report the papers that would be processed')
+    @click.option('--restart', is_flag=True, help='Ignore the stored checkpoint and start from the first paper')
+    @click.option('--force', is_flag=True, help='Reprocess the given papers even if their metadata is up to date')
+    def reprocess_metadata(paper_ids, workers, batch_size, max_per_second, dry_run, restart, force):
+        if force and not paper_ids:
+            raise click.UsageError('--force requires --paper-id')
+        metadata_backfill.run(paper_ids=list(paper_ids), workers=workers, batch_size=batch_size,
+                              max_per_second=max_per_second, dry_run=dry_run, restart=restart, force=force)
+
+    @flask_app.cli.command("extract-latex")
+    @click.option('--batch-size', type=int, default=50)
+    @click.option('--download-workers', type=int, default=2, help='Number of concurrent downloads from arXiv')
+    @click.option('--parse-workers', type=int, default=4, help='Number of processes parsing the sources')
+    @click.option('--max-downloads-per-second', type=float, default=1.0)
+    @click.option('--limit', type=int, default=None, help='Max number of papers to process')
+    def extract_latex(batch_size, download_workers, parse_workers, max_downloads_per_second, limit):
+        latex_backfill.run(batch_size=batch_size, download_workers=download_workers, parse_workers=parse_workers,
+                           max_downloads_per_second=max_downloads_per_second, limit=limit)
+
     @flask_app.route('/health')
     def hello_world():
         return 'Running!'
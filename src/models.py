@@ -23,12 +23,14 @@ make_searchable(db.metadata)
 
 paper_author_table = db.Table('paper_author', db.metadata,
                               db.Column('paper_id', db.Integer, db.ForeignKey('paper.id')),
-                              db.Column('author_id', db.Integer, db.ForeignKey('author.id'))
+                              db.Column('author_id', db.Integer, db.ForeignKey('author.id')),
+                              db.UniqueConstraint('paper_id', 'author_id', name='uq_paper_author')
                               )
 
 paper_tag_table = db.Table('paper_tag', db.metadata,
                            db.Column('paper_id', db.Integer, db.ForeignKey('paper.id'), index=True),
-                           db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), index=True)
+                           db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), index=True),
+                           db.UniqueConstraint('paper_id', 'tag_id', name='uq_paper_tag')
                            )
 
 paper_collection_table = db.Table('paper_collection', db.metadata,
@@ -79,7 +81,8 @@ class MetadataState(enum.Enum):
 class Paper(db.Model):
     __tablename__ = 'paper'
     __versioned__ = {
-        'exclude': ['authors', 'tags', 'collections', 'comments', 'tweets', 'unsubscribed_users', 'metadata_state', 'table_of_contents', 'metadata_version']
+        'exclude': ['authors', 'tags', 'collections', 'comments', 'tweets', 'unsubscribed_users', 'metadata_state', 'table_of_contents', 'metadata_version',
+                    'latex_references', 'latex_sections', 'latex_version']
     }
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -111,6 +114,9 @@ class Paper(db.Model):
     metadata_state = db.Column(db.Enum(MetadataState), nullable=True, default=MetadataState.ready)
     table_of_contents = db.Column(db.JSON, nullable=True)
     metadata_version = db.Column(db.Integer, default=0)
+    latex_references = db.Column(db.JSON, nullable=True)
+    latex_sections = db.Column(db.JSON, nullable=True)
+    latex_version = db.Column(db.Float, nullable=True)
 
     doi = db.Column(db.String, nullable=True)
 
@@ -131,7 +137,7 @@ class ArxivPaper(db.Model):
 class Tag(db.Model):
     __tablename__ = 'tag'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False, index=True)
+    name = db.Column(db.String(50), nullable=False, index=True, unique=True)
     papers = db.relationship("Paper", back_populates="tags", secondary=paper_tag_table)
     source = db.Column(db.String(30), nullable=False)
 
@@ -139,7 +145,7 @@ class Tag(db.Model):
 class Author(db.Model):
     __tablename__ = 'author'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(200), nullable=False, index=True)
+    name = db.Column(db.String(200), nullable=False, index=True, unique=True)
     first_name = db.Column(db.String(80), nullable=True)
     last_name = db.Column(db.String(80), nullable=True)
     organization = db.Column(ARRAY(db.String), nullable=True)
@@ -172,6 +178,7 @@ class Permission(db.Model):
 
 class Comment(db.Model):
     __tablename__ = 'comment'
+    __table_args__ = (db.Index('ix_comment_paper_id_sync_txid', 'paper_id', 'sync_txid', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     highlighted_text = db.Column(db.String, nullable=True)
     is_general = db.Column(db.Boolean, nullable=True)
@@ -186,6 +193,25 @@ class Comment(db.Model):
     collection_id = db.Column(db.ForeignKey('collection.id'), nullable=True)
     collection = db.relationship("Collection")
     replies = db.relationship("Reply", lazy='joined')
+    last_update_date = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now(),
+                                 onupdate=db.func.now())
+    # The transaction that last changed the comment, the comments are synced in the order of these ids
+    # (see CommentsResource), since unlike the dates they can be compared with the transactions in progress
+    sync_txid = db.Column(db.BigInteger, nullable=False, server_default=db.func.txid_current(),
+                          onupdate=db.func.txid_current())
+
+
+class CommentTombstone(db.Model):
+    """
+    Deleted comments and comments whose visibility was narrowed, so clients that sync the comments of a paper remove
+    them as well
+    """
+    __tablename__ = 'comment_tombstone'
+    __table_args__ = (db.Index('ix_comment_tombstone_paper_id_sync_txid', 'paper_id', 'sync_txid'),)
+    comment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    paper_id = db.Column(db.ForeignKey('paper.id', ondelete="CASCADE"), nullable=False)
+    sync_txid = db.Column(db.BigInteger, nullable=False, server_default=db.func.txid_current())
+    deletion_date = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
 
 
 class Reply(db.Model):
@@ -232,6 +258,57 @@ class Tweet(db.Model):
     user_followers_count = db.Column(db.Integer)
     user_following_count = db.Column(db.Integer)
     text = db.Column(db.String)
+    score = db.Column(db.Integer, nullable=True)  # The decayed score this tweet currently adds to its paper
+
+
+class ScraperState(db.Model):
+    __tablename__ = 'scraper_state'
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.JSON, nullable=True)
+    last_update_date = db.Column(db.DateTime(timezone=True), nullable=False, default=datetime.now, onupdate=datetime.now)
+
+
+class JobStatus(db.Model):
+    __tablename__ = 'job_status'
+    name = db.Column(db.String(100), primary_key=True)
+    last_start_date = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_end_date = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_duration = db.Column(db.Float, nullable=True)  # in seconds
+    last_result = db.Column(db.String(20), nullable=True)  # success, failed or timeout
+    last_error = db.Column(db.String, nullable=True)
+    items_processed = db.Column(db.Integer, nullable=True)
+
+
+class EmailState(enum.Enum):
+    pending = 0
+    sent = 1
+    failed = 2
+
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    __table_args__ = (db.Index('ix_email_outbox_state_next_attempt_date', 'state', 'next_attempt_date'),)
+    id = db.Column(db.Integer, primary_key=True)
+    template = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    recipients = db.Column(db.JSON, nullable=False)  # [{address, name, variables}], a single Mailgun batch
+    state = db.Column(db.Enum(EmailState), nullable=False, default=EmailState.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_date = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    last_error = db.Column(db.String, nullable=True)
+    creation_date = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    sent_date = db.Column(db.DateTime(timezone=True), nullable=True)
+
+
+class NotificationEvent(db.Model):
+    # A comment or reply waiting to be sent in a digest
+    __tablename__ = 'notification_event'
+    id = db.Column(db.Integer, primary_key=True)
+    paper_id = db.Column(db.ForeignKey('paper.id', ondelete="CASCADE"), nullable=False, index=True)
+    comment_id = db.Column(db.ForeignKey('comment.id', ondelete="CASCADE"), nullable=False)
+    reply_id = db.Column(db.ForeignKey('reply.id', ondelete="CASCADE"), nullable=True)
+    user_id = db.Column(db.ForeignKey('user.id', ondelete="CASCADE"), nullable=True)  # The user who posted
+    creation_date = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
 
 
 def init_db(flask_app: Flask):
@@ -0,0 +1,90 @@
+"""
+Number of viewers per paper room, kept in Redis so it is shared by all the servers and needs no DB queries.
+Every connection in a room is a member of a sorted set scored by its last heartbeat. Connections that stop sending
+heartbeats (e.g. a server that died without disconnecting its clients) drop out after PRESENCE_TTL_SECONDS.
+Changes are pushed to the room as a 'viewers' event, at most once per PUSH_INTERVAL_SECONDS for all the servers.
+"""
+import logging
+import time
+
+from flask import current_app
+from flask_socketio import SocketIO
+from redis import RedisError
+
+from .redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL_SECONDS = 30  # Expected from the clients
+PRESENCE_TTL_SECONDS = 3 * HEARTBEAT_INTERVAL_SECONDS
+PUSH_INTERVAL_SECONDS = 2
+
+
+def _get_key(room: str) -> str:
+    return f'presence:{room}'
+
+
+def _touch(room: str, sid: str):
+    client = get_redis()
+    if not client:
+        return
+    key = _get_key(room)
+    now = time.time()
+    pipe = client.pipeline(transaction=False)
+    pipe.zadd(key, {sid: now})
+    pipe.zremrangebyscore(key, '-inf', now - PRESENCE_TTL_SECONDS)
+    # An abandoned room is removed once all its members expire
+    pipe.expire(key, PRESENCE_TTL_SECONDS)
+    pipe.execute()
+
+
+def get_viewer_count(room: str) -> int:
+    client = get_redis()
+    if not client:
+        return 0
+    return client.zcount(_get_key(room), time.time() - PRESENCE_TTL_SECONDS, '+inf')
+
+
+def _push_viewer_count(socketio_app: SocketIO, room: str):
+    socketio_app.sleep(PUSH_INTERVAL_SECONDS)
+    # Read at the end of the window, so it includes the changes of the servers that skipped their push
+    try:
+        count = get_viewer_count(room)
+        socketio_app.emit('viewers', {'paperId': room, 'count': count}, to=room, namespace='/')
+    except Exception as e:
+        logger.error(f'Failed to push the viewers of room {room} - {e}')
+
+
+def _schedule_push(room: str):
+    client = get_redis()
+    socketio_app: SocketIO = getattr(current_app, 'socketio_app', None)
+    if not client or not socketio_app:
+        return
+    if client.set(f'presence:push:{room}', 1, nx=True, ex=PUSH_INTERVAL_SECONDS):
+        socketio_app.start_background_task(_push_viewer_count, socketio_app, room)
+
+
+def join(room: str, sid: str):
+    try:
+        _touch(room, sid)
+        _schedule_push(room)
+    except RedisError as e:
+        logger.warning(f'Failed to update the presence of room {room} - {e}')
+
+
+def heartbeat(room: str, sid: str):
+    try:
+        _touch(room, sid)
+    except RedisError as e:
+        logger.warning(f'Failed to update the presence of room {room} - {e}')
+
+
+def leave(room: str, sid: str):
+    client = get_redis()
+    if not client:
+        return
+    try:
+        if client.zrem(_get_key(room), sid):
+            _schedule_push(room)
+    except RedisError as e:
+        logger.warning(f'Failed to update the presence of room {room} - {e}')
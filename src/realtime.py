@@ -0,0 +1,92 @@
+"""
+Delivery of comment events to the paper rooms.
+Events are compact deltas (e.g. a new reply is sent without its parent comment), and are buffered per room for
+BATCH_WINDOW_SECONDS, so a burst on a hot paper goes out as a single emit. Repeated events about the same comment
+within the window are collapsed into the last one.
+The emits go through the Redis message queue, and the counters of emits per room are kept in the same Redis.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import redis
+from flask import current_app
+from flask_socketio import SocketIO
+
+from .redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW_SECONDS = 0.1
+METRICS_KEY = 'realtime:metrics'
+ROOM_EMITS_KEY = 'realtime:room_emits'  # A sorted set of the number of emits per room, for spotting hot papers
+
+_pending: Dict[str, 'OrderedDict[Hashable, Dict[str, Any]]'] = {}
+_lock = threading.Lock()
+
+
+def _merge_events(previous: Optional[Dict[str, Any]], event: Dict[str, Any]) -> Dict[str, Any]:
+    # Clients that did not get the new comment yet should still see it as new
+    if previous and previous['type'] == 'new' and event['type'] == 'update':
+        return {**event, 'type': 'new'}
+    return event
+
+
+def publish(room: str, event: Dict[str, Any], key: Optional[Hashable] = None):
+    """Queues an event to the room. Events with the same key in the same window replace each other"""
+    socketio_app: SocketIO = getattr(current_app, 'socketio_app', None)
+    if not socketio_app:
+        return
+    room = str(room)
+    with _lock:
+        events = _pending.get(room)
+        is_first = events is None
+        if is_first:
+            events = _pending[room] = OrderedDict()
+        if key is None:
+            key = object()
+        # Re-inserting moves the event to the end, after the events it depends on
+        events[key] = _merge_events(events.pop(key, None), event)
+    if is_first:
+        socketio_app.start_background_task(_flush_later, socketio_app, room)
+
+
+def _flush_later(socketio_app: SocketIO, room: str):
+    socketio_app.sleep(BATCH_WINDOW_SECONDS)
+    with _lock:
+        events = list(_pending.pop(room, {}).values())
+    if not events:
+        return
+    try:
+        if len(events) == 1:
+            socketio_app.emit('comment', events[0], to=room, namespace='/')
+        else:
+            socketio_app.emit('comments', {'events': events}, to=room, namespace='/')
+    except Exception as e:
+        logger.error(f'Failed to emit to room {room} - {e}')
+        return
+    record_emit(room, len(events))
+
+
+def record_emit(room: str, num_events: int):
+    client = get_redis()
+    if not client:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hincrby(METRICS_KEY, 'emits', 1)
+        pipe.hincrby(METRICS_KEY, 'events', num_events)
+        pipe.zincrby(ROOM_EMITS_KEY, 1, room)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f'Failed to record realtime metrics - {e}')
+
+
+def get_metrics(top_rooms=10) -> Dict[str, Any]:
+    client = get_redis()
+    if not client:
+        return {}
+    counters = {k.decode(): int(v) for k, v in client.hgetall(METRICS_KEY).items()}
+    rooms = client.zrevrange(ROOM_EMITS_KEY, 0, top_rooms - 1, withscores=True)
+    return {**counters, 'rooms': {room.decode(): int(score) for room, score in rooms}}
@@ -0,0 +1,15 @@
+import os
+from typing import Optional
+
+import redis
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """A shared client of the Redis that backs the Socket.IO message queue, None if REDIS_URL is not set"""
+    global _client
+    redis_url = os.environ.get('REDIS_URL')
+    if _client is None and redis_url:
+        _client = redis.Redis.from_url(redis_url, socket_timeout=1)
+    return _client
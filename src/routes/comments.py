@@ -1,15 +1,18 @@
+import base64
+import json
 import logging
 from datetime import datetime
-from typing import Optional
+from typing import List, NamedTuple, Optional, Tuple
 
 from flask import Blueprint
 from flask_jwt_extended import get_jwt_identity, jwt_optional, jwt_required
-from flask_restful import (Api, Resource, abort, fields, inputs, marshal,
-                           marshal_with, reqparse)
-from flask_socketio import emit
-from sqlalchemy import or_
+from flask_restful import Api, Resource, abort, fields, inputs, reqparse
+from sqlalchemy import func, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert
 
-from ..models import Collection, Comment, Paper, Reply, db
+from .. import realtime
+from ..models import Collection, Comment, CommentTombstone, Paper, Reply, User, db
+from .marshal_utils import compile_fields, output_json
 from .notifications.index import new_comment_notification, new_reply_notification
 from .paper_query_utils import PUBLIC_TYPES
 from .permissions_utils import enforce_permissions_to_paper
@@ -18,9 +21,11 @@ from .utils import start_background_task
 
 app = Blueprint('comments', __name__)
 api = Api(app)
+api.representation('application/json')(output_json)
 logger = logging.getLogger(__name__)
 
 EMPTY_FIELD_MSG = 'This field cannot be blank'
+MAX_COMMENTS_PER_PAGE = 500
 
 
 def anonymize_user(comment: Comment, field: str):
@@ -61,12 +66,41 @@ comment_fields = {
     'last_name': fields.String(attribute=lambda x: anonymize_user(x, 'last_name')),
     'canEdit': fields.Boolean(attribute=lambda x: can_edit(x)),
     'createdAt': fields.DateTime(dt_format='rfc822', attribute='creation_date'),
+    'updatedAt': fields.DateTime(dt_format='iso8601', attribute='last_update_date'),
     'replies': fields.List(fields.Nested(replies_fields)),
     'visibility': visibility_fields,
     'isGeneral': fields.Boolean(attribute='is_general'),
 }
 
 
+VIEWER_FIELDS = ('username', 'first_name', 'last_name', 'canEdit')
+_serialize_comment_fields = compile_fields({k: v for k, v in comment_fields.items() if k not in VIEWER_FIELDS})
+serialize_reply = compile_fields(replies_fields)
+
+
+def serialize_comments(comments: List[Comment]) -> List[dict]:
+    """Same output as marshal(comments, comment_fields), but the viewer is resolved once rather than per comment"""
+    current_user = get_jwt_email()
+    results = []
+    for comment in comments:
+        result = _serialize_comment_fields(comment)
+        author = comment.user
+        for field in ('username', 'first_name', 'last_name'):
+            value = '' if comment.shared_with == 'anonymous' or not author else getattr(author, field)
+            if value is not None:
+                result[field] = str(value)
+        if not current_user:
+            result['canEdit'] = False
+        elif author:
+            result['canEdit'] = author.email == current_user
+        results.append(result)
+    return results
+
+
+def serialize_comment(comment: Comment) -> dict:
+    return serialize_comments([comment])[0]
+
+
 def visibilityObj(obj):
     choices = ('public', 'private', 'anonymous', 'group')
     vis_type = obj.get('type')
@@ -77,32 +111,147 @@ def visibilityObj(obj):
     return obj
 
 
+class SyncCursor(NamedTuple):
+    """
+    The position of a client in the changes of the comments of a paper.
+    Changes are ordered by the id of their transaction, and `watermark` is the oldest transaction that was still in
+    progress when the client last synced. The next sync returns every change from it on, so transactions that
+    committed late are not missed (the client may receive a few changes twice).
+    `after` is the last change returned when there are more pages, and `is_sync` tells if the pages are a sync
+    """
+    watermark: int
+    after: Optional[Tuple[int, int]] = None
+    is_sync: bool = False
+
+
+def encode_cursor(cursor: SyncCursor) -> str:
+    return base64.urlsafe_b64encode(json.dumps(cursor._asdict()).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> SyncCursor:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        after = tuple(int(v) for v in data['after']) if data.get('after') else None
+        return SyncCursor(watermark=int(data['watermark']), after=after, is_sync=bool(data.get('is_sync')))
+    except (ValueError, TypeError, KeyError):
+        abort(400, message='Invalid cursor')
+
+
+def add_tombstone(comment_id: int, paper_id: int):
+    """Clients that sync the comments of the paper remove the comment, unless they can still see it"""
+    stmt = insert(CommentTombstone.__table__).values(comment_id=comment_id, paper_id=paper_id)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['comment_id'], set_={'sync_txid': func.txid_current(), 'deletion_date': func.now()}))
+
+
+def is_visibility_narrowed(comment: Comment, shared_with: str, collection_id: Optional[int]) -> bool:
+    if comment.shared_with in PUBLIC_TYPES:
+        return shared_with not in PUBLIC_TYPES
+    # The group id may be sent as a string
+    return shared_with != comment.shared_with or str(collection_id) != str(comment.collection_id)
+
+
+def get_visibility_filter(group_id: Optional[str], user: Optional[User]):
+    # TODO: simplify this:
+    if group_id:
+        return Comment.collection_id == group_id
+    if user:
+        return or_(Comment.shared_with.in_(PUBLIC_TYPES), Comment.user_id == user.id)
+    return Comment.shared_with.in_(PUBLIC_TYPES)
+
+
 class CommentsResource(Resource):
     method_decorators = [jwt_optional]
 
-    @marshal_with(comment_fields, envelope='comments')
     def get(self, paper_id):
+        """
+        Without arguments, returns all the comments the user can see.
+        Clients sync the changes since their last request by passing the returned `cursor`, which also returns the ids
+        of the comments that were deleted or are no longer visible to them. They can limit the comments to a range of
+        pages and paginate with `limit`, following the cursor while `hasMore` is set.
+        `since` filters on the update date, it is kept for older clients and may miss changes that committed late
+        """
         parser = reqparse.RequestParser()
         parser.add_argument('group', required=False, location='args')
-        group_id = parser.parse_args().get('group')
+        parser.add_argument('since', type=inputs.datetime_from_iso8601, required=False, location='args')
+        parser.add_argument('cursor', type=str, required=False, location='args')
+        parser.add_argument('page_from', type=inputs.positive, required=False, location='args')
+        parser.add_argument('page_to', type=inputs.positive, required=False, location='args')
+        parser.add_argument('limit', type=inputs.int_range(1, MAX_COMMENTS_PER_PAGE), required=False, location='args')
+        args = parser.parse_args()
+        group_id = args.get('group')
         user = get_user_optional()
         paper = Paper.query.get_or_404(paper_id)
         enforce_permissions_to_paper(paper, user)
-        query = Comment.query.filter(Comment.paper_id == paper_id)
-        # TODO: simplify this:
-        if group_id:
-            query = query.filter(Comment.collection_id == group_id)
+        cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+        is_sync = bool(cursor) and (cursor.is_sync or not cursor.after)
+
+        # Taken before reading the comments, any transaction older than it is visible to the reads below
+        watermark = db.session.query(func.txid_snapshot_xmin(func.txid_current_snapshot())).scalar()
+        if cursor and cursor.after:
+            # Later pages keep the watermark of the first one, the next sync re-scans whatever was in progress then
+            watermark = cursor.watermark
+
+        # Comments the user can't see are never returned, not even their ids. The ones the user could see before
+        # are removed through their tombstones
+        visibility_filter = get_visibility_filter(group_id, user)
+        query = Comment.query.filter(Comment.paper_id == paper_id, visibility_filter)
+        if args.get('since'):
+            query = query.filter(Comment.last_update_date > args['since'])
+        if cursor and cursor.after:
+            query = query.filter(tuple_(Comment.sync_txid, Comment.id) > cursor.after)
+        elif cursor:
+            query = query.filter(Comment.sync_txid >= cursor.watermark)
+        # General comments have no page, they are only returned when no page range is requested
+        page_number = Comment.position['pageNumber'].as_integer()
+        if args.get('page_from'):
+            query = query.filter(page_number >= args['page_from'])
+        if args.get('page_to'):
+            query = query.filter(page_number <= args['page_to'])
+
+        query = query.order_by(Comment.sync_txid.asc(), Comment.id.asc())
+        limit = args.get('limit')
+        if limit:
+            # Replies are joined, so we limit the comment ids rather than the joined rows
+            comment_ids = query.with_entities(Comment.id).limit(limit + 1).all()
+            has_more = len(comment_ids) > limit
+            comments = query.filter(Comment.id.in_([c.id for c in comment_ids[:limit]])).all()
         else:
-            if user:
-                query = query.filter(or_(Comment.shared_with.in_(PUBLIC_TYPES), Comment.user_id == user.id))
-            else:
-                query = query.filter(Comment.shared_with.in_(PUBLIC_TYPES))
-        return query.all()
+            has_more = False
+            comments = query.all()
+
+        last_change = (comments[-1].sync_txid, comments[-1].id) if comments else None
+        deleted_ids = []
+        if is_sync and not cursor.after:
+            deleted_ids = [t.comment_id for t in db.session.query(CommentTombstone.comment_id).filter(
+                CommentTombstone.paper_id == paper_id, CommentTombstone.sync_txid >= cursor.watermark)]
+            # Comments whose visibility was narrowed have tombstones as well, users that still see them keep them
+            if deleted_ids:
+                visible_ids = {c.id for c in db.session.query(Comment.id).filter(
+                    visibility_filter, Comment.id.in_(deleted_ids))}
+                deleted_ids = [i for i in deleted_ids if i not in visible_ids]
+
+        if has_more:
+            next_cursor = SyncCursor(watermark=watermark, after=last_change, is_sync=is_sync)
+        else:
+            next_cursor = SyncCursor(watermark=watermark)
+        return {'comments': serialize_comments(comments), 'deleted': [str(i) for i in deleted_ids],
+                'cursor': encode_cursor(next_cursor), 'hasMore': has_more}
 
 
 def emit_update_to_paper_subscribers(paper_id: str, type: str, comment: Comment):
     try:
-        emit('comment', {'type': type, 'data': marshal(comment, comment_fields)}, to=str(paper_id), namespace="/")
+        realtime.publish(paper_id, {'type': type, 'data': serialize_comment(comment)}, key=('comment', comment.id))
+    except Exception as e:
+        logger.error(e)
+
+
+def emit_reply_to_paper_subscribers(comment: Comment, reply: Reply):
+    # Only the reply is sent, the clients already have the rest of the comment
+    try:
+        realtime.publish(comment.paper_id, {'type': 'reply', 'commentId': comment.id,
+                                            'updatedAt': comment_fields['updatedAt'].format(comment.last_update_date),
+                                            'data': serialize_reply(reply)}, key=('reply', reply.id))
     except Exception as e:
         logger.error(e)
 
@@ -117,7 +266,6 @@ class NewCommentResource(Resource):
         except Exception as e:
             logger.error(f'Failed to notify on a new comment - {e}')
 
-    @marshal_with(comment_fields, envelope='comment')
     def post(self, paper_id):
         new_comment_parser = reqparse.RequestParser()
         new_comment_parser.add_argument('text', help=EMPTY_FIELD_MSG, type=str, location='json')
@@ -158,7 +306,7 @@ class NewCommentResource(Resource):
         db.session.commit()
         self.notify_if_needed(user_id, paper, comment)
         emit_update_to_paper_subscribers(paper_id, 'new', comment)
-        return comment
+        return {'comment': serialize_comment(comment)}
 
 
 class CommentResource(Resource):
@@ -172,7 +320,6 @@ class CommentResource(Resource):
             abort(403, message='unauthorized to delete comment')
         return comment
 
-    @marshal_with(comment_fields, envelope='comment')
     def patch(self, comment_id):
         comment = self._get_comment(comment_id)
         edit_comment_parser = reqparse.RequestParser()
@@ -180,20 +327,25 @@ class CommentResource(Resource):
         edit_comment_parser.add_argument('visibility', help=EMPTY_FIELD_MSG, type=visibilityObj, location='json',
                                          required=True)
         data = edit_comment_parser.parse_args()
+        shared_with = data['visibility']['type']
+        collection_id = data['visibility']['id'] if shared_with == 'group' else None
+        if is_visibility_narrowed(comment, shared_with, collection_id):
+            add_tombstone(comment.id, comment.paper_id)
         comment.text = data['text']
-        comment.shared_with = data['visibility']['type']
-        comment.collection_id = data['visibility']['id'] if data['visibility']['type'] == 'group' else None
+        comment.shared_with = shared_with
+        comment.collection_id = collection_id
         db.session.commit()
         emit_update_to_paper_subscribers(comment.paper_id, 'update', comment)
-        return comment
+        return {'comment': serialize_comment(comment)}
 
     def delete(self, comment_id):
         comment = self._get_comment(comment_id)
-        paper_id = str(comment.paper_id)
+        paper_id, comment_id = comment.paper_id, comment.id
         db.session.delete(comment)
+        add_tombstone(comment_id, paper_id)
         db.session.commit()
         try:
-            emit('comment', {'type': 'delete', 'id': comment_id}, to=paper_id, namespace='/')
+            realtime.publish(paper_id, {'type': 'delete', 'id': comment_id}, key=('comment', comment_id))
         except Exception as e:
             logger.error(e)
         return {'message': 'success'}
@@ -202,7 +354,6 @@ class CommentResource(Resource):
 class ReplyResource(Resource):
     method_decorators = [jwt_required]
 
-    @marshal_with(comment_fields, envelope='comment')
     def post(self, comment_id):
         comment: Comment = Comment.query.get_or_404(comment_id)
         new_reply_parser = reqparse.RequestParser()
@@ -215,15 +366,17 @@ class ReplyResource(Resource):
 
         reply = Reply(parent_id=comment.id, text=data['text'], user_id=user.id if user else None)
         db.session.add(reply)
+        # Clients sync comments by their update date, a new reply changes the comment
+        comment.last_update_date = db.func.now()
         db.session.commit()
         db.session.refresh(comment)
-        emit_update_to_paper_subscribers(comment.paper_id, 'update', comment)
+        emit_reply_to_paper_subscribers(comment, reply)
         try:
             start_background_task(target=new_reply_notification, user_id=user.id,
                                   paper_id=comment.paper_id, reply_id=reply.id)
         except Exception as e:
             logger.error(f'Failed to notify on a new comment - {e}')
-        return comment
+        return {'comment': serialize_comment(comment)}
 
 
 api.add_resource(ReplyResource, "/comment/<comment_id>/reply")
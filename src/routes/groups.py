@@ -9,6 +9,8 @@ from flask_restful import (Api, Resource, abort, fields, inputs, marshal_with,
 from sqlalchemy import func
 
 from ..models import Collection, Paper, User, db, paper_collection_table
+from .membership_utils import (get_paper_user_collection_ids, get_user_collection_ids, invalidate_collection_papers,
+                               invalidate_user_collections)
 from .user_utils import get_jwt_email, get_user_by_email
 from .utils import start_background_task
 
@@ -36,7 +38,7 @@ detailed_group_fields = {
 
 
 def get_user_groups(user: User) -> List[Collection]:
-    return Collection.query.filter(Collection.users.any(email=user.email)).all()
+    return Collection.query.filter(Collection.id.in_(list(get_user_collection_ids(user.id)))).all()
 
 
 class GroupsDetailed(Resource):
@@ -73,6 +75,7 @@ class Groups(Resource):
         group = Collection.query.get_or_404(data.get('id'))
         group.users.append(user)
         db.session.commit()
+        invalidate_user_collections(user.id)
         return get_user_groups(user)
 
 
@@ -92,12 +95,14 @@ class NewGroup(Resource):
         collection.users.append(user)
         db.session.add(collection)
         db.session.commit()
+        invalidate_user_collections(user.id)
         all_collections = get_user_groups(user)
         paper_id = data.get('paper_id')
         if paper_id:
             paper = Paper.query.get_or_404(paper_id)
             collection.papers.append(paper)
             db.session.commit()
+            invalidate_collection_papers(collection.id)
         response = {'groups': all_collections, 'new_id': collection.id}
         return response
 
@@ -133,6 +138,7 @@ class Group(Resource):
         try:
             group.users.remove(user)
             db.session.commit()
+            invalidate_user_collections(user.id)
         except ValueError:
             pass
         return get_user_groups(user)
@@ -173,11 +179,10 @@ class Group(Resource):
                 pass
 
         db.session.commit()
+        invalidate_collection_papers(group.id)
         start_background_task(target=update_num_stars, paper_id=paper.id)
 
-        paper_groups = Collection.query.filter(Collection.papers.any(
-            id=paper.id), Collection.users.any(id=user.id)).all()
-        return paper_groups
+        return Collection.query.filter(Collection.id.in_(get_paper_user_collection_ids(user.id, paper.id))).all()
 
 
 api.add_resource(Groups, '/all')
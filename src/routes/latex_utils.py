@@ -1,18 +1,35 @@
-from typing import List
-import requests
-import tarfile
+import functools
+import gzip
+import hashlib
+import logging
 import os
 import re
-import logging
-import pypandoc
+import tarfile
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from TexSoup import TexSoup
+import pypandoc
+import requests
+from diskcache import Cache
 
 logger = logging.getLogger(__name__)
-TMP_DIR = 'tmp'
 REFERENCES_VERSION = 2.23
 BIB_ITEM_MARKER = '!!!CITE!!!'
 
+SOURCES_CACHE_DIRECTORY = os.environ.get('LATEX_SOURCES_CACHE_DIRECTORY') or '/tmp/scihive-latex-sources'
+SOURCES_CACHE_SIZE_LIMIT = 2 * 1024 ** 3
+UNVERSIONED_SOURCE_EXPIRE = 24 * 60 * 60  # The latest version of a paper may change
+MAX_SOURCE_SIZE = 100 * 1024 ** 2
+MAX_SOURCE_IN_MEMORY_SIZE = 5 * 1024 ** 2
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RENDERED_BIB_CACHE_SIZE_LIMIT = 256 * 1024 ** 2
+
+sources_cache = Cache(SOURCES_CACHE_DIRECTORY, size_limit=SOURCES_CACHE_SIZE_LIMIT,
+                      eviction_policy='least-recently-used')
+rendered_bib_cache = Cache(os.path.join(SOURCES_CACHE_DIRECTORY, 'rendered-bib'), size_limit=RENDERED_BIB_CACHE_SIZE_LIMIT,
+                           eviction_policy='least-recently-used')
+
 
 def get_extension_from_headers(h):
     c_type = h.get('content-type')
@@ -32,100 +49,177 @@ def get_extension_from_headers(h):
     return None
 
 
-# Extract content of tex files from a compressed tar.gz file
-def extract_files(file, types):
+# Extract content of tex files from an arxiv source file (a compressed tar or a single compressed tex file)
+def extract_files(source: IO[bytes], extension: str, types: List[str]) -> List[str]:
     files = []
-    tar = tarfile.open(f'{TMP_DIR}/{file}', "r:gz")
-
-    # Find the tex file
-    for member in tar.getmembers():
-        if any([member.name.lower().endswith(t) for t in types]):
+    if extension == '.tex.gz':
+        if 'tex' in types:
             try:
-                files.append(tar.extractfile(member).read().decode('utf-8'))
-            except Exception as e:
-                logger.warning(f'Failed to extract reference file - {file} - {member.name}')
+                files.append(gzip.GzipFile(fileobj=source).read().decode('utf-8'))
+            except (OSError, EOFError, UnicodeDecodeError) as e:
+                # gzip.BadGzipFile is an OSError, truncated files raise EOFError
+                logger.warning(f'Failed to extract tex file - {e}')
+        return files
+
+    if extension != '.tar.gz':
+        raise tarfile.ReadError(f'Unsupported source type - {extension}')
+
+    # Stream mode reads the archive sequentially, without seeking back to the members index
+    with tarfile.open(fileobj=source, mode='r|gz') as tar:
+        for member in tar:
+            if member.isfile() and any([member.name.lower().endswith(t) for t in types]):
+                try:
+                    files.append(tar.extractfile(member).read().decode('utf-8'))
+                except Exception as e:
+                    logger.warning(f'Failed to extract reference file - {member.name}')
 
     return files
 
 
-def arxiv_id_to_source_url(arxiv_id):
+def arxiv_id_to_source_url(arxiv_id, version: Optional[int] = None):
     # https://arxiv.org/help/mimetypes has more info
-    return 'https://arxiv.org/e-print/' + arxiv_id.replace('_', '/')
+    source_url = 'https://arxiv.org/e-print/' + arxiv_id.replace('_', '/')
+    if version:
+        source_url += f'v{version}'
+    return source_url
 
 
-# Downloads arxiv latex source code
-def download_source_file(arxiv_id):
-    source_url = arxiv_id_to_source_url(arxiv_id)
+def _fetch_source_file(source_url: str) -> Tuple[str, IO[bytes]]:
     headers = {
         'User-Agent': 'SciHive',
     }
-    res = requests.get(source_url, headers=headers)
-    res.raise_for_status()
-    extension = get_extension_from_headers(res.headers)
-    if not extension:
-        raise Exception(f"Could not determine file extension of {arxiv_id}")
-    file = res.content
-    name = arxiv_id + extension
-    if not os.path.exists(TMP_DIR):
-        os.makedirs(TMP_DIR)
-
-    with open(f'{TMP_DIR}/{name}', 'wb') as f:
-        f.write(file)
-    return name
+    with requests.get(source_url, headers=headers, stream=True) as res:
+        res.raise_for_status()
+        extension = get_extension_from_headers(res.headers)
+        if not extension:
+            raise Exception(f"Could not determine file extension of {source_url}")
+
+        content = SpooledTemporaryFile(max_size=MAX_SOURCE_IN_MEMORY_SIZE)
+        size = 0
+        for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_SOURCE_SIZE:
+                content.close()
+                raise Exception(f'Source file is too large - {source_url}')
+            content.write(chunk)
+
+    content.seek(0)
+    return extension, content
+
+
+# Downloads arxiv latex source code. Returns the file extension and a file object with the (compressed) content
+def download_source_file(arxiv_id, version: Optional[int] = None) -> Tuple[str, IO[bytes]]:
+    cache_key = f'{arxiv_id}v{version}' if version else arxiv_id
+    cached_content, extension = sources_cache.get(cache_key, read=True, tag=True)
+    if cached_content is not None:
+        return extension, cached_content
+
+    extension, content = _fetch_source_file(arxiv_id_to_source_url(arxiv_id, version))
+    expire = None if version else UNVERSIONED_SOURCE_EXPIRE
+    sources_cache.set(cache_key, content, read=True, tag=extension, expire=expire)
+    content.seek(0)
+    return extension, content
+
+
+class TexScan(NamedTuple):
+    sections: List[Tuple[str, str]]
+    equations: List[str]
+    bibitems: List[Tuple[int, int]]  # (start, end) positions of each bibitem opening
+
+
+# All the alternatives start with a backslash, which lets the regex engine skip quickly to the candidates.
+# Equations are matched with a lookahead, so the scan goes on inside them like the separate regexes did
+TEX_TOKENS_REGEX = re.compile(r'\\(?:(?P<section>section|subsection|subsubsection)\{'
+                              r'|begin\{equation\}(?=(?P<equation>.*?)\\end\{equation\})'
+                              r'|(?P<bibitem>bibitem)\s*[\[\{])', re.S)
+# Commands and math are nodes in TexSoup, while escaped characters (e.g. \&) are part of the text
+SECTION_NAME_TOKENS_REGEX = re.compile(r'(?P<node>\\[a-zA-Z@]+\*?|\$\$.*?\$\$|\$.*?\$)|[{}]|\\.|[^\\${}]+', re.S)
+END_EQUATION = '\\end{equation}'
+BRACKETS_REGEXES = {(left, right): re.compile(f'[{re.escape(left)}{re.escape(right)}]') for left, right in ['{}', '[]']}
 
 
 def find_right_closing_bracket(tex, start_pos, left_char, right_char):
-    # find the right closing brackets
+    """Returns the position of the bracket closing the one at start_pos, or -1 if it is never closed"""
     level = 0
-    end_pos = start_pos + 1
-    while True:
-        if tex[end_pos] == right_char:
+    for match in BRACKETS_REGEXES[(left_char, right_char)].finditer(tex, start_pos + 1):
+        if match.group() == right_char:
             if level == 0:
-                break
+                return match.start()
             level -= 1
-        elif tex[end_pos] == left_char:
+        else:
             level += 1
-        end_pos += 1
-    return end_pos
-
+    return -1
 
-def extract_text(section, tex):
-    base_groups = section.groups()
-    if '{' not in base_groups[1]:
-        return base_groups
 
-    start_pos = section.start()
-    # find the beginning of the section element
-    while tex[start_pos] != '{':
-        start_pos += 1
+def extract_section_name(content: str) -> str:
+    # Keep only the top level text, similar to the string contents TexSoup returns for the section node
+    name = ''
+    level = 0
+    for match in SECTION_NAME_TOKENS_REGEX.finditer(content):
+        token = match.group()
+        if token == '{':
+            level += 1
+        elif token == '}':
+            level -= 1
+        elif level == 0 and not match.group('node'):
+            name += token
+    return name
 
-    # find the right closing brackets
-    end_pos = find_right_closing_bracket(tex=tex, start_pos=start_pos, left_char='{', right_char='}')
 
-    # TODO improve this part
-    soup = TexSoup(tex[section.start():end_pos+1])
-    section_contents = list(list(soup.tokens)[0].contents)
-    name = ''
-    for c in section_contents:
-        if isinstance(c, str):
-            name += c
-    return base_groups[0], name
+def scan_section(tex: str, section_type: str, open_pos: int) -> Optional[Tuple[str, str]]:
+    close_pos = tex.find('}', open_pos)
+    name = tex[open_pos + 1:close_pos]
+    if close_pos == -1 or '\n' in name:
+        # Section names are expected to end on the same line
+        return None
+    if '{' not in name:
+        return section_type, name
+
+    close_pos = find_right_closing_bracket(tex=tex, start_pos=open_pos, left_char='{', right_char='}')
+    if close_pos == -1:
+        # The nested braces are never closed, keep the name up to the first closing brace
+        return section_type, name
+    return section_type, extract_section_name(tex[open_pos + 1:close_pos])
+
+
+def scan_tex(tex: str) -> TexScan:
+    """Finds the sections, equations and bibitems of a tex file in a single pass"""
+    sections = []
+    equations = []
+    bibitems = []
+    # Like the separate regexes, a section or an equation does not start inside the previous one
+    section_end = equation_end = 0
+    for match in TEX_TOKENS_REGEX.finditer(tex):
+        if match.group('section'):
+            if match.start() < section_end:
+                continue
+            section = scan_section(tex, match.group('section'), match.end() - 1)
+            if section:
+                sections.append(section)
+                section_end = tex.find('}', match.end()) + 1
+        elif match.group('equation') is not None:
+            if match.start() < equation_end:
+                continue
+            equations.append(match.group('equation'))
+            equation_end = match.end('equation') + len(END_EQUATION)
+        elif match.start() > 0 and tex[match.start() - 1] == '\n':
+            # Include the preceding new line, bibitems are expected to start a line
+            bibitems.append((match.start() - 1, match.end()))
+    return TexScan(sections=sections, equations=equations, bibitems=bibitems)
 
 
 # Gets the sections of a tex file
-def get_sections(tex_files):
+def get_sections(tex_files, scan: Callable[[str], TexScan] = scan_tex):
     for tex in tex_files:
-        sections = list(re.finditer(r'\\(section|subsection|subsubsection){(.*?)}', tex))
+        sections = scan(tex).sections
         if sections:
-            res = [extract_text(section, tex) for section in sections]
-            return res
+            return sections
     return []
 
 
 # Gets the sections of a tex file
 def get_equations(tex):
-    equations = re.findall(r'\\begin\{equation\}(.*?)\\end\{equation\}', tex, re.S)
-    return equations
+    return scan_tex(tex).equations
 
 
 def get_cite_name(item):
@@ -133,14 +227,15 @@ def get_cite_name(item):
     if re.match(r'\n\\bibitem\s*\[', item):
         start_pos = item.find('[')
         end_pos = find_right_closing_bracket(item, start_pos, '[', ']')
-        item = item[:start_pos] + item[end_pos+1:]
+        if end_pos != -1:
+            item = item[:start_pos] + item[end_pos+1:]
     cite_name = re.search('{(.*?)}', item).group(1)
     return cite_name
 
 def clean_bib_item(content: str):
     return content.replace('%\r\n', '').replace('%\n', '')  # it breaks some of the references
 
-def get_bibliography(tex):
+def get_bibliography(tex, scan: Callable[[str], TexScan] = scan_tex):
     # Focus on the relevant section though it can work without it
     BEGIN_BIB = '\\begin{thebibliography}'
     END_BIB = '\\end{thebibliography}'
@@ -149,32 +244,33 @@ def get_bibliography(tex):
         return None
     bib_end = tex.find(END_BIB)
     bib_content = tex[:bib_end]
-    all_items_matches = list(re.finditer(r'\n\\bibitem\s*[\[\{]', bib_content))
-    if not all_items_matches:
+    all_items_spans = [span for span in scan(tex).bibitems if span[1] <= len(bib_content)]
+    if not all_items_spans:
         return None
 
     all_items_content = []
 
     # split to bibitems:
-    for i in range(len(all_items_matches)):
-        if i == len(all_items_matches) - 1:
+    for i in range(len(all_items_spans)):
+        if i == len(all_items_spans) - 1:
             end_pos = len(bib_content) + 1
         else:
-            end_pos = all_items_matches[i + 1].start()
-        item_content = bib_content[all_items_matches[i].start():end_pos]
+            end_pos = all_items_spans[i + 1][0]
+        item_content = bib_content[all_items_spans[i][0]:end_pos]
         all_items_content.append(clean_bib_item(item_content))
 
-    result = tex[:all_items_matches[0].start()]
+    result_parts = [tex[:all_items_spans[0][0]]]
     cite_names = []
     for item in all_items_content:
         # Add reference ID to ensure that we can extract them references later
         cite_name = get_cite_name(item)
         cite_names.append(cite_name)
-        result += f'\n{{{BIB_ITEM_MARKER}}}\n'
-        result += item
+        result_parts.append(f'\n{{{BIB_ITEM_MARKER}}}\n')
+        result_parts.append(item)
 
-    result += f'\n{{{BIB_ITEM_MARKER}}}\n\n'
-    result += tex[bib_end:]
+    result_parts.append(f'\n{{{BIB_ITEM_MARKER}}}\n\n')
+    result_parts.append(tex[bib_end:])
+    result = ''.join(result_parts)
     result = re.sub(r'\n\\newblock', '\n\n', result)
 
     return result, cite_names, all_items_content
@@ -186,36 +282,100 @@ def find_arxiv_id_in_bib_item(item):
         return arxiv_links.group(0)
     return None
 
+def get_pandoc_version() -> str:
+    try:
+        return pypandoc.get_pandoc_version()
+    except OSError:
+        # Nothing is rendered (or cached) without pandoc
+        return 'missing'
+
+
+def get_bib_item_cache_key(content: str, preamble: str = '') -> str:
+    # The rendered html changes with our extraction, with pandoc itself and with the macros defined before the items
+    content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+    preamble_hash = hashlib.md5(preamble.encode("utf-8")).hexdigest()
+    return f'bib-html-{REFERENCES_VERSION}-{get_pandoc_version()}-{preamble_hash}-{content_hash}'
+
+
+def get_bib_preamble(bib_string: str) -> str:
+    marker_pos = bib_string.find(f'\n{{{BIB_ITEM_MARKER}}}\n')
+    return bib_string[:marker_pos] if marker_pos >= 0 else ''
+
+
+def get_cached_bib_htmls(cites_content: List[str], preamble: str = '') -> List[Optional[str]]:
+    return [rendered_bib_cache.get(get_bib_item_cache_key(content, preamble)) for content in cites_content]
+
+
+def cache_bib_htmls(cites_content: List[str], htmls: List[Optional[str]], preamble: str = ''):
+    for content, html in zip(cites_content, htmls):
+        if html is not None:
+            rendered_bib_cache.set(get_bib_item_cache_key(content, preamble), html)
+
+
+def split_rendered_bib(html: str) -> List[str]:
+    return re.split(f'<p><span>{BIB_ITEM_MARKER}</span></p>', html)[1:-1]
+
+
+def render_bib_items(cites_content: List[str]) -> List[Optional[str]]:
+    """
+    Renders all the bib items with a single pandoc call, using markers to split the result.
+    If pandoc fails, the batch is split in two so a broken item costs a few extra calls instead of one call per item
+    """
+    if not cites_content:
+        return []
+    batch = ''.join([f'\n{{{BIB_ITEM_MARKER}}}\n{content}' for content in cites_content])
+    batch += f'\n{{{BIB_ITEM_MARKER}}}\n\n'
+    try:
+        items = split_rendered_bib(pypandoc.convert_text(batch, to='html5', format='latex'))
+        if len(items) == len(cites_content):
+            return items
+        error = 'markers are missing from the output'
+    except Exception as e:
+        error = e
+
+    if len(cites_content) == 1:
+        logger.warning(f'Failed to render bib item - {error}')
+        return [None]
+    middle = len(cites_content) // 2
+    return render_bib_items(cites_content[:middle]) + render_bib_items(cites_content[middle:])
+
+
 def convert_bib_to_html_fallback(cite_names: List[str], cites_content: List[str]):
     logger.info('Running Fallback bib extraction')
-    final_cite_names = []
-    htmls = []
-    for name, content in zip(cite_names, cites_content):
-        try:
-            html = pypandoc.convert_text(content, to='html5', format='latex')
-            htmls.append(html)
-            final_cite_names.append(name)
-        except Exception as e:
-            logger.warning(f'Failed to render bib item - {e}')
+    htmls = get_cached_bib_htmls(cites_content)
+    missing = [i for i, html in enumerate(htmls) if html is None]
+    rendered = render_bib_items([cites_content[i] for i in missing])
+    for i, html in zip(missing, rendered):
+        htmls[i] = html
+    cache_bib_htmls([cites_content[i] for i in missing], rendered)
+
+    final_cite_names = [name for name, html in zip(cite_names, htmls) if html is not None]
+    final_htmls = [html for html in htmls if html is not None]
+    return final_cite_names, final_htmls
 
-    return final_cite_names, htmls
 
 def convert_bib_to_html(paper_id, bib_string: str, cite_names: List[str], cites_content: List[str]):
     htmls = {}
-    try:
-        html = pypandoc.convert_text(bib_string, to='html5', format='latex')
-        items = re.split(f'<p><span>{BIB_ITEM_MARKER}</span></p>', html)
-        items = items[1:-1]
-        if len(items) != len(cite_names):
-            logger.exception('References ids and content are incompatible for paper - {}'.format(paper_id))
-            return htmls
+    # The fallback renders the items on their own, so only the primary render is cached with the preamble
+    preamble = get_bib_preamble(bib_string)
+    items = get_cached_bib_htmls(cites_content, preamble)
+    if None in items:
+        try:
+            html = pypandoc.convert_text(bib_string, to='html5', format='latex')
+            items = split_rendered_bib(html)
+            if len(items) != len(cite_names):
+                logger.exception('References ids and content are incompatible for paper - {}'.format(paper_id))
+                return htmls
+            cache_bib_htmls(cites_content, items, preamble)
 
-    except Exception as e:
-        logger.warning(f'Failed to render bib item of paper - {paper_id} - {e}')
-        cite_names, items = convert_bib_to_html_fallback(cite_names, cites_content)
-        if not cite_names:
-            logger.exception(f'Failed to render bib item of paper - {paper_id}')
-            return htmls
+        except Exception as e:
+            logger.warning(f'Failed to render bib item of paper - {paper_id} - {e}')
+            cite_names, items = convert_bib_to_html_fallback(cite_names, cites_content)
+            if not cite_names:
+                logger.exception(f'Failed to render bib item of paper - {paper_id}')
+                return htmls
+    else:
+        logger.info(f'Using rendered bib items from cache for paper - {paper_id}')
 
     for item, cite_name in zip(items, cite_names):
         htmls[cite_name] = {'html': item, 'arxivId': find_arxiv_id_in_bib_item(item)}
@@ -223,28 +383,56 @@ def convert_bib_to_html(paper_id, bib_string: str, cite_names: List[str], cites_
     return htmls
 
 
+def get_references(arxiv_id, files: List[str], scan: Callable[[str], TexScan] = scan_tex):
+    data = {}
+    for f in files:
+        result = get_bibliography(f, scan)
+        if result:
+            bib_string, cite_names, items = result
+            data = convert_bib_to_html(arxiv_id, bib_string, cite_names, items)
+            break
+    return {'data': data, 'version': REFERENCES_VERSION}
+
+
 # Gets the references of a tex file
 def extract_references_from_latex(arxiv_id):
-    data = {}
+    files = []
     try:
-        file_name = download_source_file(arxiv_id)
-        files = extract_files(file_name, ['tex', 'bbl'])
-        for f in files:
-            result = get_bibliography(f)
-            if result:
-                bib_string, cite_names, items = result
-                data = convert_bib_to_html(arxiv_id, bib_string, cite_names, items)
-                break
+        extension, source = download_source_file(arxiv_id)
+        with source:
+            files = extract_files(source, extension, ['tex', 'bbl'])
     except tarfile.ReadError as e:
         pass
     except requests.HTTPError as e:
         logger.warning(f'Latex file not found for {arxiv_id}')
 
-    return {'data': data, 'version': REFERENCES_VERSION}
+    return get_references(arxiv_id, files)
 
 
 def extract_sections_from_latex(arxiv_id):
-    file_name = download_source_file(arxiv_id)
-    tex_files = extract_files(file_name, ['tex'])
+    extension, source = download_source_file(arxiv_id)
+    with source:
+        tex_files = extract_files(source, extension, ['tex'])
     return get_sections(tex_files)
 
+
+def parse_source_content(arxiv_id, extension: str, content: bytes) -> Tuple[Dict[str, Any], List[Tuple[str, str]]]:
+    """Extracts both the references and the sections from the raw source content. Used by the batch job workers"""
+    try:
+        files = extract_files(BytesIO(content), extension, ['tex', 'bbl'])
+    except tarfile.ReadError:
+        files = []
+    # Both look at the same files, each file is scanned once
+    scan = functools.lru_cache(maxsize=None)(scan_tex)
+    return get_references(arxiv_id, files, scan), get_sections(files, scan)
+
+
+def extract_latex_items(arxiv_id) -> Tuple[Dict[str, Any], List[Tuple[str, str]]]:
+    """Same as parse_source_content, for papers the batch job did not reach yet"""
+    try:
+        extension, source = download_source_file(arxiv_id)
+    except requests.HTTPError:
+        logger.warning(f'Latex file not found for {arxiv_id}')
+        return get_references(arxiv_id, []), []
+    with source:
+        return parse_source_content(arxiv_id, extension, source.read())
@@ -0,0 +1,148 @@
+"""
+A cached index of group membership, used to mark the groups of the current user on papers.
+Redis keeps the collection ids of every user, and the paper ids of every collection with up to
+SMALL_COLLECTION_MAX_PAPERS papers. Larger collections are checked in the DB, only against the papers in question.
+The entries are deleted after every change to the membership (see invalidate_*), and expire after
+MEMBERSHIP_CACHE_SECONDS in case a change was missed.
+"""
+import json
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from redis import RedisError
+from sqlalchemy import func
+
+from ..models import db, paper_collection_table, user_collection_table
+from ..redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_CACHE_SECONDS = 15 * 60
+SMALL_COLLECTION_MAX_PAPERS = 1000
+
+
+class GroupRef(NamedTuple):
+    id: int
+
+
+def _get_user_key(user_id: int) -> str:
+    return f'membership:user:{user_id}'
+
+
+def _get_collection_key(collection_id: int) -> str:
+    return f'membership:collection:{collection_id}'
+
+
+def _cache_get(keys: List[str]) -> List[Optional[bytes]]:
+    client = get_redis()
+    if not client or not keys:
+        return [None] * len(keys)
+    try:
+        return client.mget(keys)
+    except RedisError as e:
+        logger.warning(f'Failed to read the membership cache - {e}')
+        return [None] * len(keys)
+
+
+def _cache_set(values: Dict[str, str]):
+    client = get_redis()
+    if not client or not values:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(key, value, ex=MEMBERSHIP_CACHE_SECONDS)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f'Failed to update the membership cache - {e}')
+
+
+def _cache_delete(keys: List[str]):
+    client = get_redis()
+    if not client or not keys:
+        return
+    try:
+        client.delete(*keys)
+    except RedisError as e:
+        logger.error(f'Failed to invalidate the membership cache - {e}')
+
+
+def get_user_collection_ids(user_id: int) -> Set[int]:
+    key = _get_user_key(user_id)
+    cached = _cache_get([key])[0]
+    if cached is not None:
+        return set(json.loads(cached))
+    collection_ids = {r.collection_id for r in db.session.query(user_collection_table.c.collection_id).filter(
+        user_collection_table.c.user_id == user_id)}
+    _cache_set({key: json.dumps(sorted(collection_ids))})
+    return collection_ids
+
+
+def get_collections_paper_ids(collection_ids: Iterable[int]) -> Dict[int, Optional[Set[int]]]:
+    """Returns the paper ids of every collection, or None for collections that are too large to keep in the cache"""
+    collection_ids = list(collection_ids)
+    keys = [_get_collection_key(c) for c in collection_ids]
+    result: Dict[int, Optional[Set[int]]] = {}
+    missing = []
+    for collection_id, cached in zip(collection_ids, _cache_get(keys)):
+        if cached is None:
+            missing.append(collection_id)
+        else:
+            paper_ids = json.loads(cached)
+            result[collection_id] = set(paper_ids) if paper_ids is not None else None
+    if not missing:
+        return result
+
+    counts = dict(db.session.query(paper_collection_table.c.collection_id, func.count()).filter(
+        paper_collection_table.c.collection_id.in_(missing)).group_by(paper_collection_table.c.collection_id))
+    small = {c for c in missing if counts.get(c, 0) <= SMALL_COLLECTION_MAX_PAPERS}
+    papers_per_collection = defaultdict(set)
+    if small:
+        for collection_id, paper_id in db.session.query(paper_collection_table.c.collection_id,
+                                                        paper_collection_table.c.paper_id).filter(
+                paper_collection_table.c.collection_id.in_(list(small))):
+            papers_per_collection[collection_id].add(paper_id)
+
+    to_cache = {}
+    for collection_id in missing:
+        paper_ids = papers_per_collection[collection_id] if collection_id in small else None
+        result[collection_id] = paper_ids
+        to_cache[_get_collection_key(collection_id)] = json.dumps(sorted(paper_ids) if paper_ids is not None else None)
+    _cache_set(to_cache)
+    return result
+
+
+def get_papers_user_collection_ids(user_id: int, paper_ids: List[int]) -> Dict[int, List[int]]:
+    """Returns the ids of the collections of the user that contain each of the papers"""
+    collection_ids = get_user_collection_ids(user_id)
+    paper_ids_set = set(paper_ids)
+    paper_to_collections = defaultdict(list)
+    large = []
+    for collection_id, collection_paper_ids in sorted(get_collections_paper_ids(collection_ids).items()):
+        if collection_paper_ids is None:
+            large.append(collection_id)
+            continue
+        for paper_id in collection_paper_ids & paper_ids_set:
+            paper_to_collections[paper_id].append(collection_id)
+
+    if large and paper_ids:
+        for collection_id, paper_id in db.session.query(paper_collection_table.c.collection_id,
+                                                        paper_collection_table.c.paper_id).filter(
+                paper_collection_table.c.collection_id.in_(large), paper_collection_table.c.paper_id.in_(paper_ids)):
+            paper_to_collections[paper_id].append(collection_id)
+    return paper_to_collections
+
+
+def get_paper_user_collection_ids(user_id: int, paper_id: int) -> List[int]:
+    return get_papers_user_collection_ids(user_id, [paper_id]).get(paper_id, [])
+
+
+def invalidate_user_collections(user_id: int):
+    """Should be called after committing a change to the groups of the user"""
+    _cache_delete([_get_user_key(user_id)])
+
+
+def invalidate_collection_papers(collection_id: int):
+    """Should be called after committing a change to the papers of the collection"""
+    _cache_delete([_get_collection_key(collection_id)])
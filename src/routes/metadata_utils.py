@@ -10,7 +10,6 @@ from flask_restful import marshal
 import requests
 from diskcache import Cache
 from flask_socketio import emit
-from sqlalchemy.orm.exc import NoResultFound
 
 from ..models import Author, MetadataState, Paper, db
 from .file_utils import FileUploader
@@ -155,26 +154,30 @@ def fetch_data_from_grobid(paper_id: int, file_content: bytes) -> Tuple[bool, Di
                   'doi': doi, 'table_of_contents': table_of_contents, 'references': references, 'version': METADATA_VERSION}
 
 
-def extract_paper_metadata(paper_id: int):
-    paper: Paper = Paper.query.get_or_404(paper_id)
-    paper.metadata_state = MetadataState.fetching  # TODO: move this to redis
-    db.session.commit()
-    file_content = requests.get(paper.local_pdf).content
+def is_metadata_stale(paper: Paper) -> bool:
+    is_metadata_missing = not paper.metadata_state or paper.metadata_state == MetadataState.missing
+    is_metadata_old = paper.metadata_state == MetadataState.ready and (paper.metadata_version or 0) < METADATA_VERSION
+    return is_metadata_missing or is_metadata_old
+
+
+def fetch_paper_metadata(paper_id: int, pdf_link: str) -> Tuple[bool, Dict[str, Any]]:
+    """Downloads the PDF and extracts its metadata via Grobid (or the cache). Does not touch the DB"""
+    file_content = requests.get(pdf_link).content
     file_hash = FileUploader.calc_hash(file_content)
-    # metadata = None
     metadata, _ = cache.get(file_hash, expire_time=True)
     if not metadata or metadata.get('version', 0) < METADATA_VERSION:
         logger.info(f'Fetching data from grobid for paper - {paper_id}')
         success, metadata = fetch_data_from_grobid(paper_id, file_content)
-        if success:
-            logger.info(f'Fetched data from grobid! - {paper_id}')
-            cache.set(file_hash, metadata, expire=24 * 60 * 60)
-        else:
-            emit('paperInfo', {'success': False}, namespace='/', to=str(paper.id))
-            return
+        if not success:
+            return False, metadata
+        logger.info(f'Fetched data from grobid! - {paper_id}')
+        cache.set(file_hash, metadata, expire=24 * 60 * 60)
     else:
         logger.info(f'Using metadata from cache for - {paper_id}')
+    return True, metadata
 
+
+def apply_paper_metadata(paper: Paper, metadata: Dict[str, Any]):
     if paper.is_private:  # These fields already exist for non private papers
         paper.title = metadata.get('title', paper.title)
         paper.abstract = metadata.get('abstract', paper.abstract)
@@ -189,16 +192,34 @@ def extract_paper_metadata(paper_id: int):
 
     # Create authors
     for current_author in metadata['authors']:
-        try:
-            author = Author.query.filter(
-                Author.first_name == current_author.first_name, Author.last_name == current_author.last_name).one()
-        except NoResultFound:
-            author = Author(name=f'{current_author.first_name} {current_author.last_name}',
-                            first_name=current_author.first_name, last_name=current_author.last_name, organization=current_author.org)
+        # Author names are unique, the scrapers may have added the author without the first and last name
+        name = f'{current_author.first_name} {current_author.last_name}'
+        author = Author.query.filter(Author.name == name).first() or Author.query.filter(
+            Author.first_name == current_author.first_name, Author.last_name == current_author.last_name).first()
+        if not author:
+            author = Author(name=name, first_name=current_author.first_name, last_name=current_author.last_name,
+                            organization=current_author.org)
             db.session.add(author)
-        author.papers.append(paper)
+        elif author.first_name is None and author.last_name is None:
+            author.first_name = current_author.first_name
+            author.last_name = current_author.last_name
+            author.organization = author.organization or current_author.org
+        if paper not in author.papers:
+            author.papers.append(paper)
 
     paper.last_update_date = datetime.now()
     paper.metadata_state = MetadataState.ready
+
+
+def extract_paper_metadata(paper_id: int):
+    paper: Paper = Paper.query.get_or_404(paper_id)
+    paper.metadata_state = MetadataState.fetching  # TODO: move this to redis
+    db.session.commit()
+    success, metadata = fetch_paper_metadata(paper.id, paper.local_pdf)
+    if not success:
+        emit('paperInfo', {'success': False}, namespace='/', to=str(paper.id))
+        return
+
+    apply_paper_metadata(paper, metadata)
     db.session.commit()
     emit('paperInfo', {'success': True, 'data': marshal(paper, metadata_fields)}, namespace='/', to=str(paper.id))
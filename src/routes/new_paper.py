@@ -13,6 +13,8 @@ from ..models import Collection, MetadataState, Paper, User, db
 from ..scrapers.arxiv import fetch_entry
 from ..scrapers.utils import parse_arxiv_url
 from .file_utils import get_uploader
+from .membership_utils import invalidate_collection_papers, invalidate_user_collections
+from .permissions_utils import invalidate_paper_access
 from .user_utils import get_user_by_email
 
 app = Blueprint('new_paper', __name__)
@@ -66,6 +68,7 @@ class NewPaper(Resource):
         paper.uploaded_by_id = user.id
         paper.is_private = True
         db.session.commit()
+        invalidate_paper_access(paper)
 
         return paper
 
@@ -96,6 +99,8 @@ class NewPaper(Resource):
 
         uploads_collection.papers.append(paper)
         db.session.commit()
+        invalidate_user_collections(user.id)
+        invalidate_collection_papers(uploads_collection.id)
 
         return {'id': paper.id}
 
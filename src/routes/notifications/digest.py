@@ -0,0 +1,115 @@
+"""
+Digest mode for comment and reply notifications (enabled by NOTIFICATION_DIGEST_MINUTES).
+Events are buffered in notification_event, and once the first event of a paper is older than the window, every
+recipient gets a single email about all the new comments and replies on that paper.
+Recipients follow the same rules as the immediate notifications, but are resolved in bulk for all the flushed papers.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Set, Tuple
+from urllib.parse import urljoin
+
+from sqlalchemy import func
+
+from ...models import Comment, NotificationEvent, Paper, Reply, User, db, unsubscribe_table
+from .dispatcher import Recipient, deliver_pending, enqueue_email
+from .index import (BASE_UNSUBSCRIBE_LINK, DIGEST_WINDOW_MINUTES, FRONTEND_BASE_URL, create_unsubscribe_token,
+                    get_shortened_text)
+
+logger = logging.getLogger(__name__)
+
+
+def get_due_paper_ids(window_minutes: int) -> List[int]:
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=window_minutes)
+    rows = db.session.query(NotificationEvent.paper_id).group_by(NotificationEvent.paper_id).having(
+        func.min(NotificationEvent.creation_date) <= cutoff).all()
+    return [r.paper_id for r in rows]
+
+
+def get_recipients(events: List[NotificationEvent]) -> Dict[Tuple[int, int], List[NotificationEvent]]:
+    """Returns the events each (user id, paper id) should be notified about"""
+    paper_ids = {e.paper_id for e in events}
+    comment_ids = {e.comment_id for e in events if e.reply_id}
+
+    commenters = defaultdict(set)
+    for paper_id, user_id in db.session.query(Comment.paper_id, Comment.user_id).filter(
+            Comment.paper_id.in_(paper_ids), Comment.user_id.isnot(None)).distinct():
+        commenters[paper_id].add(user_id)
+    for paper_id, uploaded_by_id in db.session.query(Paper.id, Paper.uploaded_by_id).filter(
+            Paper.id.in_(paper_ids), Paper.uploaded_by_id.isnot(None)):
+        commenters[paper_id].add(uploaded_by_id)
+
+    repliers = defaultdict(set)
+    if comment_ids:
+        for comment_id, user_id in db.session.query(Reply.parent_id, Reply.user_id).filter(
+                Reply.parent_id.in_(comment_ids), Reply.user_id.isnot(None)).distinct():
+            repliers[comment_id].add(user_id)
+        for comment_id, user_id in db.session.query(Comment.id, Comment.user_id).filter(
+                Comment.id.in_(comment_ids), Comment.user_id.isnot(None)):
+            repliers[comment_id].add(user_id)
+
+    unsubscribed: Set[Tuple[int, int]] = set(db.session.query(unsubscribe_table.c.user_id, unsubscribe_table.c.paper_id).filter(
+        unsubscribe_table.c.paper_id.in_(paper_ids)).all())
+
+    recipients = defaultdict(list)
+    for event in events:
+        users = repliers[event.comment_id] if event.reply_id else commenters[event.paper_id]
+        for user_id in users:
+            if user_id != event.user_id and (user_id, event.paper_id) not in unsubscribed:
+                recipients[(user_id, event.paper_id)].append(event)
+    return recipients
+
+
+def get_digest_variables(user: User, paper: Paper, events: List[NotificationEvent]) -> Dict[str, str]:
+    num_replies = sum(1 for e in events if e.reply_id)
+    num_comments = len(events) - num_replies
+    if len(events) == 1:
+        # A single event reads like the immediate notification
+        if num_replies:
+            text = f"You have got a new reply to your comment on '{paper.title}'"
+        else:
+            text = f"A new comment was posted on a paper you are following - {paper.title}"
+        link = urljoin(FRONTEND_BASE_URL, f'/paper/{paper.id}#highlight-{events[0].comment_id}')
+    else:
+        text = f"There are {num_comments} new comments and {num_replies} new replies on '{paper.title}'"
+        link = urljoin(FRONTEND_BASE_URL, f'/paper/{paper.id}')
+    return {
+        "first_name": user.username,
+        "text": text,
+        "link": link,
+        "mute_link": urljoin(BASE_UNSUBSCRIBE_LINK, create_unsubscribe_token(user.email, paper.id))
+    }
+
+
+def flush_digests(window_minutes: int = DIGEST_WINDOW_MINUTES) -> int:
+    """Queues a digest email per paper whose window is over. Returns the number of digests"""
+    paper_ids = get_due_paper_ids(window_minutes)
+    if not paper_ids:
+        return 0
+    events = NotificationEvent.query.filter(NotificationEvent.paper_id.in_(paper_ids)).order_by(
+        NotificationEvent.id).with_for_update(skip_locked=True).all()
+    recipients = get_recipients(events)
+    users = {u.id: u for u in User.query.filter(User.id.in_({user_id for user_id, _ in recipients}))} if recipients else {}
+    papers = {p.id: p for p in db.session.query(Paper.id, Paper.title).filter(Paper.id.in_(paper_ids))}
+
+    recipients_per_paper: Dict[int, List[Recipient]] = defaultdict(list)
+    for (user_id, paper_id), user_events in recipients.items():
+        user = users[user_id]
+        recipients_per_paper[paper_id].append({'address': user.email, 'name': user.username,
+                                               'variables': get_digest_variables(user, papers[paper_id], user_events)})
+
+    for event in events:
+        db.session.delete(event)
+    # The events are deleted in the same transaction that queues the emails
+    for paper_id, paper_recipients in recipients_per_paper.items():
+        subject = f"New activity on '{get_shortened_text(papers[paper_id].title)}'"
+        enqueue_email(template="new_reply", subject=subject, recipients=paper_recipients, commit=False)
+    db.session.commit()
+    logger.info(f'Flushed {len(events)} notification events into {len(recipients)} digests')
+    return len(recipients)
+
+
+def send_pending_notifications() -> int:
+    flush_digests()
+    return deliver_pending()
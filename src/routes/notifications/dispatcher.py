@@ -0,0 +1,124 @@
+"""
+Emails are written to the email_outbox table and delivered with Mailgun batch sending - a single API call per
+batch of up to MAX_BATCH_SIZE recipients, each getting their own variables (https://documentation.mailgun.com/en/latest/user_manual.html#batch-sending).
+Failed batches are retried with exponential backoff by `flask send-emails` (and the scheduler).
+"""
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, TypedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ...models import EmailOutbox, EmailState, db
+
+logger = logging.getLogger(__name__)
+
+MAILGUN_KEY = os.environ.get('MAILGUN_KEY')
+MAILGUN_URL = 'https://api.mailgun.net/v3/email.scihive.org/messages'
+SENDER = 'Scihive <noreply@scihive.org>'
+MAX_BATCH_SIZE = 1000  # Mailgun's limit of recipients per batch
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 60  # Doubled on every failed attempt
+REQUEST_TIMEOUT = 30
+
+
+class Recipient(TypedDict):
+    address: str
+    name: str
+    variables: Dict[str, str]
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    # Quick retries within a delivery attempt, the outbox handles longer outages. Sending is not idempotent, so we only
+    # retry when Mailgun did not get the request (connection errors) or rejected it without sending (429 and 503)
+    retry = Retry(total=3, connect=3, read=0, status=3, backoff_factor=1, status_forcelist=[429, 503],
+                  method_whitelist=['POST'])
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=retry))
+    session.auth = ('api', MAILGUN_KEY)
+    return session
+
+
+session = _create_session()
+
+
+def enqueue_email(template: str, subject: str, recipients: List[Recipient], commit=True) -> List[int]:
+    """Stores the email in the outbox (one row per batch) and returns the ids of the rows"""
+    if not MAILGUN_KEY:
+        logger.warning('Maingun key is missing. Skipping sending')
+        return []
+    rows = [EmailOutbox(template=template, subject=subject, recipients=recipients[i:i + MAX_BATCH_SIZE])
+            for i in range(0, len(recipients), MAX_BATCH_SIZE)]
+    db.session.add_all(rows)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    return [row.id for row in rows]
+
+
+def send_batch(email: EmailOutbox):
+    recipients: List[Recipient] = email.recipients
+    variable_names = {name for r in recipients for name in r['variables']}
+    response = session.post(MAILGUN_URL, timeout=REQUEST_TIMEOUT, data={
+        'from': SENDER,
+        'to': [f"{r['name']} <{r['address']}>" for r in recipients],
+        'subject': email.subject,
+        'template': email.template,
+        'recipient-variables': json.dumps({r['address']: r['variables'] for r in recipients}),
+        # The template variables are replaced by the values of each recipient
+        'h:X-Mailgun-Variables': json.dumps({name: f'%recipient.{name}%' for name in variable_names}),
+    })
+    response.raise_for_status()
+
+
+def deliver_email(email: EmailOutbox) -> bool:
+    # The attempt is recorded before sending, so a sender that dies mid-request still counts it. The next attempt date
+    # doubles as a lease, the row is not picked by other senders while we send it
+    email.attempts += 1
+    email.next_attempt_date = datetime.now(timezone.utc) + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** email.attempts)
+    db.session.commit()
+    try:
+        send_batch(email)
+    except Exception as e:
+        email.last_error = str(e)
+        if email.attempts >= MAX_ATTEMPTS:
+            email.state = EmailState.failed
+            logger.error(f'Failed to send email {email.id} after {email.attempts} attempts - {e}')
+        else:
+            logger.warning(f'Failed to send email {email.id}, will retry - {e}')
+        db.session.commit()
+        return False
+
+    email.state = EmailState.sent
+    email.sent_date = datetime.now(timezone.utc)
+    db.session.commit()
+    logger.info(f'Email {email.id} was sent successfully to {len(email.recipients)} recipients')
+    return True
+
+
+def deliver_pending(ids: Optional[List[int]] = None, limit: int = 100) -> int:
+    """Sends the pending emails that are due. Rows locked by another sender are skipped"""
+    query = EmailOutbox.query.filter(EmailOutbox.state == EmailState.pending,
+                                     EmailOutbox.next_attempt_date <= datetime.now(timezone.utc))
+    if ids is not None:
+        query = query.filter(EmailOutbox.id.in_(ids))
+    num_sent = 0
+    for _ in range(limit):
+        # Every row is claimed under a row lock, until deliver_email commits its lease
+        email = query.order_by(EmailOutbox.id).with_for_update(skip_locked=True).first()
+        if not email:
+            break
+        num_sent += deliver_email(email)
+    return num_sent
+
+
+def send_emails(template: str, subject: str, recipients: List[Recipient]):
+    """Queues the emails and tries to deliver them right away. Failures are retried later from the outbox"""
+    ids = enqueue_email(template, subject, recipients)
+    if ids:
+        deliver_pending(ids=ids)
@@ -1,21 +1,21 @@
-import json
 import logging
 import os
 from typing import Dict, List, Tuple
 from urllib.parse import urljoin
-import requests
 from typing import Optional
 from itsdangerous import URLSafeTimedSerializer
-from ...models import Comment, Reply, unsubscribe_table, db, User, Paper
+from ...models import Comment, NotificationEvent, Reply, unsubscribe_table, db, User, Paper
+from .dispatcher import Recipient, send_emails
 
 logger = logging.getLogger(__name__)
 
-MAILGUN_KEY = os.environ.get('MAILGUN_KEY')
 SERIALIZER_KEY = os.environ.get('SERIALIZER_KEY')
 serializer = URLSafeTimedSerializer(SERIALIZER_KEY)
 
 FRONTEND_BASE_URL = os.environ.get('FRONTEND_URL')
 BASE_UNSUBSCRIBE_LINK = urljoin(FRONTEND_BASE_URL, '/user/unsubscribe/')
+# When set, comments and replies are buffered and sent as a digest per user and paper (see digest.py)
+DIGEST_WINDOW_MINUTES = int(os.environ.get('NOTIFICATION_DIGEST_MINUTES') or 0)
 
 
 def create_unsubscribe_token(email, paper_id):
@@ -26,18 +26,21 @@ def deserialize_token(token):
     return serializer.loads(token)
 
 
-def new_invite_notification(user_id: int, paper_id: int, invited_by_name: str, message: str):
+def new_invite_notification(user_ids: List[int], paper_id: int, invited_by_name: str, message: str):
+    """Sends the invitations to all the invited users in a single batch"""
     paper: Paper = Paper.query.get(paper_id)
-    user: User = User.query.get(user_id)
+    users: List[User] = User.query.filter(User.id.in_(user_ids)).all()
 
-    variables = {
-        "first_name": user.first_name or user.username,
-        "text": message,
-        "link": urljoin(FRONTEND_BASE_URL, f'/paper/{paper_id}'),
-    }
+    recipients: List[Recipient] = []
+    for user in users:
+        variables = {
+            "first_name": user.first_name or user.username,
+            "text": message,
+            "link": urljoin(FRONTEND_BASE_URL, f'/paper/{paper_id}'),
+        }
+        recipients.append({'address': user.email, 'name': user.first_name or user.username, 'variables': variables})
     subject = f"{invited_by_name} invited you to collaborate on {paper.title}"
-    send_email(address=user.email, name=user.first_name or user.username,
-               variables=variables, template="paper_invite", subject=subject)
+    send_emails(template="paper_invite", subject=subject, recipients=recipients)
 
 
 def get_unsubscribed_users(user_id: Optional[int], paper_id: int) -> List[int]:
@@ -53,6 +56,7 @@ def get_unsubscribed_users(user_id: Optional[int], paper_id: int) -> List[int]:
 
 
 def send_mail_for_paper_comment_or_reply(send_to_users: List[User], text: str, subject: str, paper_id: int, comment_id: int):
+    recipients: List[Recipient] = []
     for user in send_to_users:
         variables = {
             "first_name": user.username,
@@ -60,7 +64,8 @@ def send_mail_for_paper_comment_or_reply(send_to_users: List[User], text: str, s
             "link": urljoin(FRONTEND_BASE_URL, f'/paper/{paper_id}#highlight-{comment_id}'),
             "mute_link": urljoin(BASE_UNSUBSCRIBE_LINK, create_unsubscribe_token(user.email, paper_id))
         }
-        send_email(address=user.email, name=user.username, variables=variables, template="new_reply", subject=subject)
+        recipients.append({'address': user.email, 'name': user.username, 'variables': variables})
+    send_emails(template="new_reply", subject=subject, recipients=recipients)
 
 
 def get_shortened_text(paper_title: str, max_length: int = 40):
@@ -70,7 +75,17 @@ def get_shortened_text(paper_title: str, max_length: int = 40):
     return shortened_title
 
 
+def buffer_notification(user_id: Optional[int], paper_id: int, comment_id: int, reply_id: Optional[int] = None):
+    db.session.add(NotificationEvent(user_id=user_id, paper_id=paper_id, comment_id=comment_id, reply_id=reply_id))
+    db.session.commit()
+
+
 def new_reply_notification(user_id: Optional[int], paper_id: int, reply_id: int):
+    if DIGEST_WINDOW_MINUTES:
+        reply = Reply.query.get(reply_id)
+        buffer_notification(user_id, paper_id, comment_id=reply.parent_id, reply_id=reply_id)
+        return
+
     paper = Paper.query.get(paper_id)
     paper_title = paper.title
     reply: Reply = Reply.query.get(reply_id)
@@ -97,6 +112,10 @@ def new_reply_notification(user_id: Optional[int], paper_id: int, reply_id: int)
 
 
 def new_comment_notification(user_id: Optional[int], paper_id: int, comment_id: int):
+    if DIGEST_WINDOW_MINUTES:
+        buffer_notification(user_id, paper_id, comment_id=comment_id)
+        return
+
     paper = Paper.query.get(paper_id)
     paper_title = paper.title
 
@@ -125,20 +144,4 @@ def new_comment_notification(user_id: Optional[int], paper_id: int, comment_id:
 
 
 def send_email(address: str, name: str, variables: Dict[str, str], subject: str, template: str):
-    if not MAILGUN_KEY:
-        logger.warning('Maingun key is missing. Skipping sending')
-        return
-    try:
-        response = requests.post(
-            "https://api.mailgun.net/v3/email.scihive.org/messages",
-            auth=("api", MAILGUN_KEY),
-            data={"from": "Scihive <noreply@scihive.org>",
-                  "to": f"{name} <{address}>",
-                  "subject": subject,
-                  "template": template,
-                  "h:X-Mailgun-Variables": f'{json.dumps(variables)}'})
-        logger.info(f'Email was sent successfully to {address}')
-        return response
-    except Exception as e:
-        logger.error(f'Failed to send email - {e}')
-        return
+    send_emails(template=template, subject=subject, recipients=[{'address': address, 'name': name, 'variables': variables}])
@@ -1,8 +1,7 @@
 import logging
 from datetime import datetime
-from enum import Enum
 from secrets import token_urlsafe
-from typing import List, Optional
+from typing import List
 
 import pytz
 from cerberus import Validator
@@ -10,23 +9,29 @@ from flask import Blueprint, send_from_directory, session
 from flask_jwt_extended import jwt_optional, jwt_required
 from flask_restful import Api, Resource, abort, fields, marshal_with, reqparse
 
-from ..models import (Author, Collection, MetadataState, Paper, Permission,
+from ..models import (Author, Collection, Paper, Permission,
                       User, db)
 from .file_utils import LOCAL_FILES_DIRECTORY, s3_available
-from .metadata_utils import METADATA_VERSION, extract_paper_metadata
+from .latex_utils import REFERENCES_VERSION, extract_latex_items
+from .marshal_utils import output_json
+from .metadata_utils import extract_paper_metadata, is_metadata_stale
+from .membership_utils import invalidate_collection_papers, invalidate_user_collections
 from .notifications.index import new_invite_notification
 from .paper_query_utils import (get_paper_or_404, get_paper_user_groups,
-                                get_paper_with_pdf, paper_fields)
+                                get_paper_with_pdf, paper_fields, serialize_paper)
 from .permissions_utils import (PermissionType, add_permissions_to_user,
+                                add_permissions_to_users,
                                 enforce_permissions_to_paper,
                                 get_paper_permission_type,
                                 get_paper_token_or_none,
-                                has_permissions_to_paper, is_paper_creator)
+                                has_permissions_to_paper,
+                                invalidate_paper_access, is_paper_creator)
 from .user_utils import get_jwt_email, get_user_by_email, get_user_optional
 from .utils import start_background_task
 
 app = Blueprint('paper', __name__)
 api = Api(app)
+api.representation('application/json')(output_json)
 logger = logging.getLogger(__name__)
 
 user_fields = {
@@ -37,12 +42,6 @@ user_fields = {
 }
 
 
-class ItemState(Enum):
-    existing = 1
-    updated = 2
-    new = 3
-
-
 class PaperGroupsResource(Resource):
     method_decorators = [jwt_required]
 
@@ -56,7 +55,6 @@ class PaperGroupsResource(Resource):
 class PaperResource(Resource):
     method_decorators = [jwt_optional]
 
-    @marshal_with(paper_fields)
     def get(self, paper_id):
         paper = get_paper_with_pdf(paper_id)
         logger.info(f'Fetching paper - {paper.id} - private: {paper.is_private}')
@@ -70,38 +68,67 @@ class PaperResource(Resource):
                 if user:
                     add_permissions_to_user(paper, user)
                     db.session.commit()
+                    invalidate_paper_access(paper)
+                    invalidate_user_collections(user.id)
 
                 session['paper_token'] = get_paper_token_or_none()
 
         if self.endpoint == 'metadata':
-            return paper
+            return serialize_paper(paper)
 
-        is_metadata_missing = not paper.metadata_state or paper.metadata_state == MetadataState.missing
-        is_metatdata_old = paper.metadata_state == MetadataState.ready and (
-            paper.metadata_version or 0) < METADATA_VERSION
-
-        if is_metadata_missing or is_metatdata_old:
+        if is_metadata_stale(paper):
             start_background_task(target=extract_paper_metadata, paper_id=paper.id)
         paper.groups = get_paper_user_groups(paper)
-        return paper
+        return serialize_paper(paper)
 
 
-def get_paper_item(paper, item, latex_fn, version=None, force_update=False):
-    state = ItemState.existing
-    if not paper:
-        abort(404, message='Paper not found')
-    new_value = old_value = getattr(paper, item)
+class PaperReferencesResource(Resource):
+    method_decorators = [jwt_optional]
+
+    def get(self, paper_id):
+        paper = get_paper_or_404(paper_id)
+        if paper.is_private:
+            # Uploaded papers have no LaTeX source
+            enforce_permissions_to_paper(paper, get_user_optional())
+            return {'data': {}, 'version': REFERENCES_VERSION}
+        references, _ = get_latex_items(paper)
+        return references
+
 
-    if force_update or not old_value or (version is not None and float(old_value.get('version', 0)) < version):
-        state = ItemState.new if not old_value else ItemState.updated
+class PaperSectionsResource(Resource):
+    method_decorators = [jwt_optional]
 
-        try:
-            new_value = latex_fn(paper.original_id)
-            setattr(paper, item, new_value)
-        except Exception as e:
-            logger.error(f'Failed to retrieve {item} for {paper.id} - {e}')
-            abort(500, message=f'Failed to retrieve {item}')
-    return new_value, old_value, state
+    def get(self, paper_id):
+        paper = get_paper_or_404(paper_id)
+        if paper.is_private:
+            enforce_permissions_to_paper(paper, get_user_optional())
+            return []
+        _, sections = get_latex_items(paper)
+        return sections
+
+
+def get_latex_items(paper: Paper):
+    """
+    The references and sections are extracted ahead of time by the extract-latex job. Papers it did not reach yet, or
+    that were extracted by an older version, are extracted now and stored for the next readers
+    """
+    if paper.latex_version is not None and paper.latex_version >= REFERENCES_VERSION:
+        return paper.latex_references, paper.latex_sections
+
+    try:
+        references, sections = extract_latex_items(paper.original_id)
+    except Exception as e:
+        logger.error(f'Failed to extract the latex of {paper.id} - {e}')
+        if paper.latex_version is None:
+            abort(500, message='Failed to retrieve the references')
+        # The results of an older version are better than nothing
+        return paper.latex_references, paper.latex_sections
+
+    paper.latex_references = references
+    paper.latex_sections = sections
+    paper.latex_version = REFERENCES_VERSION
+    db.session.commit()
+    return references, sections
 
 
 def validateAuthor(value):
@@ -148,9 +175,20 @@ class EditPaperResource(Resource):
         for author_data in (paper_data.get('authors') or []):
             author_name = author_data.get('name')
             author_id = author_data.get('id')
+            # Author names are unique, a name that already exists links the paper to that author
+            existing_author = Author.query.filter(Author.name == author_name).first()
             if author_id:
                 author = Author.query.get_or_404(author_id)
-                author.name = author_name
+                if not existing_author:
+                    author.name = author_name
+                elif existing_author.id != author.id:
+                    if author in paper.authors:
+                        paper.authors.remove(author)
+                    if existing_author not in paper.authors:
+                        paper.authors.append(existing_author)
+            elif existing_author:
+                if existing_author not in paper.authors:
+                    paper.authors.append(existing_author)
             else:
                 new_author = Author(name=author_name)
                 new_author.papers.append(paper)
@@ -188,27 +226,33 @@ class PaperInvite(Resource):
             return True
         abort(403, message="User is not allowed to add permissions")
 
-    def _get_or_create_user(self, user_data) -> User:
-        email: str = user_data['email'].lower()
-        user: Optional[User] = User.query.filter_by(email=email).first()
-        if not user:
-            name: str = user_data.get('name') or ''
-            name_parts = name.rsplit(' ', 1)
-            if not name:
-                try:
-                    name = email.split('@')[0]
-                    name_parts = name.split('.') if '.' in name else name.split('_')
-                except Exception as e:
-                    logger.error(e)
-
-            first_name = name_parts[0]
-            last_name = name_parts[1] if len(name_parts) >= 2 else ''
-            username = name.replace(' ', '') if name else email.split('@')[0]
-            user: User = User(first_name=first_name, last_name=last_name,
-                              username=username, email=email, pending=True)
-            db.session.add(user)
+    def _create_pending_user(self, email: str, user_data) -> User:
+        name: str = user_data.get('name') or ''
+        name_parts = name.rsplit(' ', 1)
+        if not name:
+            try:
+                name = email.split('@')[0]
+                name_parts = name.split('.') if '.' in name else name.split('_')
+            except Exception as e:
+                logger.error(e)
+
+        first_name = name_parts[0]
+        last_name = name_parts[1] if len(name_parts) >= 2 else ''
+        username = name.replace(' ', '') if name else email.split('@')[0]
+        user: User = User(first_name=first_name, last_name=last_name,
+                          username=username, email=email, pending=True)
+        db.session.add(user)
         return user
 
+    def _get_or_create_users(self, users_data) -> List[User]:
+        users_data_by_email = {u['email'].lower(): u for u in users_data}
+        users: List[User] = User.query.filter(User.email.in_(users_data_by_email)).all()
+        found_emails = {u.email for u in users}
+        for email, user_data in users_data_by_email.items():
+            if email not in found_emails:
+                users.append(self._create_pending_user(email, user_data))
+        return users
+
     @marshal_with({"author": fields.Nested(user_fields), "users": fields.Nested(user_fields)})
     def get(self, paper_id):
         paper: Paper = Paper.query.get_or_404(paper_id)
@@ -230,19 +274,19 @@ class PaperInvite(Resource):
         paper: Paper = get_paper_or_404(paper_id)
         self._abort_if_no_permissions(paper, current_user)
 
-        users: List[User] = []
-        for u in data['users']:
-            users.append(self._get_or_create_user(u))
-        db.session.commit()
-
-        for u in users:
-            if not has_permissions_to_paper(paper, u, check_token=False):
-                add_permissions_to_user(paper, u)
-                # TODO: Switch to task queue later
-                logger.info(f'Sending email to user - {u.username}')
-                start_background_task(target=new_invite_notification, user_id=u.id,
-                                      paper_id=paper_id, invited_by_name=current_user_name, message=data['message'])
+        users = self._get_or_create_users(data['users'])
+        db.session.flush()
+        invited_users = add_permissions_to_users(paper, users)
         db.session.commit()
+        invalidate_paper_access(paper)
+        # Invited users may have been added to a new shared collection
+        for u in invited_users:
+            invalidate_user_collections(u.id)
+
+        if invited_users:
+            logger.info(f'Sending invites to {len(invited_users)} users')
+            start_background_task(target=new_invite_notification, user_ids=[u.id for u in invited_users],
+                                  paper_id=paper.id, invited_by_name=current_user_name, message=data['message'])
         return {"message": "success"}
 
     def delete(self, paper_id):
@@ -263,6 +307,9 @@ class PaperInvite(Resource):
             except ValueError:
                 logger.warning(f'Failed to remove paper {paper_id} from shared collection - {shared_collection.id}')
         db.session.commit()
+        invalidate_paper_access(paper)
+        if shared_collection:
+            invalidate_collection_papers(shared_collection.id)
         return {"message": "success"}
 
 
@@ -289,6 +336,7 @@ class PaperSharingToken(Resource):
         else:
             paper.token = None
         db.session.commit()
+        invalidate_paper_access(paper)
         return {'token': paper.token, 'canEdit': True}
 
 
@@ -298,6 +346,8 @@ api.add_resource(PaperResource, "/<paper_id>/metadata", endpoint="metadata")
 api.add_resource(PaperResource, "/<paper_id>", endpoint="paper")
 api.add_resource(PaperGroupsResource, "/<paper_id>/groups")
 api.add_resource(EditPaperResource, "/<paper_id>/edit")
+api.add_resource(PaperReferencesResource, "/<paper_id>/references")
+api.add_resource(PaperSectionsResource, "/<paper_id>/sections")
 
 # We only want this endpoint if we're using local filesystem to store PDFs
 if not s3_available:
@@ -3,15 +3,16 @@ import logging
 
 from flask import Blueprint
 from flask_jwt_extended import jwt_optional
-from flask_restful import Api, Resource, fields, inputs, marshal_with, reqparse
+from flask_restful import Api, Resource, fields, inputs, reqparse
 from sqlalchemy import or_
 from sqlalchemy.orm import load_only
 from sqlalchemy_searchable import search
 
 from ..models import (Author, Collection, Paper, db, paper_collection_table, user_collection_table)
-from .user_utils import get_user_optional
-
+from .marshal_utils import compile_fields
+from .membership_utils import get_papers_user_collection_ids
 from .paper_query_utils import paper_list_item_fields
+from .user_utils import get_user_optional
 
 app = Blueprint('paper_list', __name__)
 api = Api(app)
@@ -68,6 +69,8 @@ papers_list_fields = {
     'hasMore': fields.Boolean,
 }
 
+serialize_papers_list = compile_fields(papers_list_fields)
+
 
 SORT_DICT = {
     'tweets': Paper.twitter_score.desc(),
@@ -102,17 +105,9 @@ def sort_query(query, args, user=None):
 
 
 def add_collections(papers, user):
-    paper_ids = [p.id for p in papers]
-    collections = db.session.query(Collection.id.label('collection_id'), paper_collection_table.c.paper_id.label('paper_id')).join(paper_collection_table).filter(
-        paper_collection_table.c.paper_id.in_(paper_ids), Collection.users.any(id=user.id)).all()
-    # Convert to a dict with list of collections
-    paper_to_collections = {}
-    for c in collections:
-        paper_to_collections.setdefault(c.paper_id, []).append(str(c.collection_id))
-
-    # assign to papers
+    paper_to_collections = get_papers_user_collection_ids(user.id, [p.id for p in papers])
     for p in papers:
-        p.collection_ids = paper_to_collections.get(p.id, [])
+        p.collection_ids = [str(c) for c in paper_to_collections.get(p.id, [])]
 
     return papers
 
@@ -123,7 +118,6 @@ NUM_PER_PAGE = 10
 class Papers(Resource):
     method_decorators = [jwt_optional]
 
-    @marshal_with(papers_list_fields)
     def get(self):
         query_parser = reqparse.RequestParser()
         query_parser.add_argument('author', type=str, required=False, location='args')
@@ -178,7 +172,8 @@ class Papers(Resource):
         if user:
             papers = add_collections(papers, user)
 
-        return {"count": paginated_result.total, "papers": papers, "hasMore": page_num * NUM_PER_PAGE < paginated_result.total}
+        return serialize_papers_list({"count": paginated_result.total, "papers": papers,
+                                      "hasMore": page_num * NUM_PER_PAGE < paginated_result.total})
 
 
 api.add_resource(Autocomplete, "/autocomplete")
@@ -7,8 +7,10 @@ from flask_jwt_extended.utils import get_jwt_identity
 from flask_restful import abort, fields
 from sqlalchemy import or_
 from .file_utils import get_uploader
+from .marshal_utils import compile_fields
+from .membership_utils import GroupRef, get_paper_user_collection_ids
 
-from ..models import Collection, MetadataState, Paper, db
+from ..models import MetadataState, Paper, db
 from ..scrapers.arxiv import fetch_entry
 
 logger = logging.getLogger(__name__)
@@ -67,6 +69,8 @@ paper_fields = {
     'metadataState': MetadataField(attribute='metadata_state'),
 }
 
+serialize_paper = compile_fields(paper_fields)
+
 
 def abs_to_pdf(url):
     return url.replace('abs', 'pdf').replace('http', 'https') + '.pdf'
@@ -105,9 +109,9 @@ def get_paper_with_pdf(paper_id) -> Paper:
     return paper
 
 
-def get_paper_user_groups(paper: Paper) -> List[Collection]:
+def get_paper_user_groups(paper: Paper) -> List[GroupRef]:
     if get_jwt_identity():
         user = get_user_optional()
-        return db.session.query(Collection.id).filter(Collection.users.any(
-            id=user.id), Collection.papers.any(id=paper.id)).all()
+        if user:
+            return [GroupRef(c) for c in get_paper_user_collection_ids(user.id, paper.id)]
     return []
@@ -1,10 +1,22 @@
+import json
+import logging
+import uuid
 from datetime import datetime
 from enum import Enum
-from typing import Optional
-from flask import session
+from typing import List, NamedTuple, Optional
+from flask import g, session
 from flask_restful import abort, reqparse
+from redis import RedisError
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
 
 from ..models import Collection, Paper, Permission, User, db
+from ..redis_utils import get_redis
+from .user_utils import get_cached_user
+
+logger = logging.getLogger(__name__)
+
+ACCESS_CACHE_SECONDS = 60
 
 
 def get_paper_token_or_none():
@@ -14,12 +26,16 @@ def get_paper_token_or_none():
     return data.get('token', session.get('paper_token', None))
 
 
-def has_valid_token(paper: Paper, token: Optional[str] = None) -> bool:
-    if not paper.token:
+def _is_valid_token(paper_token: Optional[str], token: Optional[str] = None) -> bool:
+    if not paper_token:
         return False
-    if token and paper.token == token:
+    if token and paper_token == token:
         return True
-    return paper.token == get_paper_token_or_none()
+    return paper_token == get_paper_token_or_none()
+
+
+def has_valid_token(paper: Paper, token: Optional[str] = None) -> bool:
+    return _is_valid_token(paper.token, token)
 
 
 class PermissionType(Enum):
@@ -33,18 +49,31 @@ def is_paper_creator(paper: Paper, user: Optional[User]) -> bool:
     return bool(user) and paper.uploaded_by_id == user.id
 
 
-def get_paper_permission_type(paper: Paper, user: Optional[User], token: Optional[str] = None) -> PermissionType:
-    """Returns the highest permission type available for the user"""
+def _get_paper_permission_type(paper: Paper, user: Optional[User], token: Optional[str] = None) -> PermissionType:
     if user:
         if is_paper_creator(paper, user):
             return PermissionType.CREATOR
-        if Permission.query.filter(Permission.paper_id == paper.id, Permission.user_id == user.id).first():
+        # Paper.permissions is joined-loaded with the paper
+        if any(p.user_id == user.id for p in paper.permissions):
             return PermissionType.VIEWER
     if has_valid_token(paper, token):
         return PermissionType.TOKEN
     return PermissionType.NONE
 
 
+def get_paper_permission_type(paper: Paper, user: Optional[User], token: Optional[str] = None) -> PermissionType:
+    """Returns the highest permission type available for the user. The result is memoized for the current request"""
+    key = (paper.id, user.id if user else None, token)
+    permission_types = g.setdefault('paper_permission_types', {})
+    if key not in permission_types:
+        permission_types[key] = _get_paper_permission_type(paper, user, token)
+    return permission_types[key]
+
+
+def clear_paper_permissions_cache():
+    g.pop('paper_permission_types', None)
+
+
 def has_permissions_to_paper(paper: Paper, user: Optional[User], check_token: bool = True, token: Optional[str] = None) -> bool:
     permission = get_paper_permission_type(paper, user, token=token)
     if permission == PermissionType.TOKEN:
@@ -62,7 +91,9 @@ def enforce_permissions_to_paper(paper: Paper, user: Optional[User], check_token
 
 def add_permissions_to_user(paper: Paper, user: User):
     permissions = Permission(paper_id=paper.id, user_id=user.id)
-    db.session.add(permissions)
+    # Appended to the loaded relationship so later checks in this request see it
+    paper.permissions.append(permissions)
+    clear_paper_permissions_cache()
     shared_collection = Collection.query.filter(
         Collection.created_by_id == user.id, Collection.is_shared == True).first()
     if not shared_collection:
@@ -70,3 +101,130 @@ def add_permissions_to_user(paper: Paper, user: User):
                                        created_by_id=user.id, is_shared=True)
         shared_collection.users.append(user)
         db.session.add(shared_collection)
+
+
+def add_permissions_to_users(paper: Paper, users: List[User]) -> List[User]:
+    """
+    Bulk version of add_permissions_to_user, for users without permissions to the paper.
+    Returns the users that were granted permissions - users that already had them (or the creator) are skipped
+    """
+    candidates = {u.id: u for u in users if u.id != paper.uploaded_by_id}
+    if not candidates:
+        return []
+    stmt = insert(Permission).values([{'paper_id': paper.id, 'user_id': user_id, 'creation_date': datetime.now()}
+                                      for user_id in candidates])
+    # Concurrent invites of the same user are resolved by the primary key
+    added_ids = {r.user_id for r in db.session.execute(
+        stmt.on_conflict_do_nothing(index_elements=['paper_id', 'user_id']).returning(Permission.user_id))}
+    db.session.expire(paper, ['permissions'])
+    clear_paper_permissions_cache()
+    if not added_ids:
+        return []
+
+    with_shared_collection = {c.created_by_id for c in db.session.query(Collection.created_by_id).filter(
+        Collection.created_by_id.in_(added_ids), Collection.is_shared == True)}
+    for user_id in added_ids - with_shared_collection:
+        shared_collection = Collection(creation_date=datetime.utcnow(), name="Shared",
+                                       created_by_id=user_id, is_shared=True)
+        shared_collection.users.append(candidates[user_id])
+        db.session.add(shared_collection)
+    return [candidates[user_id] for user_id in added_ids]
+
+
+class PaperAccess(NamedTuple):
+    id: int
+    is_private: bool
+    uploaded_by_id: Optional[int]
+    token: Optional[str]
+    generation: str  # Changes whenever the cache of the paper is invalidated
+
+
+def _get_access_key(paper_id) -> str:
+    return f'paper_access:{paper_id}'
+
+
+def _query_paper_access(paper_id: str) -> Optional[PaperAccess]:
+    query = [Paper.original_id == paper_id]
+    try:
+        query.append(Paper.id == int(paper_id))
+    except ValueError:
+        pass
+    row = db.session.query(Paper.id, Paper.is_private, Paper.uploaded_by_id, Paper.token).filter(or_(*query)).first()
+    if not row:
+        return None
+    return PaperAccess(row.id, bool(row.is_private), row.uploaded_by_id, row.token, uuid.uuid4().hex)
+
+
+def _query_user_access(access: PaperAccess, email: str) -> bool:
+    # The same user the routes resolve, emails are not unique
+    user = get_cached_user(email)
+    if not user:
+        return False
+    user_id = user.id
+    if access.uploaded_by_id == user_id:
+        return True
+    return db.session.query(Permission.query.filter(Permission.paper_id == access.id,
+                                                    Permission.user_id == user_id).exists()).scalar()
+
+
+def get_paper_access(paper_id: str) -> Optional[PaperAccess]:
+    """The columns that decide access to the paper (by its id or original id), cached for ACCESS_CACHE_SECONDS"""
+    client = get_redis()
+    key = _get_access_key(paper_id)
+    try:
+        cached = client.get(key) if client else None
+    except RedisError as e:
+        logger.warning(f'Failed to read the access cache - {e}')
+        client = cached = None
+    if cached:
+        return PaperAccess(*json.loads(cached))
+
+    access = _query_paper_access(paper_id)
+    if access and client:
+        try:
+            client.set(key, json.dumps(access), ex=ACCESS_CACHE_SECONDS)
+        except RedisError as e:
+            logger.warning(f'Failed to update the access cache - {e}')
+    return access
+
+
+def can_access_paper(access: PaperAccess, email: Optional[str], token: Optional[str] = None) -> bool:
+    """
+    The same decision as enforce_permissions_to_paper, without loading the paper.
+    The decision per user is cached under the generation of the paper, so invalidating the paper drops all of them
+    """
+    if not access.is_private or _is_valid_token(access.token, token):
+        return True
+    if not email:
+        return False
+    client = get_redis()
+    key = f'{_get_access_key(access.id)}:{access.generation}:{email}'
+    try:
+        cached = client.get(key) if client else None
+    except RedisError as e:
+        logger.warning(f'Failed to read the access cache - {e}')
+        client = cached = None
+    if cached is not None:
+        return cached == b'1'
+
+    allowed = _query_user_access(access, email)
+    if client:
+        try:
+            client.set(key, '1' if allowed else '0', ex=ACCESS_CACHE_SECONDS)
+        except RedisError as e:
+            logger.warning(f'Failed to update the access cache - {e}')
+    return allowed
+
+
+def invalidate_paper_access(paper: Paper):
+    """Should be called after committing changes to the permissions or the sharing token of the paper"""
+    client = get_redis()
+    if not client:
+        return
+    keys = [_get_access_key(paper.id)]
+    if paper.original_id:
+        keys.append(_get_access_key(paper.original_id))
+    try:
+        client.delete(*keys)
+    except RedisError as e:
+        logger.error(f'Failed to invalidate the access cache of paper {paper.id} - {e}')
@@ -1,6 +1,7 @@
 import logging
 from typing import Optional
 from datetime import datetime
+from flask import g
 from flask_jwt_extended import get_jwt_identity
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -10,10 +11,21 @@ from flask_restful import abort
 logger = logging.getLogger(__name__)
 
 
+def get_cached_user(email: str) -> Optional[User]:
+    """Users are looked up once per request (or app context), only existing users are memoized"""
+    users = g.setdefault('users_by_email', {})
+    user = users.get(email)
+    if not user:
+        user = User.query.filter_by(email=email).first()
+        if user:
+            users[email] = user
+    return user
+
+
 def get_user_by_email(email: str = None) -> User:
     if not email:
         email = get_jwt_email()
-    user = User.query.filter_by(email=email).first()
+    user = get_cached_user(email) if email else None
     if not user:
         abort(404, message='User not found')
     return user
@@ -31,7 +43,7 @@ def get_user_optional() -> Optional[User]:
     current_user = get_jwt_email()
 
     if current_user:
-        return User.query.filter(User.email == current_user).first()
+        return get_cached_user(current_user)
 
     return None
 
@@ -5,16 +5,22 @@ so this file will be loaded first, and then new results will be added to it.
 """
 import logging
 import re
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import dateutil.parser
 import time
-import random
 import argparse
+import queue
+import threading
 import urllib.request
+import eventlet
 import feedparser
-from ..models import Paper, Author, ArxivPaper, Tag, db
-from .utils import catch_exceptions, parse_arxiv_url
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import lazyload
+from ..models import Paper, Author, ArxivPaper, Tag, db, paper_author_table, paper_tag_table
+from .arxiv_atom import parse_entries
+from .utils import RateLimiter, catch_exceptions, get_scraper_state, parse_arxiv_url, set_scraper_state
 
 logger = logging.getLogger(__name__)
 BASE_URL = 'http://export.arxiv.org/api/query?'  # base api query url
@@ -61,153 +67,309 @@ def get_tags(paper_data):
     return tags
 
 
-def add_tags(tags, paper, source='arXiv'):
-    tags = [t for t in tags if re.match('[A-Za-z\\-]+\\.[A-Za-z\\-]+', t)]
-    existing = db.session.query(Tag).filter(Tag.name.in_(tags)).all()
-    for tag_name in tags:
-        tag = next((t for t in existing if t.name == tag_name), None)
-        if tag is None:
-            tag = Tag(name=tag_name, source=source)
-            db.session.add(tag)
+def filter_tags(tags):
+    return [t for t in tags if re.match('[A-Za-z\\-]+\\.[A-Za-z\\-]+', t)]
 
-        paper.tags.append(tag)
-    if tags:
-        db.session.commit()
 
+def get_author_names(paper_data):
+    # Keep the order but drop duplicates, a paper can not be linked to the same author twice
+    return list(dict.fromkeys([author['name'] for author in paper_data.get('authors', [])]))
 
-def handle_entry(e) -> Tuple[Paper, bool, bool]:
-    paper_data = encode_feedparser_dict(e)
 
-    # Count of added and skipper papers
-    added = 0
-    skipped = 0
-
-    # Extract just the raw arxiv id and version for this paper
-    rawid, version = parse_arxiv_url(paper_data['id'])
-    paper_data['_rawid'] = rawid
-    paper_data['_version'] = version
-
-    # If the paper didn't exist in our database (or it's a new version), we add it
-    paper = db.session.query(Paper).filter(Paper.original_id == rawid).first()
+def parse_entry(e) -> Optional[dict]:
+    """Converts a feed entry to a dict with the fields we need. Returns None for entries without a PDF"""
+    # Entries from our Atom parser are already plain dicts
+    json_data = encode_feedparser_dict(e) if isinstance(e, feedparser.FeedParserDict) else e
+    paper_data = dict(json_data)
+    paper_data['_json_data'] = json_data
+    paper_data['_rawid'], paper_data['_version'] = parse_arxiv_url(paper_data['id'])
+    paper_data['_pdf_link'] = get_pdf_link(paper_data)
+    if not paper_data['_pdf_link']:
+        return None
     paper_data['time_updated'] = dateutil.parser.parse(paper_data['updated'])
     paper_data['time_published'] = dateutil.parser.parse(paper_data['published'])
+    return paper_data
 
-    # Get the PDF
-    pdf_link = get_pdf_link(paper_data)
-
-    # We ignore papers without a PDF
-    if not pdf_link:
-        return paper_data, 0, 1
 
-    if not paper:
-        # Getting the PDF from the dictionary
-        local_pdf = None
+def get_or_create_ids(model, names, **extra_fields) -> Dict[str, int]:
+    """Maps names to ids with a single query, inserting the missing ones in a single statement"""
+    ids = dict(db.session.query(model.name, model.id).filter(model.name.in_(names)).all())
+    # Sorted, so concurrent inserts of overlapping names lock them in the same order
+    missing = sorted(name for name in names if name not in ids)
+    if missing:
+        table = model.__table__
+        stmt = insert(table).values([dict(name=name, **extra_fields) for name in missing])
+        # Names inserted by a concurrent transaction are skipped here, and selected once it committed
+        stmt = stmt.on_conflict_do_nothing(index_elements=['name']).returning(table.c.name, table.c.id)
+        ids.update(dict(db.session.execute(stmt).fetchall()))
+        conflicted = [name for name in missing if name not in ids]
+        if conflicted:
+            ids.update(dict(db.session.query(model.name, model.id).filter(model.name.in_(conflicted)).all()))
+    return ids
 
-        paper = Paper(title=paper_data['title'], link=paper_data['link'], original_pdf=pdf_link, local_pdf=local_pdf, publication_date=paper_data['time_published'],
-                      abstract=paper_data['summary'], original_id=paper_data['_rawid'], doi=paper_data.get('arxiv_doi'), last_update_date=paper_data['time_updated'])
 
-        # Adding new authors to the paper
-        for author in paper_data['authors']:
-            author_name = author['name']
-            existing_author = Author.query.filter(Author.name == author_name).first()
-            if not existing_author:
-                existing_author = Author(name=author_name)
-                db.session.add(existing_author)
+def get_paper_fields(paper_data) -> dict:
+    return dict(title=paper_data['title'], link=paper_data['link'], original_pdf=paper_data['_pdf_link'],
+                abstract=paper_data['summary'], original_id=paper_data['_rawid'],
+                last_update_date=paper_data['time_updated'], publication_date=paper_data['time_published'])
 
-            existing_author.papers.append(paper)
 
-        # We create a new paper in database (and an arXiv paper object)
-        added = 1
+def ingest_entries(entries) -> Tuple[int, int]:
+    """
+    Adds a page of feed entries in a single transaction.
+    Existing papers, authors and tags are resolved with one query each. Papers are written through the ORM, so they
+    are versioned, the rest is written with multi-row inserts
+    """
+    num_skipped = 0
+    entries_data: Dict[str, dict] = {}
+    for e in entries:
+        paper_data = parse_entry(e)
+        if not paper_data:
+            num_skipped += 1
+            continue
+        entries_data[paper_data['_rawid']] = paper_data
+
+    if not entries_data:
+        return 0, num_skipped
+
+    # The relationships are not needed, and are loaded lazily instead of being joined
+    existing = {p.original_id: p for p in Paper.query.options(lazyload('*')).filter(
+        Paper.original_id.in_(list(entries_data.keys())))}
+    new_papers = [d for rawid, d in entries_data.items() if rawid not in existing]
+    updated_papers = [d for rawid, d in entries_data.items()
+                      if rawid in existing and existing[rawid].last_update_date < d['time_updated']]
+    num_skipped += len(entries_data) - len(new_papers) - len(updated_papers)
+
+    for d in new_papers:
+        paper = Paper(**get_paper_fields(d), doi=d.get('arxiv_doi'))
         db.session.add(paper)
-        db.session.flush()
-        arxiv_paper = ArxivPaper(paper_id=paper.id, json_data=e)
-        db.session.add(arxiv_paper)
-
-    elif paper.last_update_date < paper_data['time_published']:
-        # Updating the existing paper in the database
-        paper.title = paper_data['title']
-        paper.abstract = paper_data['summary']
-        paper.link = paper_data['link']
-        paper.original_pdf = pdf_link
-        paper.original_id = paper_data['_rawid']
-        paper.last_update_date = paper_data['time_updated']
-        paper.publication_date = paper_data['time_published']
-
-        # Updating the arXiv object as well
-        existing_arxiv_paper = db.session.query(ArxivPaper).filter(ArxivPaper.paper == paper.id).first()
-        existing_arxiv_paper.json_data = e
-
-        added = 1
-    else:
-        skipped = 1
+        existing[d['_rawid']] = paper
+    for d in updated_papers:
+        for key, value in get_paper_fields(d).items():
+            setattr(existing[d['_rawid']], key, value)
+    # Flushed through SQLAlchemy-Continuum, which writes the paper_version rows
+    db.session.flush()
+    paper_ids = {rawid: paper.id for rawid, paper in existing.items()}
+
+    changed_papers = new_papers + updated_papers
+    if changed_papers:
+        stmt = insert(ArxivPaper.__table__).values(
+            [dict(paper_id=paper_ids[d['_rawid']], json_data=d['_json_data']) for d in changed_papers])
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['paper_id'], set_={'json_data': stmt.excluded.json_data}))
+
+    # Authors are only added to new papers
+    author_names = list({name for d in new_papers for name in get_author_names(d)})
+    if author_names:
+        author_ids = get_or_create_ids(Author, author_names)
+        links = [dict(paper_id=paper_ids[d['_rawid']], author_id=author_ids[name])
+                 for d in new_papers for name in get_author_names(d)]
+        db.session.execute(insert(paper_author_table).values(links).on_conflict_do_nothing())
+
+    entries_tags = {rawid: set(filter_tags(get_tags(d))) for rawid, d in entries_data.items()}
+    tag_names = list(set().union(*entries_tags.values()))
+    if tag_names:
+        tag_ids = get_or_create_ids(Tag, tag_names, source='arXiv')
+        links = [dict(paper_id=paper_ids[rawid], tag_id=tag_ids[name]) for rawid, tags in entries_tags.items() for name in tags]
+        db.session.execute(insert(paper_tag_table).values(links).on_conflict_do_nothing())
 
     db.session.commit()
-    # Getting the tags for the papers
-    tags = get_tags(paper_data)
-    add_tags(tags, paper)
-
-    return paper, added, skipped
-
-# Is this method redundant?
+    return len(new_papers) + len(updated_papers), num_skipped
 
 
 def fetch_entry(paper_id) -> Optional[Paper]:
     paper_id = paper_id.replace('_', '/')
     try:
-        with urllib.request.urlopen(f'{BASE_URL}id_list={paper_id}') as url:
-            response = url.read()
-        parse = feedparser.parse(response)
-        paper, added, skipped = handle_entry(parse.entries[0])
-        return paper
+        entries = parse_entries(fetch_feed(f'id_list={paper_id}'))[:1]
+        ingest_entries(entries)
+        if not entries:
+            return None
+        # None for papers without a PDF, which are skipped
+        return Paper.query.filter(Paper.original_id == parse_arxiv_url(entries[0]['id'])[0]).first()
     except Exception as e:
         logger.warning(f'Paper not found on arxiv - {paper_id}')
         logger.warning(e)
         return None
 
 
-def fetch_entries(query):
+HARVEST_STATE_NAME = 'arxiv_harvest'
+MAX_EMPTY_RESPONSES = 10
+CHECKPOINT_SECONDS = 60  # Pages are idempotent, a resumed harvest repeats at most this much work
+
+
+def fetch_feed(query) -> bytes:
     with urllib.request.urlopen(BASE_URL + query) as url:
-        response = url.read()
+        return url.read()
 
-    parse = feedparser.parse(response)
-    num_added = 0
-    num_skipped = 0
 
-    for e in parse.entries:
-        _, added, skipped = handle_entry(e)
-        num_added += added
-        num_skipped += skipped
+def fetch_entries(query):
+    return ingest_entries(parse_entries(fetch_feed(query)))
 
-    return num_added, num_skipped
 
+class HarvestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {'fetch_time': 0.0, 'parse_time': 0.0, 'write_time': 0.0, 'pages': 0, 'added': 0, 'skipped': 0}
 
-@catch_exceptions(logger=logger)
-def fetch_papers(start_index=0, max_index=3000, results_per_iteration=200, wait_time=5, query=DEF_QUERY, break_on_no_added=1):
-    # Main loop to fetch new results
-    logger.info('Updating paper DB')
+    def add(self, key: str, value):
+        with self._lock:
+            self.values[key] += value
 
-    for i in range(start_index, max_index, results_per_iteration):
-        num_failures = 0
+    def log(self):
+        v = self.values
+        logger.info(f'Harvested {v["pages"]} pages - added {v["added"]}, skipped {v["skipped"]} - '
+                    f'fetch {v["fetch_time"]:.1f}s, parse {v["parse_time"]:.1f}s, write {v["write_time"]:.1f}s')
 
-        logger.info(f'Results {i} - {i + results_per_iteration}')
-        query_string = f'search_query={query}&sortBy=lastUpdatedDate&start={i}&max_results={results_per_iteration}'
 
-        while num_failures < 10:
-            num_added, num_skipped = fetch_entries(query_string)
+class OffsetTracker:
+    """Pages may finish out of order, we only checkpoint the offset that all the pages before it were done"""
 
-            if num_added == 0 and num_skipped > 0 and break_on_no_added == 1:
-                logger.info('No new papers were added. Assuming no new papers exist. Exiting.')
-                return
-            elif num_added + num_skipped > 0:
+    def __init__(self, start_index: int, step: int):
+        self.next_index = start_index
+        self._step = step
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def complete(self, index: int) -> int:
+        with self._lock:
+            self._done.add(index)
+            while self.next_index in self._done:
+                self._done.remove(self.next_index)
+                self.next_index += self._step
+            return self.next_index
+
+
+class Harvester:
+    """
+    Fetches result pages on a producer thread (rate limited) and parses and stores them on consumer threads.
+    The queue between them is bounded, so the producer waits when the DB falls behind.
+    The threads only overlap when they are real threads - under eventlet, psycopg2 blocks the hub while a page is
+    written. The scheduler runs the harvest in a process without eventlet (see scheduler.py)
+    """
+
+    def __init__(self, flask_app, query: str, results_per_iteration: int, wait_time: float, num_workers: int,
+                 queue_size: int, break_on_no_added: int):
+        self._flask_app = flask_app
+        self._query = query
+        self._results_per_iteration = results_per_iteration
+        self._rate_limiter = RateLimiter(1 / wait_time)
+        self._num_workers = num_workers
+        self._pages = queue.Queue(maxsize=queue_size)
+        self._break_on_no_added = break_on_no_added
+        self._stop = threading.Event()
+        self._checkpoint_lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+        self.caught_up = False
+        self.metrics = HarvestMetrics()
+
+    def _get_query_string(self, index: int):
+        return f'search_query={self._query}&sortBy=lastUpdatedDate&start={index}&max_results={self._results_per_iteration}'
+
+    def _fetch(self, index: int) -> bytes:
+        self._rate_limiter.wait()
+        start = time.monotonic()
+        response = fetch_feed(self._get_query_string(index))
+        self.metrics.add('fetch_time', time.monotonic() - start)
+        return response
+
+    def _produce(self, start_index: int, max_index: int):
+        try:
+            for index in range(start_index, max_index, self._results_per_iteration):
+                if self._stop.is_set():
+                    break
+                logger.info(f'Results {index} - {index + self._results_per_iteration}')
+                try:
+                    response = self._fetch(index)
+                except Exception as e:
+                    logger.error(f'Failed to fetch results {index} from arxiv - {e}')
+                    self._stop.set()
+                    break
+                self._pages.put((index, response))
+        finally:
+            for _ in range(self._num_workers):
+                self._pages.put(None)
+
+    def _parse(self, index: int, response: bytes):
+        for _ in range(MAX_EMPTY_RESPONSES):
+            start = time.monotonic()
+            entries = parse_entries(response)
+            self.metrics.add('parse_time', time.monotonic() - start)
+            if entries:
+                return entries
+            logger.info(f'Received no results from arxiv for {index}. Retrying')
+            response = self._fetch(index)
+        return []
+
+    def _consume(self, tracker: OffsetTracker):
+        with self._flask_app.app_context():
+            while True:
+                item = self._pages.get()
+                if item is None:
+                    return
+                index, response = item
+                try:
+                    entries = self._parse(index, response)
+                    start = time.monotonic()
+                    num_added, num_skipped = ingest_entries(entries)
+                    self.metrics.add('write_time', time.monotonic() - start)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.exception(f'Failed to process results {index} - {e}')
+                    continue
+
+                self.metrics.add('pages', 1)
+                self.metrics.add('added', num_added)
+                self.metrics.add('skipped', num_skipped)
                 logger.info(f'Added {num_added} papers, already had {num_skipped}.')
-                break
-            else:
-                logger.info('Received no results from arxiv. Retrying after sleep')
-                num_failures += 1
-                time.sleep(5)
+                self._checkpoint(tracker.complete(index))
+                if num_added == 0 and num_skipped > 0 and self._break_on_no_added == 1:
+                    logger.info('No new papers were added. Assuming no new papers exist. Stopping.')
+                    self.caught_up = True
+                    self._stop.set()
+
+    def _checkpoint(self, next_index: int):
+        with self._checkpoint_lock:
+            if time.monotonic() - self._last_checkpoint < CHECKPOINT_SECONDS:
+                return
+            self._last_checkpoint = time.monotonic()
+        set_scraper_state(HARVEST_STATE_NAME, {'query': self._query, 'next_index': next_index})
+
+    def run(self, start_index: int, max_index: int):
+        if eventlet.patcher.is_monkey_patched('thread'):
+            logger.warning('Running with eventlet, the DB writes will not overlap with the downloads')
+        tracker = OffsetTracker(start_index, self._results_per_iteration)
+        producer = threading.Thread(target=self._produce, args=(start_index, max_index))
+        consumers = [threading.Thread(target=self._consume, args=(tracker,)) for _ in range(self._num_workers)]
+        producer.start()
+        for consumer in consumers:
+            consumer.start()
+        producer.join()
+        for consumer in consumers:
+            consumer.join()
+        return tracker.next_index
+
+
+@catch_exceptions(logger=logger)
+def fetch_papers(start_index=0, max_index=3000, results_per_iteration=200, wait_time=5, query=DEF_QUERY, break_on_no_added=1,
+                 num_workers=1, queue_size=4, resume=True):
+    # Main loop to fetch new results
+    logger.info('Updating paper DB')
 
-        logger.info(f'Sleeping for {wait_time} seconds')
-        time.sleep(wait_time + random.uniform(0, 3))
+    state = get_scraper_state(HARVEST_STATE_NAME)
+    if resume and state and state.get('query') == query and state.get('next_index', 0) > start_index:
+        start_index = state['next_index']
+        logger.info(f'Resuming the previous harvest from {start_index}')
+
+    harvester = Harvester(flask_app=current_app._get_current_object(), query=query,
+                          results_per_iteration=results_per_iteration, wait_time=wait_time, num_workers=num_workers,
+                          queue_size=queue_size, break_on_no_added=break_on_no_added)
+    next_index = harvester.run(start_index, max_index)
+    harvester.metrics.log()
+    if harvester.caught_up or next_index >= max_index:
+        set_scraper_state(HARVEST_STATE_NAME, None)
+    else:
+        set_scraper_state(HARVEST_STATE_NAME, {'query': query, 'next_index': next_index})
+        logger.warning(f'Harvest stopped before completion. The next run will resume from {next_index}')
+    return harvester.metrics.values['added']
 
 
 def parse_arguments():
@@ -223,6 +385,9 @@ def parse_arguments():
                         help='wait time allows being gentle on the arxiv API (in seconds)')
     parser.add_argument('--break-on-no-added', type=int, default=1,
                         help='break out early if all returned query papers are already in db? 1=yes, 0=no')
+    parser.add_argument('--num-workers', type=int, default=1, help='number of threads parsing and storing results')
+    parser.add_argument('--queue-size', type=int, default=4, help='max number of fetched pages waiting to be stored')
+    parser.add_argument('--no-resume', action='store_true', help='ignore the offset stored by an interrupted run')
     args, unknown = parser.parse_known_args()
 
     return args
@@ -236,7 +401,8 @@ def run():
 
     # Fetching papers
     fetch_papers(args.start_index, args.max_index, args.results_per_iteration,
-                 args.wait_time, args.search_query, args.break_on_no_added)
+                 args.wait_time, args.search_query, args.break_on_no_added,
+                 num_workers=args.num_workers, queue_size=args.queue_size, resume=not args.no_resume)
 
 
 if __name__ == "__main__":
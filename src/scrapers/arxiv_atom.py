@@ -0,0 +1,69 @@
+"""
+A streaming parser for the arXiv API Atom feed (https://arxiv.org/help/api/user-manual#_details_of_atom_results_returned).
+It yields plain dicts with the same keys feedparser returns for the fields we use, without feedparser's
+sanitizing and the deep copy into plain dicts afterwards.
+"""
+from io import BytesIO
+from typing import Dict, Iterator, List
+import xml.etree.ElementTree as ET
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+ARXIV_NS = '{http://arxiv.org/schemas/atom}'
+
+
+def _text(elem: ET.Element) -> str:
+    return (elem.text or '').strip()
+
+
+def _parse_link(elem: ET.Element) -> Dict[str, str]:
+    link = dict(elem.attrib)
+    link.setdefault('rel', 'alternate')
+    link.setdefault('type', 'text/html')
+    return link
+
+
+def _parse_entry(elem: ET.Element) -> dict:
+    entry = {'authors': [], 'links': [], 'tags': []}
+    for child in elem:
+        tag = child.tag
+        if tag == f'{ATOM_NS}author':
+            author = {}
+            for author_field in child:
+                if author_field.tag == f'{ATOM_NS}name':
+                    author['name'] = _text(author_field)
+                elif author_field.tag == f'{ARXIV_NS}affiliation':
+                    # Like feedparser, we only keep the last affiliation on the entry itself
+                    entry['arxiv_affiliation'] = _text(author_field)
+            entry['authors'].append(author)
+        elif tag == f'{ATOM_NS}link':
+            entry['links'].append(_parse_link(child))
+        elif tag == f'{ATOM_NS}category':
+            entry['tags'].append({'term': child.get('term'), 'scheme': child.get('scheme'), 'label': child.get('label')})
+        elif tag == f'{ARXIV_NS}primary_category':
+            entry['arxiv_primary_category'] = {'term': child.get('term'), 'scheme': child.get('scheme')}
+        elif tag.startswith(ATOM_NS):
+            entry[tag[len(ATOM_NS):]] = _text(child)
+        elif tag.startswith(ARXIV_NS):
+            entry[f'arxiv_{tag[len(ARXIV_NS):]}'] = _text(child)
+
+    alternate = next((link for link in entry['links'] if link['rel'] == 'alternate'), None)
+    if alternate:
+        entry['link'] = alternate.get('href')
+    if entry['authors']:
+        entry['author_detail'] = dict(entry['authors'][-1])
+        entry['author'] = entry['authors'][-1].get('name')
+    return entry
+
+
+def iter_entries(content: bytes) -> Iterator[dict]:
+    """Yields the feed entries one by one, releasing the parsed elements as we go"""
+    parser = ET.iterparse(BytesIO(content), events=('start', 'end'))
+    _, root = next(parser)
+    for event, elem in parser:
+        if event == 'end' and elem.tag == f'{ATOM_NS}entry':
+            yield _parse_entry(elem)
+            root.remove(elem)
+
+
+def parse_entries(content: bytes) -> List[dict]:
+    return list(iter_entries(content))
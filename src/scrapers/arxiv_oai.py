@@ -0,0 +1,178 @@
+"""
+Incremental arXiv harvesting via OAI-PMH (https://arxiv.org/help/oa).
+We keep a high-water mark of the last datestamp we stored, and only ask for records that changed since then.
+The base URL can be overridden (ARXIV_OAI_URL) to replay recorded responses from a local server.
+"""
+import logging
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from .arxiv import ingest_entries
+from .utils import catch_exceptions, get_scraper_state, set_scraper_state
+
+logger = logging.getLogger(__name__)
+
+OAI_URL = os.environ.get('ARXIV_OAI_URL') or 'http://export.arxiv.org/oai2'
+STATE_NAME = 'arxiv_oai'
+DEFAULT_SETS = ['cs', 'stat']
+DEFAULT_CATEGORIES = ['cs.CV', 'cs.AI', 'cs.LG', 'cs.CL', 'cs.NE', 'stat.ML']
+DEFAULT_LOOKBACK_DAYS = 3
+MAX_RETRIES = 5
+
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+ARXIV_NS = '{http://arxiv.org/OAI/arXiv/}'
+
+
+class OAIError(Exception):
+    def __init__(self, code: Optional[str], message: str):
+        super().__init__(f'OAI error - {code} - {message}')
+        self.code = code
+
+
+def get_text(elem: ET.Element, tag: str, default=None) -> Optional[str]:
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return default
+    return ' '.join(child.text.split())
+
+
+def record_to_entry(record: ET.Element) -> Optional[dict]:
+    """Converts an OAI record to the same structure feedparser returns for the search API"""
+    header = record.find(f'{OAI_NS}header')
+    if header is None or header.get('status') == 'deleted':
+        return None
+    metadata = record.find(f'{OAI_NS}metadata/{ARXIV_NS}arXiv')
+    if metadata is None:
+        return None
+
+    arxiv_id = get_text(metadata, f'{ARXIV_NS}id')
+    created = get_text(metadata, f'{ARXIV_NS}created')
+    updated = get_text(metadata, f'{ARXIV_NS}updated', created)
+    authors = []
+    for author in metadata.findall(f'{ARXIV_NS}authors/{ARXIV_NS}author'):
+        name_parts = [get_text(author, f'{ARXIV_NS}forenames'), get_text(author, f'{ARXIV_NS}keyname'),
+                      get_text(author, f'{ARXIV_NS}suffix')]
+        authors.append({'name': ' '.join(filter(None, name_parts))})
+    categories = (get_text(metadata, f'{ARXIV_NS}categories') or '').split()
+
+    entry = {
+        'id': f'http://arxiv.org/abs/{arxiv_id}',
+        'link': f'http://arxiv.org/abs/{arxiv_id}',
+        'links': [{'href': f'http://arxiv.org/pdf/{arxiv_id}', 'type': 'application/pdf', 'rel': 'related', 'title': 'pdf'}],
+        'title': get_text(metadata, f'{ARXIV_NS}title', ''),
+        'summary': get_text(metadata, f'{ARXIV_NS}abstract', ''),
+        # OAI dates have no time, the search API returns UTC timestamps
+        'published': f'{created}T00:00:00Z',
+        'updated': f'{updated}T00:00:00Z',
+        'authors': authors,
+        'tags': [{'term': c, 'scheme': 'http://arxiv.org/schemas/atom', 'label': None} for c in categories],
+    }
+    doi = get_text(metadata, f'{ARXIV_NS}doi')
+    if doi:
+        entry['arxiv_doi'] = doi
+    return entry
+
+
+def parse_response(content: bytes) -> Tuple[List[dict], Optional[str], Optional[str]]:
+    """
+    Returns the entries, the latest datestamp of the page (deleted records included) and the resumption token
+    (None when the list is complete)
+    """
+    root = ET.fromstring(content)
+    error = root.find(f'{OAI_NS}error')
+    if error is not None:
+        if error.get('code') == 'noRecordsMatch':
+            return [], None, None
+        raise OAIError(error.get('code'), ' '.join((error.text or '').split()))
+
+    list_records = root.find(f'{OAI_NS}ListRecords')
+    if list_records is None:
+        raise OAIError(None, 'The response has neither ListRecords nor an error')
+    records = list_records.findall(f'{OAI_NS}record')
+    entries = [record_to_entry(r) for r in records]
+    datestamps = [get_text(r, f'{OAI_NS}header/{OAI_NS}datestamp') for r in records]
+    latest_datestamp = max(filter(None, datestamps), default=None)
+    token_elem = list_records.find(f'{OAI_NS}resumptionToken')
+    token = token_elem.text if token_elem is not None and token_elem.text else None
+    return [e for e in entries if e], latest_datestamp, token
+
+
+def fetch_records(params: dict) -> bytes:
+    url = f'{OAI_URL}?{urllib.parse.urlencode(params)}'
+    for _ in range(MAX_RETRIES):
+        try:
+            with urllib.request.urlopen(url) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            # arXiv uses 503 with Retry-After for flow control
+            if e.code != 503:
+                raise
+            retry_after = int(e.headers.get('Retry-After') or 10)
+            logger.info(f'OAI server asked to retry after {retry_after} seconds')
+            time.sleep(retry_after)
+    raise Exception(f'Failed to fetch {url} after {MAX_RETRIES} retries')
+
+
+def is_relevant(entry: dict, categories: List[str]) -> bool:
+    return any(tag['term'] in categories for tag in entry['tags'])
+
+
+def harvest_set(set_spec: str, state: dict, categories: List[str]) -> Tuple[int, int]:
+    set_state = state.setdefault(set_spec, {})
+    from_date = set_state.get('from') or (datetime.utcnow() - timedelta(days=DEFAULT_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    token = set_state.get('resumption_token')
+    watermark = set_state.get('pending_watermark') or from_date
+    num_added = num_skipped = 0
+    logger.info(f'Harvesting set {set_spec} from {from_date}')
+
+    while True:
+        if token:
+            params = {'verb': 'ListRecords', 'resumptionToken': token}
+        else:
+            params = {'verb': 'ListRecords', 'metadataPrefix': 'arXiv', 'from': from_date, 'set': set_spec}
+        try:
+            entries, latest_datestamp, token = parse_response(fetch_records(params))
+        except OAIError as e:
+            if e.code != 'badResumptionToken' or 'resumptionToken' not in params:
+                raise
+            # Tokens expire - restart the list from the stored watermark
+            logger.warning(f'Resumption token was rejected, restarting from {from_date} - {e}')
+            token = None
+            continue
+
+        relevant = [e for e in entries if is_relevant(e, categories)]
+        added, skipped = ingest_entries(relevant)
+        num_added += added
+        num_skipped += skipped + len(entries) - len(relevant)
+        if latest_datestamp:
+            watermark = max(watermark, latest_datestamp)
+
+        # Keep the token so an interrupted run can continue the same list
+        set_state.update({'resumption_token': token, 'pending_watermark': watermark})
+        set_scraper_state(STATE_NAME, state)
+        if not token:
+            break
+
+    # The list is complete, the next run only needs records from the latest datestamp we've seen
+    state[set_spec] = {'from': watermark}
+    set_scraper_state(STATE_NAME, state)
+    return num_added, num_skipped
+
+
+@catch_exceptions(logger=logger)
+def run(sets: Optional[List[str]] = None, categories: Optional[List[str]] = None, from_date: Optional[str] = None):
+    state = get_scraper_state(STATE_NAME, {})
+    sets = sets or DEFAULT_SETS
+    if from_date:
+        for set_spec in sets:
+            state[set_spec] = {'from': from_date}
+
+    for set_spec in sets:
+        num_added, num_skipped = harvest_set(set_spec, state, categories or DEFAULT_CATEGORIES)
+        logger.info(f'Set {set_spec} - added {num_added} papers, skipped {num_skipped}')
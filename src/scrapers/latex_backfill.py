@@ -0,0 +1,106 @@
+"""
+Extracts the references and sections of arXiv papers from their LaTeX source, ahead of the first reader.
+Papers that are already at REFERENCES_VERSION are skipped, so the job can be stopped and re-run at any point.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from sqlalchemy import func
+
+from ..models import ArxivPaper, Paper, db
+from ..routes.latex_utils import REFERENCES_VERSION, download_source_file, parse_source_content
+from .utils import ProgressReporter, RateLimiter, catch_exceptions
+
+logger = logging.getLogger(__name__)
+
+SourceFile = Tuple[str, bytes]  # (extension, content)
+
+
+def get_pending_papers_query():
+    return db.session.query(Paper.id, Paper.original_id).join(ArxivPaper, ArxivPaper.paper_id == Paper.id).filter(
+        func.coalesce(Paper.latex_version, 0) < REFERENCES_VERSION, Paper.is_private.isnot(True))
+
+
+def download_source(arxiv_id: str) -> Optional[SourceFile]:
+    """Returns None when the paper has no source, and raises on other (probably temporary) errors"""
+    try:
+        extension, source = download_source_file(arxiv_id)
+    except requests.HTTPError:
+        logger.warning(f'Latex file not found for {arxiv_id}')
+        return None
+    with source:
+        return extension, source.read()
+
+
+def download_batch(executor: ThreadPoolExecutor, batch, rate_limiter: RateLimiter) -> Dict[int, Optional[SourceFile]]:
+    futures = {}
+    for paper_id, arxiv_id in batch:
+        rate_limiter.wait()
+        futures[executor.submit(download_source, arxiv_id)] = paper_id
+
+    sources = {}
+    for future in as_completed(futures):
+        paper_id = futures[future]
+        try:
+            sources[paper_id] = future.result()
+        except Exception as e:
+            # We will retry the paper on the next run
+            logger.warning(f'Failed to download latex source of paper - {paper_id} - {e}')
+    return sources
+
+
+def parse_batch(executor: ProcessPoolExecutor, batch, sources: Dict[int, Optional[SourceFile]]) -> List[dict]:
+    arxiv_ids = dict(batch)
+    futures = {}
+    updates = []
+    for paper_id, source in sources.items():
+        if source is None:
+            updates.append(dict(id=paper_id, latex_references={'data': {}, 'version': REFERENCES_VERSION},
+                                latex_sections=[], latex_version=REFERENCES_VERSION))
+            continue
+        extension, content = source
+        futures[executor.submit(parse_source_content, arxiv_ids[paper_id], extension, content)] = paper_id
+
+    for future in as_completed(futures):
+        paper_id = futures[future]
+        try:
+            references, sections = future.result()
+        except Exception as e:
+            logger.warning(f'Failed to parse latex source of paper - {paper_id} - {e}')
+            continue
+        updates.append(dict(id=paper_id, latex_references=references,
+                            latex_sections=sections, latex_version=REFERENCES_VERSION))
+    return updates
+
+
+@catch_exceptions(logger=logger)
+def run(batch_size=50, download_workers=2, parse_workers=4, max_downloads_per_second=1.0, limit=None):
+    total = get_pending_papers_query().count()
+    if limit:
+        total = min(total, limit)
+    logger.info(f'Found {total} papers with references older than version {REFERENCES_VERSION}')
+
+    progress = ProgressReporter(logger, total)
+    rate_limiter = RateLimiter(max_downloads_per_second)
+    last_id = 0
+    # Downloading is I/O bound and polite (few threads), while parsing is CPU bound pure Python (processes).
+    # The workers are spawned rather than forked, a fork would copy the eventlet hub and the DB connections
+    with ThreadPoolExecutor(max_workers=download_workers) as download_executor, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) as parse_executor:
+        while progress.processed < total:
+            batch = get_pending_papers_query().filter(Paper.id > last_id).order_by(
+                Paper.id.asc()).limit(min(batch_size, total - progress.processed)).all()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            sources = download_batch(download_executor, batch, rate_limiter)
+            updates = parse_batch(parse_executor, batch, sources)
+            db.session.bulk_update_mappings(Paper, updates)
+            db.session.commit()
+            progress.advance(len(batch))
+
+    progress.report()
+    logger.info('Finished extracting latex references and sections')
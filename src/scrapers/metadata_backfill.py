@@ -0,0 +1,108 @@
+"""
+Re-extracts the metadata of papers whose metadata is older than METADATA_VERSION.
+Papers are walked in id order and the last processed id is checkpointed, so an interrupted run can be resumed.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Sequence
+
+from sqlalchemy import func, or_
+
+from ..models import MetadataState, Paper, db
+from ..routes.metadata_utils import METADATA_VERSION, apply_paper_metadata, fetch_paper_metadata
+from .utils import ProgressReporter, RateLimiter, catch_exceptions, get_scraper_state, set_scraper_state
+
+logger = logging.getLogger(__name__)
+
+# Stored in the DB, so a run on another pod can resume it
+CHECKPOINT_STATE_NAME = f'reprocess_metadata_checkpoint_v{METADATA_VERSION}'
+
+
+def get_stale_papers_query():
+    is_missing = or_(Paper.metadata_state.is_(None), Paper.metadata_state == MetadataState.missing)
+    is_old = (Paper.metadata_state == MetadataState.ready) & (func.coalesce(Paper.metadata_version, 0) < METADATA_VERSION)
+    return db.session.query(Paper.id, Paper.local_pdf).filter(or_(is_missing, is_old), Paper.local_pdf.isnot(None))
+
+
+def get_papers_query(paper_ids: Optional[Sequence[int]] = None, force=False):
+    if force:
+        query = db.session.query(Paper.id, Paper.local_pdf).filter(Paper.local_pdf.isnot(None))
+    else:
+        query = get_stale_papers_query()
+    if paper_ids:
+        query = query.filter(Paper.id.in_(paper_ids))
+    return query
+
+
+def get_next_batch(last_id: int, batch_size: int, paper_ids: Optional[Sequence[int]] = None, force=False):
+    query = get_papers_query(paper_ids, force).filter(Paper.id > last_id)
+    return query.order_by(Paper.id.asc()).limit(batch_size).all()
+
+
+def _fetch(paper_id: int, pdf_link: str):
+    try:
+        return fetch_paper_metadata(paper_id, pdf_link)
+    except Exception as e:
+        logger.warning(f'Failed to fetch metadata for paper - {paper_id} - {e}')
+        return False, None
+
+
+def process_batch(executor: ThreadPoolExecutor, batch, rate_limiter: RateLimiter, progress: ProgressReporter) -> int:
+    futures = {}
+    for paper_id, pdf_link in batch:
+        rate_limiter.wait()
+        futures[executor.submit(_fetch, paper_id, pdf_link)] = paper_id
+
+    num_failed = 0
+    # The DB session is not shared with the workers - all the writes happen on this thread
+    for future in as_completed(futures):
+        paper_id = futures[future]
+        success, metadata = future.result()
+        if success:
+            apply_paper_metadata(Paper.query.get(paper_id), metadata)
+            db.session.commit()
+        else:
+            num_failed += 1
+        progress.advance()
+    return num_failed
+
+
+@catch_exceptions(logger=logger)
+def run(paper_ids: Optional[List[int]] = None, workers=4, batch_size=100, max_per_second=2.0, dry_run=False, restart=False,
+        force=False):
+    # A targeted run should not move (or depend on) the checkpoint of the full run
+    use_checkpoint = not paper_ids
+    last_id = 0
+    if use_checkpoint and not restart:
+        last_id = get_scraper_state(CHECKPOINT_STATE_NAME, 0)
+        if last_id:
+            logger.info(f'Resuming from paper id {last_id}')
+
+    total = get_papers_query(paper_ids, force).filter(Paper.id > last_id).count()
+    if force:
+        logger.info(f'Found {total} papers to reprocess')
+    else:
+        logger.info(f'Found {total} papers with metadata older than version {METADATA_VERSION}')
+
+    if dry_run:
+        batch = get_next_batch(last_id, batch_size, paper_ids, force)
+        logger.info(f'Dry run - next papers to process: {[paper_id for paper_id, _ in batch]}')
+        return
+
+    progress = ProgressReporter(logger, total)
+    rate_limiter = RateLimiter(max_per_second)
+    num_failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = get_next_batch(last_id, batch_size, paper_ids, force)
+            if not batch:
+                break
+            num_failed += process_batch(executor, batch, rate_limiter, progress)
+            last_id = batch[-1][0]
+            if use_checkpoint:
+                set_scraper_state(CHECKPOINT_STATE_NAME, last_id)
+
+    progress.report()
+    logger.info(f'Finished reprocessing metadata - {progress.processed - num_failed} updated, {num_failed} failed')
+    if use_checkpoint:
+        set_scraper_state(CHECKPOINT_STATE_NAME, None)
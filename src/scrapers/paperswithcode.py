@@ -1,50 +1,137 @@
 import requests
 import csv
 from io import StringIO
+from itertools import islice
 import logging
 import os
+from typing import Dict, Iterable, Iterator
+
+from sqlalchemy import text
 
 from .utils import catch_exceptions
-from ..models import Paper, PaperWithCode, db
+from ..models import db
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+STAGING_COLUMNS = ['arxiv_id', 'github_link', 'url', 'stars', 'framework']
+COPY_CHUNK_SIZE = 10000
 
-def fetch_data():
-    user = os.environ.get('PAPERSWITHCODE_USER')
-    password = os.environ.get('PAPERSWITHCODE_PASS')
-    response = requests.get('https://paperswithcode.com/api/linkstars', auth=(user, password))
-    content = response.content.decode('utf-8')
-    f = StringIO(content)
-    data = csv.DictReader(f, escapechar='\\')
-    return data
+CREATE_STAGING_TABLE = '''
+CREATE TEMP TABLE paper_with_code_staging (
+    row_num serial, arxiv_id text, github_link text, url text, stars integer, framework text
+) ON COMMIT DROP
+'''
 
+# A paper may appear in several rows (one per repository). Like the per-row update did, the links come from the first
+# row of the paper and the stars from its last row. Only rows whose stars changed are updated
+UPSERT_QUERY = '''
+WITH staged AS (
+    SELECT DISTINCT ON (paper.id) paper.id AS paper_id, s.github_link, s.url, s.framework,
+           last_value(s.stars) OVER (PARTITION BY paper.id ORDER BY s.row_num
+                                     ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS stars
+    FROM paper_with_code_staging s JOIN paper ON paper.original_id = s.arxiv_id
+    ORDER BY paper.id, s.row_num
+), updated AS (
+    UPDATE paper_with_code SET stars = staged.stars, last_update_date = :now
+    FROM staged
+    WHERE paper_with_code.paper_id = staged.paper_id AND paper_with_code.stars IS DISTINCT FROM staged.stars
+    RETURNING paper_with_code.id
+), inserted AS (
+    INSERT INTO paper_with_code (paper_id, github_link, link, stars, framework, last_update_date)
+    SELECT staged.paper_id, LEFT(staged.github_link, 150), LEFT(COALESCE(staged.url, ''), 150), staged.stars,
+           LEFT(staged.framework, 50), :now
+    FROM staged
+    WHERE NOT EXISTS (SELECT 1 FROM paper_with_code WHERE paper_with_code.paper_id = staged.paper_id)
+    RETURNING paper_with_code.id
+)
+SELECT (SELECT count(*) FROM staged) AS matched, (SELECT count(*) FROM updated) AS updated,
+       (SELECT count(*) FROM inserted) AS inserted,
+       (SELECT count(*) FROM paper_with_code_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM paper WHERE paper.original_id = s.arxiv_id)) AS not_found
+'''
 
-def update_db(data):
-    now = datetime.utcnow()
+
+class CsvRowsFile:
+    """A read-only file object that renders rows as CSV lazily, so COPY can stream them"""
+
+    def __init__(self, rows: Iterable[list]):
+        self._rows = iter(rows)
+        self._buffer = StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def parse_stars(value) -> int:
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+
+def get_staging_rows(data: Iterable[dict]) -> Iterator[list]:
     for row in data:
-        try:
-            arxiv_id = row['arxiv_id']
-            paper = Paper.query.filter(Paper.original_id == arxiv_id).first()
-            if not paper:
-                logger.info(f'Paper not found - {arxiv_id}')
-                continue
-        except KeyError as e:
+        arxiv_id = row.get('arxiv_id')
+        if not arxiv_id:
             logger.warning(f'arxiv_id is missing for row {row}')
             continue
+        yield [arxiv_id, row.get('github_link'), row.get('url'), parse_stars(row.get('stars')), row.get('framework')]
+
 
-        stars = int(row.get('stars', 0))
-        if not paper.paper_with_code:
-            obj = PaperWithCode(paper_id=paper.id, github_link=row.get('github_link'), link=row.get(
-                'url', ''), stars=stars, framework=row.get('framework'), last_update_date=now)
-            db.session.add(obj)
-        else:
-            if paper.paper_with_code.stars != stars:
-                paper.paper_with_code.stars = stars
-                paper.paper_with_code.last_update_date = now
+def fetch_data() -> Iterator[dict]:
+    """Streams the dump and yields its rows, without holding the whole response in memory"""
+    user = os.environ.get('PAPERSWITHCODE_USER')
+    password = os.environ.get('PAPERSWITHCODE_PASS')
+    with requests.get('https://paperswithcode.com/api/linkstars', auth=(user, password), stream=True) as response:
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        # iter_lines decodes incrementally, so multi-byte characters split between chunks are handled
+        lines = response.iter_lines(decode_unicode=True)
+        yield from csv.DictReader(lines, escapechar='\\')
 
+
+def update_db(data) -> Dict[str, int]:
+    """Stages the rows with COPY and upserts them with a single statement, in a single transaction"""
+    now = datetime.utcnow()
+    try:
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute(CREATE_STAGING_TABLE)
+        rows = get_staging_rows(data)
+        num_rows = 0
+        while True:
+            chunk = list(islice(rows, COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            cursor.copy_expert(f'COPY paper_with_code_staging ({", ".join(STAGING_COLUMNS)}) FROM STDIN WITH CSV',
+                               CsvRowsFile(chunk))
+            num_rows += len(chunk)
+            logger.info(f'Staged {num_rows} rows')
+
+        result = db.session.execute(text(UPSERT_QUERY), {'now': now}).first()
         db.session.commit()
+    except Exception:
+        # A failed COPY (e.g. a broken download) leaves the transaction aborted for the next user of the session
+        db.session.rollback()
+        raise
+
+    counts = {'inserted': result.inserted, 'updated': result.updated,
+              'unchanged': result.matched - result.inserted - result.updated, 'not_found': result.not_found}
+    return counts
 
 
 @catch_exceptions(logger=logger)
@@ -52,5 +139,6 @@ def run():
     logger.info('Fetching data from papers with code')
     data = fetch_data()
     logger.info('Updating DB with data from papers with code')
-    update_db(data)
-    logger.info('Finished updating data from papers with code')
+    counts = update_db(data)
+    logger.info(f'Finished updating data from papers with code - {counts}')
+    return counts['inserted'] + counts['updated']
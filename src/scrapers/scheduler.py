@@ -0,0 +1,165 @@
+"""
+Runs the scrapers and the email outbox periodically, in place of a separate cron entry per CLI command.
+Every run is a separate process (`flask run-job`), so a long job does not delay the short ones, and a job that times
+out is killed together with all its threads.
+Several pods may run the scheduler - a Postgres advisory lock per job, held by the job process, makes sure only one of
+them runs it at a time. The lock is released by Postgres when the process exits or is killed.
+"""
+import inspect
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import schedule
+from sqlalchemy import text
+
+from ..models import JobStatus, db
+from ..routes.notifications import digest
+from . import arxiv, paperswithcode, twitter
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 10
+KILL_GRACE_SECONDS = 30
+
+
+class Job(NamedTuple):
+    name: str
+    func: Callable[[], Optional[int]]  # Returns the number of items processed
+    interval_minutes: int
+    jitter_minutes: int
+    timeout_minutes: int
+
+
+JOBS = [
+    Job('fetch-arxiv', arxiv.fetch_papers, interval_minutes=6 * 60, jitter_minutes=30, timeout_minutes=2 * 60),
+    Job('fetch-paperswithcode', paperswithcode.run, interval_minutes=24 * 60, jitter_minutes=60, timeout_minutes=60),
+    Job('fetch-twitter', twitter.main_twitter_fetcher, interval_minutes=30, jitter_minutes=5, timeout_minutes=20),
+    Job('decay-twitter-scores', twitter.update_twitter_scores, interval_minutes=6 * 60, jitter_minutes=30,
+        timeout_minutes=30),
+    Job('send-emails', digest.send_pending_notifications, interval_minutes=5, jitter_minutes=0, timeout_minutes=5),
+]
+
+
+def get_lock_key(name: str) -> int:
+    return zlib.crc32(f'scheduler:{name}'.encode())
+
+
+def is_due(job: Job) -> bool:
+    status = JobStatus.query.get(job.name)
+    if not status or not status.last_start_date:
+        return True
+    return status.last_start_date < datetime.now(timezone.utc) - timedelta(minutes=job.interval_minutes)
+
+
+def save_status(job: Job, start_date: datetime, result: str, items_processed: Optional[int] = None,
+                error: Optional[str] = None):
+    end_date = datetime.now(timezone.utc)
+    db.session.merge(JobStatus(name=job.name, last_start_date=start_date, last_end_date=end_date,
+                               last_duration=(end_date - start_date).total_seconds(), last_result=result,
+                               last_error=error, items_processed=items_processed))
+    db.session.commit()
+
+
+def get_job(name: str) -> Job:
+    return next(job for job in JOBS if job.name == name)
+
+
+def run_job(job: Job):
+    """Runs the job in the current process, unless it is running elsewhere"""
+    # The lock is held by a dedicated connection, and released by Postgres if the process dies
+    with db.engine.connect() as lock_connection:
+        key = get_lock_key(job.name)
+        if not lock_connection.execute(text('SELECT pg_try_advisory_lock(:key)'), key=key).scalar():
+            logger.info(f'Job {job.name} is already running elsewhere, skipping')
+            return
+        try:
+            start_date = datetime.now(timezone.utc)
+            logger.info(f'Starting job {job.name}')
+            # The scrapers catch and log their own exceptions, we call the undecorated function to record failures
+            func = inspect.unwrap(job.func)
+            try:
+                items_processed = func()
+            except Exception as e:
+                db.session.rollback()
+                logger.exception(f'Job {job.name} failed')
+                save_status(job, start_date, 'failed', error=str(e))
+                return
+
+            save_status(job, start_date, 'success', items_processed=items_processed)
+            logger.info(f'Finished job {job.name} - {items_processed} items processed')
+        finally:
+            lock_connection.execute(text('SELECT pg_advisory_unlock(:key)'), key=key)
+
+
+class JobProcess(NamedTuple):
+    job: Job
+    process: subprocess.Popen
+    start_date: datetime
+
+
+running_jobs: Dict[str, JobProcess] = {}
+
+
+def start_job(job: Job):
+    running = running_jobs.get(job.name)
+    if running and running.process.poll() is None:
+        logger.warning(f'Job {job.name} is still running, skipping this run')
+        return
+    # The job processes do not need eventlet, their threads and DB calls run in parallel without it
+    env = {**os.environ, 'DISABLE_MONKEY_PATCH': '1'}
+    # A new session (process group) lets us kill the job together with any process it started
+    process = subprocess.Popen([sys.executable, '-m', 'flask', 'run-job', job.name], env=env, start_new_session=True)
+    running_jobs[job.name] = JobProcess(job, process, datetime.now(timezone.utc))
+
+
+def stop_process(process: subprocess.Popen):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(KILL_GRACE_SECONDS)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def check_running_jobs():
+    now = datetime.now(timezone.utc)
+    for name, running in list(running_jobs.items()):
+        if running.process.poll() is not None:
+            # The job process records its own result
+            if running.process.returncode != 0:
+                logger.error(f'Job {name} exited with code {running.process.returncode}')
+            del running_jobs[name]
+        elif now - running.start_date > timedelta(minutes=running.job.timeout_minutes):
+            logger.error(f'Job {name} timed out after {running.job.timeout_minutes} minutes, stopping it')
+            stop_process(running.process)
+            del running_jobs[name]
+            save_status(running.job, running.start_date, 'timeout')
+
+
+def run(job_names: Optional[List[str]] = None, run_once=False):
+    jobs = [job for job in JOBS if not job_names or job.name in job_names]
+    # Jobs that were due while the scheduler was down (e.g. during a deploy) run right away
+    for job in jobs:
+        if run_once or is_due(job):
+            start_job(job)
+    if run_once:
+        while running_jobs:
+            time.sleep(POLL_SECONDS)
+            check_running_jobs()
+        return
+
+    for job in jobs:
+        # A random interval in the range spreads the runs of the different pods and jobs
+        schedule.every(job.interval_minutes).to(job.interval_minutes + job.jitter_minutes).minutes.do(start_job, job)
+    logger.info(f'Scheduled jobs - {", ".join(job.name for job in jobs)}')
+    while True:
+        schedule.run_pending()
+        check_running_jobs()
+        time.sleep(POLL_SECONDS)
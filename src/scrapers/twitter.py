@@ -8,18 +8,32 @@ import logging
 import math
 import os
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
+from typing import Callable, Dict, List, Optional, Tuple
 
 import pytz
 import tweepy
-from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
 from ..models import Paper, Tweet, db
-from .utils import catch_exceptions
+from .utils import RateLimiter, catch_exceptions, get_scraper_state, set_scraper_state
 
 # settings
 # -----------------------------------------------------------------------------
 sleep_time = 60 * 15  # in seconds, between twitter API calls. Default rate limit is 180 per 15 minutes
 max_tweet_records = 15
+# Reply counting shares the search rate limit (180 per 15 minutes) with the main query, we keep a margin for it
+max_reply_searches = 150
+reply_search_workers = 4
+reply_searches_per_second = 1
+max_search_pages = 10  # Pages of 100 tweets we follow back to the last seen tweet on each run
+max_retries = 5
+backoff_base = 2  # in seconds, doubled on every failed attempt
+user_timeline_workers = 4
+user_timelines_per_second = 1.5  # The app rate limit is 1500 per 15 minutes
+STATE_NAME = 'twitter'
 
 logger = logging.getLogger(__name__)
 
@@ -47,131 +61,310 @@ def extract_arxiv_pids(r):
     return pids
 
 
-def get_latest_or_loop(api, q):
-    results = None
-    while results is None:
+def call_with_backoff(func: Callable, **kwargs):
+    """Retries the API call with exponential backoff, and raises after max_retries failed attempts"""
+    for attempt in range(max_retries):
         try:
-            results = api.search(q=q, count=100, result_type="mixed", tweet_mode='extended')
+            return func(**kwargs)
         except Exception as e:
-            logger.info('there was some problem (waiting some time and trying again):')
-            logger.error(e)
+            if attempt == max_retries - 1:
+                raise
+            wait_time = backoff_base * 2 ** attempt
+            logger.warning(f'Twitter API call failed, retrying in {wait_time} seconds - {e}')
+            sleep(wait_time)
+
+
+def search_since(api, q: str, since_id: Optional[str]) -> list:
+    """Fetches the tweets newer than since_id, newest first. Without since_id only the latest page is fetched"""
+    results = []
+    max_id = None
+    for _ in range(max_search_pages if since_id else 1):
+        page = call_with_backoff(api.search, q=q, count=100, result_type='recent', tweet_mode='extended',
+                                 since_id=since_id, max_id=max_id)
+        results += page
+        if len(page) < 100:
+            break
+        max_id = min(t.id for t in page) - 1
+    else:
+        if since_id:
+            logger.warning(f'Reached {max_search_pages} pages before tweet {since_id}, older tweets are skipped')
 
-    logger.info('Fetched results')
+    logger.info(f'Fetched {len(results)} results')
     return results
 
 
+def get_max_id(tweets: list, default: Optional[str] = None) -> Optional[str]:
+    ids = [t.id for t in tweets] + ([int(default)] if default else [])
+    return str(max(ids)) if ids else None
+
+
 epochd = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)  # time of epoch
 
 
+# Decay parameters - see get_age_decay
+DECAY_SCALE = 7  # The distance from origin at which the computed factor will equal decay parameter
+DECAY = 0.5  # Defines the score at scale compared to zero (better to update only the scale and keep it fixed
+DECAY_OFFSET = 2  # the decay function will only compute the decay function for post with a distance greater
+DECAY_TIME_FACTOR = 0.75  # Reduce the decay over time by taking the TIME FACTOR power of the time value
+DECAY_GAMMA = math.log(DECAY) / DECAY_SCALE
+SCORE_WINDOW_DAYS = 180  # Older tweets are worth less than 1% of their original score, we drop them altogether
+
+# The SQL version of get_tweet_score, used by the periodic decay pass and the full recomputation
+TWEET_SCORE_SQL = '''
+CASE WHEN extract(epoch FROM (:now - tweet.creation_date)) / 86400 > :window THEN 0
+ELSE floor((coalesce(tweet.likes, 0) + 2 * coalesce(tweet.retweets, 0) + 4 * coalesce(tweet.replies, 0)) *
+    CASE WHEN extract(epoch FROM (:now - tweet.creation_date)) / 86400 <= :offset THEN 1
+    ELSE exp(:gamma * power(extract(epoch FROM (:now - tweet.creation_date)) / 86400, :time_factor)) END + 0.5)
+END
+'''
+
+# Scores are rounded integers, most of the older tweets keep their score between passes and are not rewritten
+DECAY_TWEETS_QUERY = f'''
+UPDATE tweet SET score = decayed.score
+FROM (SELECT tweet.id, {TWEET_SCORE_SQL} AS score FROM tweet
+      WHERE (tweet.score IS NULL OR tweet.score > 0) AND tweet.paper_id IS NOT NULL) decayed
+WHERE tweet.id = decayed.id AND tweet.score IS DISTINCT FROM decayed.score
+RETURNING tweet.paper_id
+'''
+
+REFRESH_PAPER_SCORES_QUERY = '''
+UPDATE paper SET twitter_score = totals.score
+FROM (SELECT paper_id, sum(score) AS score FROM tweet WHERE paper_id = ANY(:paper_ids) GROUP BY paper_id) totals
+WHERE paper.id = totals.paper_id AND paper.twitter_score IS DISTINCT FROM totals.score
+'''
+
+FULL_SCORES_QUERY = f'''
+SELECT paper.id, paper.twitter_score, sum({TWEET_SCORE_SQL}) AS expected
+FROM paper JOIN tweet ON tweet.paper_id = paper.id
+GROUP BY paper.id
+'''
+
+ADD_SCORE_DELTA_QUERY = 'UPDATE paper SET twitter_score = coalesce(twitter_score, 0) + :delta WHERE id = :paper_id'
+
+
 def get_age_decay(age):
     """
     Calc Gauss decay factor - based on elastic search decay function
-    :param age: age in hours
+    :param age: age in days
     :return: decay factor
     """
-    SCALE = 7  # The distance from origin at which the computed factor will equal decay parameter
-    DECAY = 0.5  # Defines the score at scale compared to zero (better to update only the scale and keep it fixed
-    OFFSET = 2  # the decay function will only compute the decay function for post with a distance greater
-    TIME_FACTOR = 0.75  # Reduce the decay over time by taking the TIME FACTOR power of the time value
-
-    if age <= OFFSET:
+    if age <= DECAY_OFFSET:
         return 1
-    gamma = math.log(DECAY) / SCALE
-    return math.exp(gamma * (age ** TIME_FACTOR))
+    return math.exp(DECAY_GAMMA * (age ** DECAY_TIME_FACTOR))
 
 
-def summarize_tweets(papers_to_update):
-    papers_to_update = list(set(papers_to_update))
-    papers_tweets = a = db.session.query(Paper).join(Tweet).with_entities(Paper, func.sum(Tweet.likes + 2 * Tweet.retweets +
-                                                                                          4 * Tweet.replies)).filter(Paper.id.in_(papers_to_update)).group_by(Paper.id).all()
-    for paper, score in papers_tweets:
-        paper.twitter_score = score
+def get_decay_params(now: datetime.datetime) -> dict:
+    return dict(now=now, window=SCORE_WINDOW_DAYS, offset=DECAY_OFFSET, gamma=DECAY_GAMMA, time_factor=DECAY_TIME_FACTOR)
 
+
+def get_tweet_score(row: dict, now: datetime.datetime) -> int:
+    age = (now - row['creation_date']).total_seconds() / 86400
+    if age > SCORE_WINDOW_DAYS:
+        return 0
+    raw_score = (row['likes'] or 0) + 2 * (row['retweets'] or 0) + 4 * (row['replies'] or 0)
+    return int(math.floor(raw_score * get_age_decay(age) + 0.5))
+
+
+def apply_score_deltas(rows: List[dict]):
+    """Adds the difference between the new and the stored score of each tweet to its paper"""
+    stored = {t.id: t for t in db.session.query(Tweet.id, Tweet.paper_id, Tweet.score).filter(
+        Tweet.id.in_([r['id'] for r in rows])).all()}
+    deltas = defaultdict(int)
+    for row in rows:
+        deltas[row['paper_id']] += row['score']
+        old = stored.get(row['id'])
+        if old and old.score:
+            deltas[old.paper_id] -= old.score
+    deltas = [{'paper_id': paper_id, 'delta': delta} for paper_id, delta in deltas.items() if delta and paper_id]
+    if deltas:
+        db.session.execute(text(ADD_SCORE_DELTA_QUERY), deltas)
+
+
+def apply_score_decay(now: Optional[datetime.datetime] = None) -> int:
+    """Decays the score of all the tweets in the scoring window and refreshes the score of their papers"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    paper_ids = {r.paper_id for r in db.session.execute(text(DECAY_TWEETS_QUERY), get_decay_params(now))}
+    if paper_ids:
+        db.session.execute(text(REFRESH_PAPER_SCORES_QUERY), {'paper_ids': list(paper_ids)})
     db.session.commit()
+    logger.info(f'Decayed twitter score of {len(paper_ids)} papers')
+    return len(paper_ids)
 
 
-def fetch_twitter_users(api, usernames):
+@catch_exceptions(logger=logger)
+def update_twitter_scores(verify=False, fix=False):
+    """
+    Runs the decay pass, as its own scheduled job - the scale of the decay is days, so a few passes a day are enough.
+    Between the passes, new tweets are scored at their insertion time and the older ones at the last pass.
+    With verify, compares the incremental scores to a full recomputation from the tweets
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    num_papers = apply_score_decay(now)
+    if not verify:
+        return num_papers
+
+    results = db.session.execute(text(FULL_SCORES_QUERY), get_decay_params(now)).fetchall()
+    mismatches = [r for r in results if (r.twitter_score or 0) != r.expected]
+    logger.info(f'Verified twitter score of {len(results)} papers - {len(mismatches)} mismatches')
+    for r in mismatches[:20]:
+        logger.warning(f'Paper {r.id} - score is {r.twitter_score}, expected {r.expected}')
+    if fix and mismatches:
+        db.session.execute(text('UPDATE paper SET twitter_score = :expected WHERE id = :id'),
+                           [{'id': r.id, 'expected': r.expected} for r in mismatches])
+        db.session.commit()
+    return num_papers
+
+
+def fetch_user_timeline(api, screen_name: str, since_id: Optional[str], rate_limiter: RateLimiter) -> list:
+    rate_limiter.wait()
+    try:
+        return call_with_backoff(api.user_timeline, screen_name=screen_name, count=100, tweet_mode='extended',
+                                 since_id=since_id)
+    except Exception as e:
+        logger.warning(f'Failed to fetch tweets from {screen_name} - {e}')
+        return []
+
+
+def fetch_twitter_users(api, usernames, since_ids: Dict[str, str]) -> Tuple[list, Dict[str, str]]:
+    """Fetches the new tweets of every user concurrently. Returns the tweets and the updated since ids"""
     logger.info('Fetching tweets from users list')
+    rate_limiter = RateLimiter(user_timelines_per_second)
+    screen_names = [u['screen_name'] for u in usernames]
     tweets = []
-    for idx, u in enumerate(usernames):
-        try:
-            tweets += api.user_timeline(screen_name=u['screen_name'], count=100, tweet_mode='extended')
-            # if idx > 3:
-            #     break
-        except Exception as e:
-            logger.warning(f'Failed to fetch tweets from {u["screen_name"]}')
-        sleep(1)
+    new_since_ids = dict(since_ids)
+    with ThreadPoolExecutor(max_workers=user_timeline_workers) as executor:
+        futures = {name: executor.submit(fetch_user_timeline, api, name, since_ids.get(name), rate_limiter)
+                   for name in screen_names}
+        for name, future in futures.items():
+            user_tweets = future.result()
+            tweets += user_tweets
+            new_since_ids[name] = get_max_id(user_tweets, since_ids.get(name))
     logger.info('Finished fetching tweets from users list')
-    return tweets
+    return tweets, {name: since_id for name, since_id in new_since_ids.items() if since_id}
 
 
-def fetch_tweets(api):
+def fetch_tweets(api, state: dict) -> Tuple[list, dict]:
+    """Fetches the tweets we haven't seen yet. Returns the tweets and the state to store once they are processed"""
     logger.info('Fetching tweets')
     # fetch the latest mentioning arxiv.org
-    results = get_latest_or_loop(api, 'arxiv.org')
+    search_since_id = state.get('search_since_id')
+    results = search_since(api, 'arxiv.org', search_since_id)
+    new_state = dict(state, search_since_id=get_max_id(results, search_since_id))
 
     if os.path.isfile(USERS_FILENAME):
         usernames = json.load(open(USERS_FILENAME, 'r'))
-        # results += fetch_twitter_users(api, usernames)
+        user_tweets, new_state['users_since_id'] = fetch_twitter_users(api, usernames, state.get('users_since_id', {}))
+        results += user_tweets
     else:
         logger.warning('Users file is missing')
-    return results
+    return results, new_state
 
 
-def create_tweet(r, paper, dnow_utc, num_replies):
+def get_tweet_row(r, paper_id, dnow_utc, num_replies) -> dict:
     creation_date = r.created_at.replace(tzinfo=pytz.UTC)
-    tweet = Tweet(id=r.id_str, paper=paper, insertion_date=dnow_utc, creation_date=creation_date, lang=r.lang, text=r.full_text, retweets=r.retweet_count, likes=r.favorite_count,
-                  replies=num_replies, user_screen_name=r.author.screen_name, user_name=r.author.name, user_followers_count=r.author.followers_count, user_following_count=r.author.friends_count)
-    db.session.merge(tweet)
+    return dict(id=r.id_str, paper_id=paper_id, insertion_date=dnow_utc, creation_date=creation_date, lang=r.lang,
+                text=r.full_text, retweets=r.retweet_count, likes=r.favorite_count, replies=num_replies,
+                user_screen_name=r.author.screen_name, user_name=r.author.name,
+                user_followers_count=r.author.followers_count, user_following_count=r.author.friends_count)
+
+
+def upsert_tweets(rows: List[dict], now: Optional[datetime.datetime] = None):
+    if not rows:
+        return
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    for row in rows:
+        row['score'] = get_tweet_score(row, now)
+    # Deltas are computed against the stored scores, before they are overwritten
+    apply_score_deltas(rows)
+    stmt = insert(Tweet.__table__).values(rows)
+    updated_columns = {c: stmt.excluded[c] for c in rows[0] if c != 'id'}
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['id'], set_=updated_columns))
     db.session.commit()
-    return tweet
 
 
-def find_num_replies(api, t):
+def search_author_replies(api, screen_name: str, tweets: list, rate_limiter: RateLimiter) -> Dict[str, int]:
+    """
+    Counts the replies of other users to the given tweets of an author, with a single search.
+    Only returns the counts of tweets with replies in the search: it goes back a week at most, and a full page may not
+    reach the oldest tweets
+    """
+    rate_limiter.wait()
+    tweet_ids = {t.id_str for t in tweets}
+    since_id = min(tweets, key=lambda t: t.id).id_str
     try:
-        replies = api.search(q=f'to:{t.author.screen_name}', since_id=t.id_str, count=100)
-        def filter_func(x): return x.in_reply_to_status_id_str == t.id_str and x.author.screen_name != t.author.screen_name
-        rel_replies = list(filter(filter_func, replies))
-        return len(rel_replies)
+        replies = api.search(q=f'to:{screen_name}', since_id=since_id, count=100)
     except Exception as e:
-        logger.error(f'Failed to fetch replies for tweet - {t.id_str} - {e}')
-        return 0
+        logger.error(f'Failed to fetch replies for user - {screen_name} - {e}')
+        return {}
+
+    # The page holds the newest replies, a full one only has all the replies of the tweets newer than its oldest reply
+    covered_id = min(reply.id for reply in replies) if len(replies) >= 100 else 0
+    counts = defaultdict(int)
+    for reply in replies:
+        if reply.in_reply_to_status_id_str in tweet_ids and reply.author.screen_name != screen_name:
+            counts[reply.in_reply_to_status_id_str] += 1
+    return {tweet_id: count for tweet_id, count in counts.items() if int(tweet_id) >= covered_id}
+
+
+def count_replies(api, tweets: list) -> Dict[str, int]:
+    """
+    Runs one search per author, up to max_reply_searches authors (most tweets first).
+    Tweets the searches did not count keep the count we stored before, if any
+    """
+    tweets_by_author = defaultdict(list)
+    for t in tweets:
+        tweets_by_author[t.author.screen_name].append(t)
+    authors = sorted(tweets_by_author, key=lambda a: len(tweets_by_author[a]), reverse=True)
+    searched, skipped = authors[:max_reply_searches], authors[max_reply_searches:]
+    if skipped:
+        logger.info(f'Reply search budget exceeded, using stored counts for {len(skipped)} users')
+
+    counts = dict(db.session.query(Tweet.id, Tweet.replies).filter(Tweet.id.in_([t.id_str for t in tweets])).all())
+    rate_limiter = RateLimiter(reply_searches_per_second)
+    with ThreadPoolExecutor(max_workers=reply_search_workers) as executor:
+        futures = [executor.submit(search_author_replies, api, a, tweets_by_author[a], rate_limiter) for a in searched]
+        for future in futures:
+            counts.update(future.result())
+    return counts
 
 
 def process_tweets(api, tweets_raw_data):
     logger.info('Process tweets')
     dnow_utc = datetime.datetime.now(datetime.timezone.utc)
-    num_new = 0
-    papers_to_update = []
-    unique_tweet_ids = set()
+    tweets = {}
+    tweet_pids = {}
 
     for r in tweets_raw_data:
         if hasattr(r, 'retweeted_status'):
             # logger.info('Tweet is a retweet')
             r = r.retweeted_status
 
-        if r.id_str in unique_tweet_ids:
+        if r.id_str in tweets:
             continue
 
         arxiv_pids = extract_arxiv_pids(r)
         if not arxiv_pids:
             continue
-
-        paper = Paper.query.filter(Paper.original_id.in_(arxiv_pids)).first()
-        if not paper:
-            logger.info(f'No Arxiv pid found in DB - tweet {r.id_str}')
+        tweets[r.id_str] = r
+        tweet_pids[r.id_str] = arxiv_pids
+
+    all_pids = {pid for pids in tweet_pids.values() for pid in pids}
+    paper_ids = dict(db.session.query(Paper.original_id, Paper.id).filter(Paper.original_id.in_(all_pids)).all()) \
+        if all_pids else {}
+
+    matched = []
+    for tweet_id, pids in tweet_pids.items():
+        paper_id = next((paper_ids[pid] for pid in pids if pid in paper_ids), None)
+        if not paper_id:
+            logger.info(f'No Arxiv pid found in DB - tweet {tweet_id}')
             continue
+        matched.append((tweets[tweet_id], paper_id))
 
-        papers_to_update.append(paper.id)
-
-        num_replies = find_num_replies(api, r)
-        tweet = create_tweet(r, paper, dnow_utc, num_replies)
-
-        unique_tweet_ids.add(r.id_str)
-        logger.info(f'Found tweet for {paper.id} with {tweet.likes} likes')
+    num_replies = count_replies(api, [r for r, _ in matched]) if matched else {}
+    upsert_tweets([get_tweet_row(r, paper_id, dnow_utc, num_replies.get(r.id_str) or 0) for r, paper_id in matched])
 
-    logger.info(f'processed {len(tweets_raw_data)} new tweets')
-    return papers_to_update
+    logger.info(f'processed {len(tweets_raw_data)} new tweets, {len(matched)} tweets about known papers')
+    return [paper_id for _, paper_id in matched]
 
 
 @catch_exceptions(logger=logger)
@@ -180,6 +373,8 @@ def main_twitter_fetcher():
     if not api:
         logger.error('Twitter API keys are missing. Skipping')
         return
-    tweets = fetch_tweets(api)
-    papers_to_update = process_tweets(api, tweets)
-    summarize_tweets(papers_to_update)
+    tweets, new_state = fetch_tweets(api, get_scraper_state(STATE_NAME, {}))
+    stored_tweets = process_tweets(api, tweets)
+    # Only move the checkpoint once the tweets are stored, a failed run will fetch them again
+    set_scraper_state(STATE_NAME, new_state)
+    return len(stored_tweets)
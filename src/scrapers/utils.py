@@ -1,10 +1,17 @@
+import copy
+import functools
 import re
-from typing import Tuple
+import threading
+import time
+from typing import Any, Tuple
+
+from ..models import ScraperState, db
 
 
 def catch_exceptions(logger):
     def decorator(func):
 
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
@@ -26,3 +33,69 @@ def parse_arxiv_url(url: str) -> Tuple[str, int]:
     """
     match = re.search(r"/(?P<id>(\d{4}\.\d{4,5})|([a-zA-Z\-.]+/\d{6,10}))(v(?P<version>\d+))?", url)
     return match.group('id').replace('/', '_'), int(match.group('version') or 0)
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket - no more than `max_per_second` calls go through on average, with bursts of up to
+    `burst` calls after a quiet period
+    """
+
+    def __init__(self, max_per_second: float, burst: float = 1):
+        self._rate = max_per_second
+        self._capacity = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def wait(self):
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self._rate
+            time.sleep(wait_time)
+
+
+class ProgressReporter:
+    """Logs throughput and ETA of a long running job"""
+
+    def __init__(self, logger, total: int, report_every: int = 50):
+        self._logger = logger
+        self._total = total
+        self._report_every = report_every
+        self._start = time.monotonic()
+        self.processed = 0
+
+    def advance(self, count: int = 1):
+        previous = self.processed
+        self.processed += count
+        if previous // self._report_every != self.processed // self._report_every or self.processed == self._total:
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self._start
+        rate = self.processed / elapsed if elapsed else 0
+        remaining = max(self._total - self.processed, 0)
+        eta = remaining / rate if rate else float('inf')
+        self._logger.info(f'Processed {self.processed}/{self._total} - {rate:.2f} items/sec - ETA {eta:.0f} seconds')
+
+
+def get_scraper_state(name: str, default: Any = None) -> Any:
+    state = ScraperState.query.get(name)
+    # JSON values are not tracked for in-place changes, callers get a copy they can modify and store again
+    return copy.deepcopy(state.value) if state and state.value is not None else default
+
+
+def set_scraper_state(name: str, value: Any):
+    db.session.merge(ScraperState(name=name, value=value))
+    db.session.commit()
@@ -1,11 +1,12 @@
 import logging
 
+from flask import request
 from flask_jwt_extended.view_decorators import jwt_optional
-from flask_socketio import SocketIO, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 
-from .routes.paper_query_utils import get_paper_or_none
-from .routes.permissions_utils import enforce_permissions_to_paper
-from .routes.user_utils import get_user_optional
+from . import presence
+from .routes.permissions_utils import can_access_paper, get_paper_access
+from .routes.user_utils import get_jwt_email
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +23,26 @@ def setup_websocket(socketio_app: SocketIO):
         token = data.get('token')
         if not paper_id:
             logger.warning('paperId is missing')
+            emit('join_error', {'paperId': paper_id, 'message': 'paperId is missing'})
             return
-        current_user = get_user_optional()
-        paper = get_paper_or_none(paper_id)
-        if not paper:
+        # Clients rejoin on every reconnect, so the access check avoids loading the paper and is mostly cached
+        access = get_paper_access(paper_id)
+        if not access:
             logger.warning(f'paper not found - {paper_id}')
+            emit('join_error', {'paperId': paper_id, 'message': 'Paper not found'})
+            return
+        if not can_access_paper(access, get_jwt_email(), token=token):
+            logger.warning(f'Missing permissions to join paper - {paper_id}')
+            emit('join_error', {'paperId': paper_id, 'message': 'Missing paper permissions'})
             return
-        enforce_permissions_to_paper(paper, current_user, token=token)
         join_room(paper_id)
+        presence.join(paper_id, request.sid)
+
+    @socketio_app.on('heartbeat')
+    def on_heartbeat(data):
+        paper_id = data.get('paperId')
+        if paper_id and paper_id in rooms():
+            presence.heartbeat(paper_id, request.sid)
 
     @socketio_app.on('leave')
     def on_leave(data):
@@ -38,3 +51,10 @@ def setup_websocket(socketio_app: SocketIO):
             logger.warning('paperId is missing')
             return
         leave_room(paper_id)
+        presence.leave(paper_id, request.sid)
+
+    @socketio_app.on('disconnect')
+    def on_disconnect():
+        for room in rooms():
+            if room != request.sid:
+                presence.leave(room, request.sid)
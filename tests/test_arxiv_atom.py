@@ -0,0 +1,33 @@
+import feedparser
+
+from src.scrapers.arxiv import encode_feedparser_dict, get_author_names, get_paper_fields, parse_entry
+from src.scrapers.arxiv_atom import parse_entries
+
+from .conftest import read_fixture
+
+# Derived fields feedparser adds on top of the feed, which nothing reads
+FEEDPARSER_ONLY_FIELDS = {'guidislink', 'title_detail', 'summary_detail', 'published_parsed', 'updated_parsed'}
+
+
+def test_parse_entries_matches_feedparser():
+    content = read_fixture('arxiv_feed.xml')
+    expected = [encode_feedparser_dict(e) for e in feedparser.parse(content).entries]
+    entries = parse_entries(content)
+
+    assert len(entries) == len(expected) == 4
+    for entry, feedparser_entry in zip(entries, expected):
+        for field in FEEDPARSER_ONLY_FIELDS:
+            feedparser_entry.pop(field, None)
+        assert entry == feedparser_entry
+
+
+def test_parse_entry_matches_feedparser():
+    content = read_fixture('arxiv_feed.xml')
+    for entry, feedparser_entry in zip(parse_entries(content), feedparser.parse(content).entries):
+        paper_data, feedparser_paper_data = parse_entry(entry), parse_entry(feedparser_entry)
+        if feedparser_paper_data is None:
+            assert paper_data is None
+            continue
+        assert get_paper_fields(paper_data) == get_paper_fields(feedparser_paper_data)
+        assert get_author_names(paper_data) == get_author_names(feedparser_paper_data)
+        assert paper_data['tags'] == feedparser_paper_data['tags']
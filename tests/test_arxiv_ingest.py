@@ -0,0 +1,114 @@
+from sqlalchemy import event
+from sqlalchemy_continuum import version_class
+
+from src.models import Author, Paper, Tag, db
+from src.scrapers import arxiv
+from src.scrapers.arxiv import get_or_create_ids, ingest_entries
+from src.scrapers.arxiv_atom import parse_entries
+from src.scrapers.utils import get_scraper_state, set_scraper_state
+
+from .conftest import read_fixture
+
+
+def get_entries():
+    return parse_entries(read_fixture('arxiv_feed.xml'))
+
+
+def test_ingest_entries_adds_papers_authors_and_tags():
+    num_added, num_skipped = ingest_entries(get_entries())
+    assert (num_added, num_skipped) == (3, 1)
+
+    paper = Paper.query.filter(Paper.original_id == '2009.05387').one()
+    assert paper.doi == '10.18653/v1/2020.emnlp-main.1'
+    assert sorted(a.name for a in paper.authors) == ['Ahmed Hassan', 'Maria Gonzalez', 'Wei Chen']
+    assert sorted(t.name for t in paper.tags) == ['cs.CL', 'cs.IR']
+    # Shared authors and tags are created once
+    assert Author.query.filter(Author.name == 'Wei Chen').count() == 1
+    assert sorted(t.name for t in Tag.query) == ['cond-mat.str-el', 'cs.CL', 'cs.IR', 'cs.LG']
+
+
+def test_ingest_entries_versions_papers():
+    ingest_entries(get_entries())
+    entries = get_entries()
+    entries[0]['updated'] = '2020-09-13T10:00:00Z'
+    entries[0]['title'] = 'A New Title'
+    assert ingest_entries(entries) == (1, 3)
+
+    paper = Paper.query.filter(Paper.original_id == '2009.05387').one()
+    assert paper.title == 'A New Title'
+    PaperVersion = version_class(Paper)
+    versions = PaperVersion.query.filter(PaperVersion.id == paper.id).order_by(PaperVersion.transaction_id).all()
+    assert [v.title for v in versions][-1] == 'A New Title'
+    assert len(versions) == 2
+
+
+def test_get_or_create_ids_skips_names_created_by_another_transaction():
+    existing = get_or_create_ids(Tag, ['cs.CL'], source='arXiv')
+    db.session.commit()
+    other_connection = db.engine.connect()
+    inserted = []
+
+    # Another writer commits cs.LG right after our select, our insert must skip it instead of failing
+    def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+        if conn is not other_connection and statement.startswith('SELECT') and not inserted:
+            inserted.append(True)
+            other_connection.execute(Tag.__table__.insert().values(name='cs.LG', source='arXiv'))
+
+    event.listen(db.engine, 'after_cursor_execute', insert_concurrently)
+    try:
+        ids = get_or_create_ids(Tag, ['cs.CL', 'cs.LG', 'cs.AI'], source='arXiv')
+    finally:
+        event.remove(db.engine, 'after_cursor_execute', insert_concurrently)
+        other_connection.close()
+    db.session.commit()
+    assert ids['cs.CL'] == existing['cs.CL']
+    assert ids == dict(db.session.query(Tag.name, Tag.id))
+
+
+def test_harvest_resumes_and_stops_when_caught_up(app, monkeypatch):
+    requested = []
+
+    def fetch_feed(query):
+        requested.append(query)
+        return read_fixture('arxiv_feed.xml')
+
+    monkeypatch.setattr(arxiv, 'fetch_feed', fetch_feed)
+    # The second page has the same papers, so the harvest is caught up
+    num_added = arxiv.fetch_papers(max_index=20, results_per_iteration=4, wait_time=0.01, num_workers=1, queue_size=1)
+    assert num_added == 3
+    assert Paper.query.count() == 3
+    assert get_scraper_state(arxiv.HARVEST_STATE_NAME) is None
+
+    requested.clear()
+    set_scraper_state(arxiv.HARVEST_STATE_NAME, {'query': arxiv.DEF_QUERY, 'next_index': 8})
+    arxiv.fetch_papers(max_index=20, results_per_iteration=4, wait_time=0.01, num_workers=2, queue_size=2)
+    assert 'start=8&' in requested[0]
+
+
+def test_fetch_entry_ingests_the_paper(monkeypatch):
+    requested = []
+
+    def fetch_feed(query):
+        requested.append(query)
+        return read_fixture('arxiv_feed.xml')
+
+    monkeypatch.setattr(arxiv, 'fetch_feed', fetch_feed)
+    paper = arxiv.fetch_entry('2009.05387')
+    assert requested == ['id_list=2009.05387']
+    assert paper.original_id == '2009.05387'
+    assert sorted(t.name for t in paper.tags) == ['cs.CL', 'cs.IR']
+    assert len(paper.authors) == 3
+
+    # Stored versions older than the feed are updated, even when the paper was published before the stored update
+    paper.title = 'An Old Title'
+    paper.last_update_date = paper.publication_date
+    db.session.commit()
+    assert arxiv.fetch_entry('2009.05387').title.startswith('Cross-lingual Transfer')
+
+
+def test_fetch_entry_skips_papers_without_a_pdf(monkeypatch):
+    entries = get_entries()
+    monkeypatch.setattr(arxiv, 'fetch_feed', lambda query: b'')
+    monkeypatch.setattr(arxiv, 'parse_entries', lambda content: entries[3:])
+    assert arxiv.fetch_entry('2009.03300') is None
+    assert Paper.query.count() == 0
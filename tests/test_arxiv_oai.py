@@ -0,0 +1,100 @@
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from src.models import ArxivPaper, Paper
+from src.scrapers import arxiv_oai
+from src.scrapers.utils import get_scraper_state, set_scraper_state
+
+from .conftest import read_fixture
+
+
+class OAIServer:
+    """Replays recorded OAI-PMH responses, picked by the resumption token or the from date of the request"""
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.num_unavailable = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+                server.requests.append(params)
+                if server.num_unavailable:
+                    server.num_unavailable -= 1
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                    self.end_headers()
+                    return
+                content = read_fixture(server.responses[params.get('resumptionToken') or params['from']])
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/oai2'
+
+
+@pytest.fixture
+def oai_server(monkeypatch):
+    server = OAIServer()
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(arxiv_oai, 'OAI_URL', server.url)
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+def test_harvests_the_list_and_stores_the_watermark(oai_server):
+    oai_server.responses = {'2020-09-10': 'oai_list_records_1.xml', '6961467|1001': 'oai_list_records_2.xml'}
+    oai_server.num_unavailable = 1
+    arxiv_oai.run(sets=['cs'], from_date='2020-09-10')
+
+    assert [r.get('resumptionToken') for r in oai_server.requests] == [None, None, '6961467|1001']
+    # cs.LO is not one of the categories we follow
+    assert sorted(p.original_id for p in Paper.query) == ['2009.05387', 'cs_0112017']
+    paper = Paper.query.filter(Paper.original_id == 'cs_0112017').one()
+    assert [a.name for a in paper.authors] == ['John A. Smith Jr']
+    assert 'datestamp' not in ArxivPaper.query.get(paper.id).json_data
+    # The deleted record has the latest datestamp
+    assert get_scraper_state(arxiv_oai.STATE_NAME) == {'cs': {'from': '2020-09-14'}}
+
+
+def test_no_records_match_keeps_the_watermark(oai_server):
+    oai_server.responses = {'2020-09-14': 'oai_no_records.xml'}
+    set_scraper_state(arxiv_oai.STATE_NAME, {'stat': {'from': '2020-09-14'}})
+    arxiv_oai.run(sets=['stat'])
+
+    assert Paper.query.count() == 0
+    assert get_scraper_state(arxiv_oai.STATE_NAME) == {'stat': {'from': '2020-09-14'}}
+
+
+def test_restarts_the_list_when_the_resumption_token_expired(oai_server):
+    oai_server.responses = {'expired': 'oai_bad_resumption_token.xml', '2020-09-10': 'oai_list_records_1.xml',
+                            '6961467|1001': 'oai_list_records_2.xml'}
+    set_scraper_state(arxiv_oai.STATE_NAME, {'cs': {'from': '2020-09-10', 'resumption_token': 'expired',
+                                                    'pending_watermark': '2020-09-12'}})
+    arxiv_oai.run(sets=['cs'])
+
+    assert [r.get('resumptionToken') or r['from'] for r in oai_server.requests] == \
+           ['expired', '2020-09-10', '6961467|1001']
+    assert Paper.query.count() == 2
+    assert get_scraper_state(arxiv_oai.STATE_NAME) == {'cs': {'from': '2020-09-14'}}
+
+
+def test_parse_response_errors():
+    with pytest.raises(arxiv_oai.OAIError) as e:
+        arxiv_oai.parse_response(read_fixture('oai_bad_resumption_token.xml'))
+    assert e.value.code == 'badResumptionToken'
+
+    with pytest.raises(arxiv_oai.OAIError):
+        arxiv_oai.parse_response(b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><Identify/></OAI-PMH>')
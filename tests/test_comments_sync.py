@@ -0,0 +1,153 @@
+from datetime import datetime
+
+from src.models import Comment, Paper, User, db
+
+from .conftest import login
+
+
+def add_paper() -> Paper:
+    paper = Paper(title='Paper', original_id='2009.05387', publication_date=datetime(2020, 9, 11),
+                  last_update_date=datetime(2020, 9, 12))
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+
+def add_user(email='author@scihive.org') -> User:
+    user = User(email=email, username=email.split('@')[0])
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def add_comment(paper: Paper, user: User = None, text='Comment', shared_with='public') -> Comment:
+    comment = Comment(text=text, paper_id=paper.id, is_general=True, shared_with=shared_with,
+                      creation_date=datetime.utcnow(), user_id=user.id if user else None)
+    db.session.add(comment)
+    db.session.commit()
+    return comment
+
+
+def get_comments(client, paper: Paper, **args):
+    response = client.get(f'/paper/{paper.id}/comments', query_string=args)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def get_texts(result):
+    return sorted(c['text'] for c in result['comments'])
+
+
+def test_sync_returns_only_the_changes(app):
+    paper = add_paper()
+    add_comment(paper, text='First')
+    client = app.test_client()
+    result = get_comments(client, paper)
+    assert get_texts(result) == ['First']
+
+    add_comment(paper, text='Second')
+    result = get_comments(client, paper, cursor=result['cursor'])
+    assert get_texts(result) == ['Second']
+    assert get_comments(client, paper, cursor=result['cursor'])['comments'] == []
+
+
+def test_sync_returns_comments_that_committed_after_the_previous_sync(app):
+    paper = add_paper()
+    client = app.test_client()
+    other_connection = db.engine.connect()
+    transaction = other_connection.begin()
+    # Started (and stamped with its date) before the sync, but committed after it
+    other_connection.execute(Comment.__table__.insert().values(
+        text='Late', paper_id=paper.id, is_general=True, shared_with='public', creation_date=datetime.utcnow()))
+    result = get_comments(client, paper)
+    assert result['comments'] == []
+    transaction.commit()
+    other_connection.close()
+
+    assert get_texts(get_comments(client, paper, cursor=result['cursor'])) == ['Late']
+
+
+def test_sync_returns_deleted_and_hidden_comments(app):
+    paper = add_paper()
+    author = add_user()
+    deleted = add_comment(paper, author, text='Deleted')
+    hidden = add_comment(paper, author, text='Hidden')
+    add_comment(paper, author, text='Kept')
+    viewer = app.test_client()
+    result = get_comments(viewer, paper)
+    assert get_texts(result) == ['Deleted', 'Hidden', 'Kept']
+
+    client = app.test_client()
+    login(client, author.email)
+    assert client.delete(f'/paper/comment/{deleted.id}').status_code == 200
+    response = client.patch(f'/paper/comment/{hidden.id}', json={'text': 'Hidden', 'visibility': {'type': 'private'}})
+    assert response.status_code == 200
+
+    result = get_comments(viewer, paper, cursor=result['cursor'])
+    assert result['comments'] == []
+    assert sorted(result['deleted']) == sorted([str(deleted.id), str(hidden.id)])
+    # The author still sees the private comment
+    assert get_texts(get_comments(client, paper)) == ['Hidden', 'Kept']
+
+
+
+def test_sync_does_not_return_the_ids_of_comments_the_user_never_saw(app):
+    paper = add_paper()
+    author = add_user()
+    viewer = app.test_client()
+    cursor = get_comments(viewer, paper)['cursor']
+    private = add_comment(paper, author, text='Private', shared_with='private')
+    add_comment(paper, author, text='Public')
+
+    client = app.test_client()
+    login(client, author.email)
+    response = client.patch(f'/paper/comment/{private.id}', json={'text': 'Edited', 'visibility': {'type': 'private'}})
+    assert response.status_code == 200
+
+    result = get_comments(viewer, paper, cursor=cursor)
+    assert get_texts(result) == ['Public']
+    assert result['deleted'] == []
+
+
+def test_sync_keeps_narrowed_comments_the_user_still_sees(app):
+    paper = add_paper()
+    author = add_user()
+    comment = add_comment(paper, author, text='Narrowed')
+    client = app.test_client()
+    login(client, author.email)
+    cursor = get_comments(client, paper)['cursor']
+
+    response = client.patch(f'/paper/comment/{comment.id}', json={'text': 'Narrowed',
+                                                               'visibility': {'type': 'private'}})
+    assert response.status_code == 200
+    result = get_comments(client, paper, cursor=cursor)
+    assert get_texts(result) == ['Narrowed']
+    assert result['deleted'] == []
+
+    # The comment already has a tombstone
+    assert client.delete(f'/paper/comment/{comment.id}').status_code == 200
+    result = get_comments(client, paper, cursor=result['cursor'])
+    assert result['comments'] == []
+    assert result['deleted'] == [str(comment.id)]
+
+
+def test_sync_pages(app):
+    paper = add_paper()
+    client = app.test_client()
+    cursor = get_comments(client, paper)['cursor']
+    for i in range(5):
+        add_comment(paper, text=f'Comment {i}')
+
+    texts = []
+    has_more = True
+    while has_more:
+        result = get_comments(client, paper, cursor=cursor, limit=2)
+        texts += get_texts(result)
+        cursor, has_more = result['cursor'], result['hasMore']
+    assert texts == [f'Comment {i}' for i in range(5)]
+    assert get_comments(client, paper, cursor=cursor)['comments'] == []
+
+
+def test_invalid_cursor(app):
+    paper = add_paper()
+    assert app.test_client().get(f'/paper/{paper.id}/comments', query_string={'cursor': 'abc'}).status_code == 400
@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+
+import requests
+
+from src.models import EmailOutbox, EmailState, db
+from src.routes.notifications import dispatcher
+
+
+def add_email() -> EmailOutbox:
+    email = EmailOutbox(template='digest', subject='Updates',
+                        recipients=[{'address': 'user@scihive.org', 'name': 'User', 'variables': {}}])
+    db.session.add(email)
+    db.session.commit()
+    return email
+
+
+def test_posts_are_only_retried_when_mailgun_did_not_send():
+    retry = dispatcher.session.get_adapter(dispatcher.MAILGUN_URL).max_retries
+    assert retry.is_retry('POST', 429) and retry.is_retry('POST', 503)
+    assert not retry.is_retry('POST', 500) and not retry.is_retry('POST', 502)
+    # A read timeout means Mailgun may have sent the batch
+    assert retry.read == 0 and retry.connect > 0
+
+
+def test_attempt_is_recorded_before_sending(monkeypatch):
+    email = add_email()
+    seen_by_others = []
+
+    def send_batch(sent_email):
+        with db.engine.connect() as connection:
+            seen_by_others.append(connection.execute(
+                'SELECT attempts, next_attempt_date FROM email_outbox WHERE id = %s', sent_email.id).first())
+        raise requests.ConnectionError('Connection reset')
+
+    monkeypatch.setattr(dispatcher, 'send_batch', send_batch)
+    assert dispatcher.deliver_pending() == 0
+    attempts, next_attempt_date = seen_by_others[0]
+    assert attempts == 1
+    # Other senders skip the row while it is being sent
+    assert next_attempt_date > datetime.now(timezone.utc)
+
+    db.session.expire_all()
+    email = EmailOutbox.query.get(email.id)
+    assert (email.state, email.attempts, email.last_error) == (EmailState.pending, 1, 'Connection reset')
+    # Not due yet
+    assert dispatcher.deliver_pending() == 0
+    assert len(seen_by_others) == 1
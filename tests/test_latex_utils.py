@@ -0,0 +1,149 @@
+import gzip
+import os
+import re
+from io import BytesIO
+
+import pytest
+from TexSoup import TexSoup
+
+from src.routes import latex_utils
+
+from .conftest import FIXTURES_DIRECTORY, read_fixture
+
+
+def test_bib_item_cache_key_depends_on_the_versions(monkeypatch):
+    monkeypatch.setattr(latex_utils.pypandoc, 'get_pandoc_version', lambda: '2.10')
+    key = latex_utils.get_bib_item_cache_key('\\bibitem{a} A paper')
+    assert key == latex_utils.get_bib_item_cache_key('\\bibitem{a} A paper')
+    assert key != latex_utils.get_bib_item_cache_key('\\bibitem{a} Another paper')
+    assert key != latex_utils.get_bib_item_cache_key('\\bibitem{a} A paper', '\\newcommand{\\etal}{et al.}')
+
+    monkeypatch.setattr(latex_utils.pypandoc, 'get_pandoc_version', lambda: '2.11')
+    assert key != latex_utils.get_bib_item_cache_key('\\bibitem{a} A paper')
+
+    monkeypatch.setattr(latex_utils, 'REFERENCES_VERSION', latex_utils.REFERENCES_VERSION + 0.01)
+    monkeypatch.setattr(latex_utils.pypandoc, 'get_pandoc_version', lambda: '2.10')
+    assert key != latex_utils.get_bib_item_cache_key('\\bibitem{a} A paper')
+
+
+def test_bib_preamble_is_the_tex_before_the_items():
+    tex = read_fixture(os.path.join('latex', 'bibliography.bbl')).decode()
+    bib_string, _, _ = latex_utils.get_bibliography(tex)
+    preamble = latex_utils.get_bib_preamble(bib_string)
+    assert tex.startswith(preamble) and preamble.rstrip() == tex[:tex.index('\\bibitem')].rstrip()
+    assert latex_utils.get_bib_preamble('no items') == ''
+
+
+
+@pytest.mark.parametrize('content', [b'not gzip', gzip.compress(b'\\section{Intro}')[:-10],
+                                     gzip.compress('\\section{Intro}'.encode('utf-16'))])
+def test_skips_a_broken_single_tex_file(content):
+    assert latex_utils.extract_files(BytesIO(content), '.tex.gz', ['tex']) == []
+
+
+def test_extracts_a_single_tex_file():
+    source = BytesIO(gzip.compress(b'\\section{Intro}'))
+    assert latex_utils.extract_files(source, '.tex.gz', ['tex']) == ['\\section{Intro}']
+
+
+def test_extracts_no_references_from_a_broken_single_tex_file(monkeypatch):
+    monkeypatch.setattr(latex_utils, 'download_source_file', lambda arxiv_id: ('.tex.gz', BytesIO(b'not gzip')))
+    references = latex_utils.extract_references_from_latex('2009.05387')
+    assert references == {'data': {}, 'version': latex_utils.REFERENCES_VERSION}
+
+
+def read_latex_fixtures():
+    directory = os.path.join(FIXTURES_DIRECTORY, 'latex')
+    return {name: read_fixture(os.path.join('latex', name)).decode() for name in sorted(os.listdir(directory))}
+
+
+# The regex and TexSoup implementation scan_tex replaced, kept as the reference for its output
+def reference_find_right_closing_bracket(tex, start_pos, left_char, right_char):
+    level = 0
+    end_pos = start_pos + 1
+    while True:
+        if tex[end_pos] == right_char:
+            if level == 0:
+                break
+            level -= 1
+        elif tex[end_pos] == left_char:
+            level += 1
+        end_pos += 1
+    return end_pos
+
+
+def reference_extract_text(section, tex):
+    base_groups = section.groups()
+    if '{' not in base_groups[1]:
+        return base_groups
+    start_pos = tex.index('{', section.start())
+    end_pos = reference_find_right_closing_bracket(tex, start_pos, '{', '}')
+    soup = TexSoup(tex[section.start():end_pos + 1])
+    return base_groups[0], ''.join(c for c in list(soup.contents)[0].contents if isinstance(c, str))
+
+
+def reference_get_sections(tex):
+    sections = re.finditer(r'\\(section|subsection|subsubsection){(.*?)}', tex)
+    return [reference_extract_text(section, tex) for section in sections]
+
+
+def reference_get_bibliography(tex):
+    if tex.find('\\begin{thebibliography}') == -1:
+        return None
+    bib_end = tex.find('\\end{thebibliography}')
+    bib_content = tex[:bib_end]
+    matches = list(re.finditer(r'\n\\bibitem\s*[\[\{]', bib_content))
+    if not matches:
+        return None
+    items = []
+    for i, match in enumerate(matches):
+        end_pos = len(bib_content) + 1 if i == len(matches) - 1 else matches[i + 1].start()
+        items.append(latex_utils.clean_bib_item(bib_content[match.start():end_pos]))
+
+    result = tex[:matches[0].start()]
+    cite_names = []
+    for item in items:
+        cite_item = item
+        if re.match(r'\n\\bibitem\s*\[', item):
+            start_pos = item.find('[')
+            end_pos = reference_find_right_closing_bracket(item, start_pos, '[', ']')
+            cite_item = item[:start_pos] + item[end_pos + 1:]
+        cite_names.append(re.search('{(.*?)}', cite_item).group(1))
+        result += f'\n{{{latex_utils.BIB_ITEM_MARKER}}}\n' + item
+    result += f'\n{{{latex_utils.BIB_ITEM_MARKER}}}\n\n' + tex[bib_end:]
+    return re.sub(r'\n\\newblock', '\n\n', result), cite_names, items
+
+
+@pytest.mark.parametrize('name', sorted(read_latex_fixtures()))
+def test_scan_matches_the_reference_implementation(name):
+    tex = read_latex_fixtures()[name]
+    assert latex_utils.get_sections([tex]) == reference_get_sections(tex)
+    assert latex_utils.get_equations(tex) == re.findall(r'\\begin\{equation\}(.*?)\\end\{equation\}', tex, re.S)
+    assert latex_utils.get_bibliography(tex) == reference_get_bibliography(tex)
+
+
+def test_scan_looks_inside_equations():
+    tex = ('\\begin{equation}\n\\section{Inside}\n\\end{equation}\n\\section{After}\n'
+           '\\begin{thebibliography}{1}\n\\begin{equation}\n\\bibitem{a} A\n\\end{equation}\n\\end{thebibliography}')
+    scan = latex_utils.scan_tex(tex)
+    assert scan.sections == [('section', 'Inside'), ('section', 'After')]
+    assert scan.equations == ['\n\\section{Inside}\n', '\n\\bibitem{a} A\n']
+    assert latex_utils.get_bibliography(tex)[1] == ['a']
+
+
+def test_parse_source_content_scans_each_file_once(monkeypatch):
+    tex = read_latex_fixtures()['bibliography.tex']
+    scanned = []
+    scan_tex = latex_utils.scan_tex
+    monkeypatch.setattr(latex_utils, 'scan_tex', lambda content: scanned.append(content) or scan_tex(content))
+    monkeypatch.setattr(latex_utils, 'convert_bib_to_html', lambda paper_id, bib_string, cite_names, items: {})
+
+    _, sections = latex_utils.parse_source_content('2009.05387', '.tex.gz', gzip.compress(tex.encode()))
+    assert sections == [('section', 'Related Work')]
+    assert scanned == [tex]
+
+
+def test_unclosed_brackets():
+    assert latex_utils.find_right_closing_bracket('{a{b}', 0, '{', '}') == -1
+    assert latex_utils.get_sections(['\\section{A {b}']) == [('section', 'A {b')]
+    assert latex_utils.get_cite_name('\n\\bibitem[Lee {2019}{lee2019}') == '2019'
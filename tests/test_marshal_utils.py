@@ -0,0 +1,121 @@
+import json
+from datetime import datetime, timezone
+
+import flask_restful
+import orjson
+from flask_restful import fields
+
+from src.models import Author, Comment, MetadataState, Paper, PaperWithCode, Reply, User, db
+from src.routes import comments as comments_routes
+from src.routes.comments import comment_fields, serialize_comments
+from src.routes.marshal_utils import compile_fields
+from src.routes.membership_utils import GroupRef
+from src.routes.paper_list import papers_list_fields, serialize_papers_list
+from src.routes.paper_query_utils import paper_fields, serialize_paper
+
+
+def marshal(data, fields_dict):
+    # Looked up on every call, the app replaces flask_restful.marshal with the version that drops None values
+    return flask_restful.marshal(data, fields_dict)
+
+
+def assert_same_output(compiled, marshalled):
+    # Compare the JSON each one is sent as, so datetimes and ordered dicts are compared by their encoding
+    assert orjson.loads(orjson.dumps(compiled)) == json.loads(json.dumps(marshalled))
+
+
+def add_papers():
+    authors = [Author(name='Maria Gonzalez'), Author(name='Wei Chen')]
+    papers = [
+        Paper(title='Dense Retrievers', original_id='2009.05387', abstract='We study', authors=authors,
+              publication_date=datetime(2020, 9, 11), last_update_date=datetime(2020, 9, 12), doi='10.18653/1',
+              local_pdf='https://storage.scihive.org/2009.05387.pdf', twitter_score=12, num_stars=3,
+              table_of_contents=[{'title': 'Intro', 'page': 1}], references={'data': {}},
+              metadata_state=MetadataState.fetching,
+              paper_with_code=PaperWithCode(github_link='https://github.com/a/b', link='https://pwc.com/a', stars=7,
+                                            last_update_date=datetime(2020, 9, 13))),
+        # Uploaded papers have no arXiv id, authors, code or metadata
+        Paper(title='Uploaded', publication_date=datetime(2020, 9, 1), last_update_date=datetime(2020, 9, 1),
+              is_private=True, metadata_state=None, twitter_score=None, num_stars=None),
+        Paper(title='Code without stars', original_id='2009.04981', authors=authors[1:],
+              publication_date=datetime(2020, 9, 10), last_update_date=datetime(2020, 9, 10), is_private=False,
+              paper_with_code=PaperWithCode(link='https://pwc.com/c', last_update_date=datetime(2020, 9, 13))),
+    ]
+    db.session.add_all(papers)
+    db.session.commit()
+    db.session.expire_all()
+    return Paper.query.order_by(Paper.id).all()
+
+
+def test_serialize_paper_matches_marshal():
+    papers = add_papers()
+    papers[0].groups = [GroupRef(1), GroupRef(5)]
+    papers[1].groups = []
+    for paper in papers:
+        assert_same_output(serialize_paper(paper), marshal(paper, paper_fields))
+
+
+def test_serialize_papers_list_matches_marshal():
+    papers = add_papers()
+    papers[0].collection_ids = ['1', '5']
+    for data in [{'count': 3, 'papers': papers, 'hasMore': False}, {'count': 0, 'papers': [], 'hasMore': None}]:
+        assert_same_output(serialize_papers_list(data), marshal(data, papers_list_fields))
+
+
+def test_serialize_comments_matches_marshal(monkeypatch):
+    author = User(email='author@scihive.org', username='author', first_name='Ada', last_name=None)
+    other = User(email='other@scihive.org', username='other', first_name='Bo', last_name='Li')
+    paper = add_papers()[0]
+    created = datetime(2020, 9, 12, 10, 30, tzinfo=timezone.utc)
+    comments = []
+    for i, (user, shared_with) in enumerate([(author, 'public'), (author, 'anonymous'), (other, 'private'),
+                                             (None, 'public'), (other, 'group')]):
+        replies = [Reply(text='Reply', user=reply_user, creation_date=created) for reply_user in [other, None][:i]]
+        comments.append(Comment(text=f'Comment {i}', highlighted_text=None if i % 2 else 'Highlight',
+                                position={'pageNumber': i, 'rects': []} if i != 3 else None, paper=paper,
+                                user=user, shared_with=shared_with, creation_date=created, replies=replies,
+                                is_general=None if i == 4 else bool(i % 2)))
+    db.session.add_all(comments)
+    db.session.commit()
+    db.session.expire_all()
+    comments = Comment.query.order_by(Comment.id).all()
+
+    for email in [None, 'author@scihive.org', 'other@scihive.org']:
+        monkeypatch.setattr(comments_routes, 'get_jwt_email', lambda: email)
+        assert_same_output(serialize_comments(comments), marshal(comments, comment_fields))
+
+
+class Plain:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_compile_fields_defaults_and_attributes():
+    fields_dict = {
+        'raw': fields.Raw(default=[]),
+        'raw_dict': fields.Raw(attribute='missing', default={'a': 1}),
+        'string': fields.String(default=''),
+        'integer': fields.Integer,
+        'integer_default': fields.Integer(default=5),
+        'boolean': fields.Boolean(attribute='flag', default=False),
+        'float': fields.Float(attribute='value'),
+        'dotted': fields.String(attribute='child.name', default='none'),
+        'callable': fields.String(attribute=lambda obj: 'dict' if isinstance(obj, dict) else None),
+        'date': fields.DateTime(dt_format='iso8601', attribute='created'),
+        'plain_nested': {'name': fields.String(attribute='child.name'), 'empty': fields.String},
+        'nested': fields.Nested({'name': fields.String, 'empty': fields.String}, attribute='child', allow_null=True),
+        'items': fields.List(fields.Nested({'name': fields.String, 'empty': fields.String})),
+        'strings': fields.List(fields.String),
+    }
+    serialize = compile_fields(fields_dict)
+    objects = [
+        Plain(raw=None, string=None, integer=None, integer_default=None, flag=None, value=None, child=None,
+              created=None, items=None, strings=None),
+        Plain(raw=[1, 2], string='text', integer='7', integer_default=0, flag=1, value=1.5,
+              child=Plain(name='child', empty=None), created=datetime(2020, 9, 12, tzinfo=timezone.utc),
+              items=[Plain(name='a', empty=None), None], strings=['a', 1]),
+        {'raw': {'x': None}, 'string': 'dict', 'integer': 3, 'flag': False, 'value': 0, 'child': {'name': 'c'},
+         'items': [], 'strings': []},
+    ]
+    for obj in objects:
+        assert_same_output(serialize(obj), marshal(obj, fields_dict))
@@ -0,0 +1,95 @@
+import threading
+from datetime import datetime
+
+from src.models import MetadataState, Paper, db
+from src.routes.metadata_utils import METADATA_VERSION, AuthorObj
+from src.scrapers import metadata_backfill
+from src.scrapers.utils import get_scraper_state, set_scraper_state
+
+
+def add_papers(num_papers: int, **kwargs):
+    papers = [Paper(title=f'Paper {i}', local_pdf=f'https://arxiv.org/pdf/2009.0538{i}', is_private=False,
+                    publication_date=datetime(2020, 9, 11), last_update_date=datetime(2020, 9, 12), **kwargs)
+              for i in range(num_papers)]
+    db.session.add_all(papers)
+    db.session.commit()
+    return [paper.id for paper in papers]
+
+
+class FakeGrobid:
+    def __init__(self, failing_ids=()):
+        self.failing_ids = set(failing_ids)
+        self.fetched = []
+        self.threads = set()
+
+    def __call__(self, paper_id, pdf_link):
+        self.fetched.append(paper_id)
+        self.threads.add(threading.get_ident())
+        if paper_id in self.failing_ids:
+            return False, None
+        return True, {'doi': f'10.1/{paper_id}', 'table_of_contents': [], 'references': [],
+                      'authors': [AuthorObj(first_name='Ada', last_name=f'Lovelace{paper_id}', org=[])]}
+
+
+def test_fetches_on_the_workers_and_applies_on_the_caller(monkeypatch):
+    paper_ids = add_papers(3)
+    grobid = FakeGrobid(failing_ids=[paper_ids[1]])
+    monkeypatch.setattr(metadata_backfill, 'fetch_paper_metadata', grobid)
+
+    metadata_backfill.run(workers=2, batch_size=2, max_per_second=1000)
+
+    assert sorted(grobid.fetched) == paper_ids
+    assert threading.get_ident() not in grobid.threads
+    db.session.expire_all()
+    applied, failed, _ = [Paper.query.get(paper_id) for paper_id in paper_ids]
+    assert applied.doi == f'10.1/{paper_ids[0]}'
+    assert applied.metadata_state == MetadataState.ready and applied.metadata_version == METADATA_VERSION
+    assert [author.name for author in applied.authors] == [f'Ada Lovelace{paper_ids[0]}']
+    assert failed.doi is None and not failed.metadata_version
+    # The finished run leaves no checkpoint behind
+    assert get_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME) is None
+
+
+def test_resumes_from_the_checkpoint(monkeypatch):
+    paper_ids = add_papers(4)
+    set_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME, paper_ids[1])
+    grobid = FakeGrobid()
+    monkeypatch.setattr(metadata_backfill, 'fetch_paper_metadata', grobid)
+
+    metadata_backfill.run(max_per_second=1000)
+    assert sorted(grobid.fetched) == paper_ids[2:]
+
+    grobid.fetched = []
+    set_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME, paper_ids[1])
+    metadata_backfill.run(max_per_second=1000, restart=True)
+    assert sorted(grobid.fetched) == paper_ids[:2]
+
+
+def test_an_interrupted_run_keeps_the_last_finished_batch(monkeypatch):
+    paper_ids = add_papers(4)
+    grobid = FakeGrobid()
+    monkeypatch.setattr(metadata_backfill, 'fetch_paper_metadata', grobid)
+    apply_paper_metadata = metadata_backfill.apply_paper_metadata
+
+    def apply_until_the_last_paper(paper, metadata):
+        if paper.id == paper_ids[-1]:
+            raise KeyboardInterrupt
+        apply_paper_metadata(paper, metadata)
+
+    monkeypatch.setattr(metadata_backfill, 'apply_paper_metadata', apply_until_the_last_paper)
+    metadata_backfill.run(workers=1, batch_size=2, max_per_second=1000)
+    assert get_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME) == paper_ids[1]
+
+
+def test_forces_the_given_papers_and_keeps_the_checkpoint(monkeypatch):
+    paper_ids = add_papers(2, metadata_state=MetadataState.ready, metadata_version=METADATA_VERSION)
+    set_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME, 1000)
+    grobid = FakeGrobid()
+    monkeypatch.setattr(metadata_backfill, 'fetch_paper_metadata', grobid)
+
+    metadata_backfill.run(paper_ids=paper_ids[1:], max_per_second=1000)
+    assert grobid.fetched == []
+
+    metadata_backfill.run(paper_ids=paper_ids[1:], max_per_second=1000, force=True)
+    assert grobid.fetched == paper_ids[1:]
+    assert get_scraper_state(metadata_backfill.CHECKPOINT_STATE_NAME) == 1000
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from src.models import Paper, db
+from src.routes import paper as paper_routes
+from src.routes.latex_utils import REFERENCES_VERSION
+
+
+def add_paper(**kwargs) -> Paper:
+    paper = Paper(title='Paper', original_id='2009.05387', publication_date=datetime(2020, 9, 11),
+                  last_update_date=datetime(2020, 9, 12), **kwargs)
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+
+def test_serves_the_extracted_latex(app, monkeypatch):
+    references = {'data': {'ref1': {'html': '<p>Ref</p>', 'arxivId': None}}, 'version': REFERENCES_VERSION}
+    paper = add_paper(latex_references=references, latex_sections=[['section', 'Intro']],
+                      latex_version=REFERENCES_VERSION)
+    monkeypatch.setattr(paper_routes, 'extract_latex_items', lambda arxiv_id: 1 / 0)
+
+    client = app.test_client()
+    assert client.get(f'/paper/{paper.id}/references').get_json() == references
+    assert client.get(f'/paper/{paper.id}/sections').get_json() == [['section', 'Intro']]
+
+
+def test_extracts_stale_latex_and_stores_it(app, monkeypatch):
+    paper = add_paper(latex_references={'data': {}, 'version': 1.0}, latex_sections=[], latex_version=1.0)
+    references = {'data': {'ref1': {'html': '<p>Ref</p>', 'arxivId': None}}, 'version': REFERENCES_VERSION}
+    extracted = []
+
+    def extract_latex_items(arxiv_id):
+        extracted.append(arxiv_id)
+        return references, [('section', 'Intro')]
+
+    monkeypatch.setattr(paper_routes, 'extract_latex_items', extract_latex_items)
+    client = app.test_client()
+    assert client.get(f'/paper/{paper.id}/references').get_json() == references
+    assert client.get(f'/paper/{paper.id}/sections').get_json() == [['section', 'Intro']]
+    assert extracted == ['2009.05387']
+    db.session.expire_all()
+    assert Paper.query.get(paper.id).latex_version == REFERENCES_VERSION
+
+
+def test_falls_back_to_stale_latex_when_the_extraction_fails(app, monkeypatch):
+    paper = add_paper(latex_references={'data': {}, 'version': 1.0}, latex_sections=[['section', 'Old']],
+                      latex_version=1.0)
+    monkeypatch.setattr(paper_routes, 'extract_latex_items', lambda arxiv_id: 1 / 0)
+    assert app.test_client().get(f'/paper/{paper.id}/sections').get_json() == [['section', 'Old']]
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import psycopg2
+import pytest
+
+from src.models import Paper, PaperWithCode, db
+from src.scrapers.paperswithcode import update_db
+
+
+def add_paper(original_id: str) -> Paper:
+    paper = Paper(title='Paper', original_id=original_id, publication_date=datetime(2020, 9, 11),
+                  last_update_date=datetime(2020, 9, 12))
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+
+def get_row(arxiv_id, github_link, stars):
+    return {'arxiv_id': arxiv_id, 'github_link': github_link, 'url': f'https://paperswithcode.com/{arxiv_id}',
+            'stars': str(stars), 'framework': 'pytorch'}
+
+
+def test_update_db_takes_the_links_of_the_first_row_and_the_stars_of_the_last():
+    paper = add_paper('2009.05387')
+    counts = update_db([get_row('2009.05387', 'https://github.com/a/first', 10),
+                        get_row('2009.05387', 'https://github.com/b/second', 3),
+                        get_row('2009.99999', 'https://github.com/c/missing', 1)])
+    assert counts == {'inserted': 1, 'updated': 0, 'unchanged': 0, 'not_found': 1}
+    pwc = PaperWithCode.query.filter(PaperWithCode.paper_id == paper.id).one()
+    assert (pwc.github_link, pwc.stars) == ('https://github.com/a/first', 3)
+
+    counts = update_db([get_row('2009.05387', 'https://github.com/b/second', 7)])
+    assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 0, 'not_found': 0}
+    db.session.expire_all()
+    pwc = PaperWithCode.query.filter(PaperWithCode.paper_id == paper.id).one()
+    assert (pwc.github_link, pwc.stars) == ('https://github.com/a/first', 7)
+
+
+def test_update_db_rolls_back_on_failure():
+    add_paper('2009.05387')
+
+    # Postgres rejects the NUL character, which aborts the transaction in the middle of the COPY
+    with pytest.raises(psycopg2.Error):
+        update_db([get_row('2009.05387', 'https://github.com/a/first', 10), get_row('2009.\x00', None, 1)])
+    # The session is usable again
+    assert PaperWithCode.query.count() == 0
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+
+from src.models import Paper, Permission, User, db
+from src.routes import paper as paper_routes
+from src.routes.permissions_utils import PermissionType, get_paper_permission_type
+from src.routes.user_utils import get_cached_user
+
+from .conftest import login
+
+
+def add_user(email: str) -> User:
+    user = User(email=email, username=email.split('@')[0])
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def add_private_paper(owner: User, viewers=()) -> Paper:
+    paper = Paper(title='Paper', original_id='file-hash', publication_date=datetime(2020, 9, 11),
+                  last_update_date=datetime(2020, 9, 12), is_private=True, uploaded_by_id=owner.id,
+                  local_pdf='https://storage.scihive.org/file-hash.pdf')
+    db.session.add(paper)
+    db.session.commit()
+    db.session.add_all([Permission(paper_id=paper.id, user_id=viewer.id) for viewer in viewers])
+    db.session.commit()
+    return paper
+
+
+def get_user_queries(statements):
+    return [s for s in statements if 'FROM "user"' in s and '"user".email =' in s]
+
+
+def get_permission_queries(statements):
+    return [s for s in statements if 'FROM permission' in s]
+
+
+def test_get_cached_user_queries_once(query_counter):
+    user = add_user('viewer@scihive.org')
+    query_counter.reset()
+    assert get_cached_user('viewer@scihive.org') is get_cached_user('viewer@scihive.org') is not None
+    assert query_counter.count == 1
+    # Missing users are not memoized, they may sign up during the request
+    assert get_cached_user('new@scihive.org') is None
+    assert get_cached_user('new@scihive.org') is None
+    assert query_counter.count == 3
+    assert user.id == get_cached_user('viewer@scihive.org').id
+
+
+def test_paper_permission_type_uses_the_loaded_permissions(query_counter):
+    owner, viewer, other = add_user('owner@scihive.org'), add_user('viewer@scihive.org'), add_user('other@scihive.org')
+    paper_id = add_private_paper(owner, viewers=[viewer]).id
+    db.session.expire_all()
+    paper = Paper.query.get(paper_id)
+    users = [User.query.get(u.id) for u in (owner, viewer, other)]
+    query_counter.reset()
+    for _ in range(2):
+        assert [get_paper_permission_type(paper, user) for user in users] == \
+               [PermissionType.CREATOR, PermissionType.VIEWER, PermissionType.NONE]
+    assert query_counter.count == 0
+
+
+@pytest.mark.parametrize('path', ['', '/comments', '/groups'])
+def test_private_paper_endpoints_resolve_the_user_once(app, query_counter, monkeypatch, path):
+    monkeypatch.setattr(paper_routes, 'is_metadata_stale', lambda paper: False)
+    owner, viewer = add_user('owner@scihive.org'), add_user('viewer@scihive.org')
+    paper_id = add_private_paper(owner, viewers=[viewer]).id
+    client = app.test_client()
+    login(client, 'viewer@scihive.org')
+
+    query_counter.reset()
+    assert client.get(f'/paper/{paper_id}{path}').status_code == 200
+    assert len(get_user_queries(query_counter.statements)) == 1
+    assert get_permission_queries(query_counter.statements) == []
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from src.scrapers.utils import RateLimiter, parse_arxiv_url
+
+
+def test_rate_limiter_is_shared_by_threads():
+    rate_limiter = RateLimiter(max_per_second=50)
+    calls = []
+
+    def call():
+        for _ in range(5):
+            rate_limiter.wait()
+            calls.append(time.monotonic())
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The first call goes through right away, the other 19 wait for their token
+    assert len(calls) == 20
+    assert time.monotonic() - start >= 19 / 50 * 0.95
+
+
+def test_rate_limiter_burst():
+    rate_limiter = RateLimiter(max_per_second=1, burst=3)
+    start = time.monotonic()
+    for _ in range(3):
+        rate_limiter.wait()
+    assert time.monotonic() - start < 0.5
+
+
+def test_parse_arxiv_url():
+    assert parse_arxiv_url('http://arxiv.org/abs/1512.08756v2') == ('1512.08756', 2)
+    assert parse_arxiv_url('http://arxiv.org/abs/cond-mat/0102536v1') == ('cond-mat_0102536', 1)
@@ -0,0 +1,94 @@
+import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from src.models import Paper, Tweet, db
+from src.scrapers.twitter import (FULL_SCORES_QUERY, apply_score_decay, count_replies, get_decay_params,
+                                  get_tweet_score, upsert_tweets)
+
+NOW = datetime.datetime(2020, 9, 14, 12, tzinfo=datetime.timezone.utc)
+
+
+def add_paper(original_id: str) -> Paper:
+    paper = Paper(title='Paper', original_id=original_id, publication_date=datetime.datetime(2020, 9, 11),
+                  last_update_date=datetime.datetime(2020, 9, 12))
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+
+def get_row(tweet_id: str, paper_id: int, age_days: float, likes=0, retweets=0, replies=0) -> dict:
+    return dict(id=tweet_id, paper_id=paper_id, insertion_date=NOW, creation_date=NOW - datetime.timedelta(days=age_days),
+                lang='en', text='A paper', retweets=retweets, likes=likes, replies=replies)
+
+
+def get_full_recomputation(now: datetime.datetime) -> dict:
+    return {r.id: (r.twitter_score, r.expected) for r in db.session.execute(text(FULL_SCORES_QUERY), get_decay_params(now))}
+
+
+def test_sql_scores_match_python_scores():
+    paper = add_paper('2009.05387')
+    ages = [0, 0.5, 2, 2.5, 3, 7, 13.7, 30, 90, 179.9, 181]
+    rows = [get_row(f'{i}', paper.id, age, likes=97 * i + 3, retweets=11 * i, replies=i) for i, age in enumerate(ages)]
+    db.session.execute(Tweet.__table__.insert(), rows)
+    db.session.commit()
+
+    apply_score_decay(NOW)
+    scores = dict(db.session.query(Tweet.id, Tweet.score))
+    assert scores == {row['id']: get_tweet_score(row, NOW) for row in rows}
+
+
+def test_incremental_scores_match_full_recomputation():
+    paper, other_paper = add_paper('2009.05387'), add_paper('2009.04981')
+    upsert_tweets([get_row('1', paper.id, 1, likes=40), get_row('2', paper.id, 5, likes=10, retweets=3),
+                   get_row('3', other_paper.id, 20, likes=500)], now=NOW)
+    # Later fetches update the counts, add tweets and move a tweet to another paper
+    later = NOW + datetime.timedelta(hours=7)
+    upsert_tweets([get_row('1', paper.id, 1, likes=75, replies=2), get_row('4', other_paper.id, 0, likes=8),
+                   get_row('2', other_paper.id, 5, likes=12, retweets=3)], now=later)
+
+    for days in (0.5, 3, 40, 200):
+        now = NOW + datetime.timedelta(days=days)
+        apply_score_decay(now)
+        results = get_full_recomputation(now)
+        assert all(score == expected for score, expected in results.values()), (days, results)
+        # Tweets whose score did not change are not rewritten
+        assert apply_score_decay(now) == 0
+    assert Paper.query.get(paper.id).twitter_score == 0
+
+
+def make_tweet(tweet_id: int, screen_name='author', in_reply_to=None):
+    return SimpleNamespace(id=tweet_id, id_str=str(tweet_id), author=SimpleNamespace(screen_name=screen_name),
+                           in_reply_to_status_id_str=str(in_reply_to) if in_reply_to else None)
+
+
+class FakeSearchApi:
+    def __init__(self, replies):
+        self.replies = replies
+
+    def search(self, q, since_id, count):
+        replies = [r for r in self.replies if r.id > int(since_id)]
+        return sorted(replies, key=lambda r: r.id, reverse=True)[:count]
+
+
+def test_count_replies_keeps_the_stored_counts_of_tweets_without_replies():
+    paper = add_paper('2009.05387')
+    upsert_tweets([get_row('10', paper.id, 1, replies=5), get_row('20', paper.id, 1, replies=1)], now=NOW)
+    tweets = [make_tweet(10), make_tweet(20), make_tweet(30)]
+    api = FakeSearchApi([make_tweet(31, 'reader', in_reply_to=20), make_tweet(32, 'reader', in_reply_to=20),
+                         make_tweet(33, 'author', in_reply_to=20)])
+
+    assert count_replies(api, tweets) == {'10': 5, '20': 2}
+
+
+def test_count_replies_only_counts_the_tweets_a_full_page_covers():
+    paper = add_paper('2009.05387')
+    upsert_tweets([get_row('10', paper.id, 1, replies=150)], now=NOW)
+    # The page only reaches back to the 20 latest replies of tweet 500, the replies to tweet 700 are all in it
+    replies = [make_tweet(100 + i, 'reader', in_reply_to=10) for i in range(50)]
+    replies += [make_tweet(600 + i, 'reader', in_reply_to=500) for i in range(80)]
+    replies += [make_tweet(800 + i, 'reader', in_reply_to=700) for i in range(80)]
+    api = FakeSearchApi(replies)
+
+    assert count_replies(api, [make_tweet(10), make_tweet(500), make_tweet(700)]) == {'10': 150, '700': 80}
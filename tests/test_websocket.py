@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from flask_jwt_extended import create_access_token
+
+from src.models import Paper, User, db
+
+
+def add_private_paper(uploaded_by: User) -> Paper:
+    paper = Paper(title='Paper', original_id='file-hash', publication_date=datetime(2020, 9, 11),
+                  last_update_date=datetime(2020, 9, 12), is_private=True, uploaded_by_id=uploaded_by.id)
+    db.session.add(paper)
+    db.session.commit()
+    return paper
+
+
+def add_user(email: str, username: str) -> User:
+    user = User(email=email, username=username)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def get_socket_client(app, email: str = None):
+    from src import socketio_app
+    flask_client = app.test_client()
+    if email:
+        flask_client.set_cookie('localhost', 'access_token_cookie', create_access_token(identity=email))
+    return socketio_app.test_client(app, flask_test_client=flask_client)
+
+
+def test_rejected_join_returns_an_error(app):
+    owner = add_user('owner@scihive.org', 'owner')
+    # The socket client pushes its own app context, which removes the session of the test when it ends
+    paper_id = str(add_private_paper(owner).id)
+    client = get_socket_client(app)
+    client.emit('join', {'paperId': paper_id})
+    assert client.get_received() == [{'name': 'join_error', 'args': [
+        {'paperId': paper_id, 'message': 'Missing paper permissions'}], 'namespace': '/'}]
+
+    client.emit('join', {'paperId': '123456'})
+    assert client.get_received()[0]['args'][0]['message'] == 'Paper not found'
+
+
+def test_join_with_duplicate_emails(app):
+    # Emails are not unique, the access check picks the same user as the routes instead of failing
+    owner = add_user('owner@scihive.org', 'owner')
+    add_user('owner@scihive.org', 'owner2')
+    paper_id = str(add_private_paper(owner).id)
+    client = get_socket_client(app, 'owner@scihive.org')
+    client.emit('join', {'paperId': paper_id})
+    assert client.get_received() == []